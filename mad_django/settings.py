@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -151,3 +152,49 @@ CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:8000",
     "http://localhost:8000",
 ]
+
+
+# Multi-Agent Dungeon settings
+
+# Directory holding the Unix sockets the daemons use to wake each other up
+# when queue rows are written (see mad_multi_agent_dungeon/doorbell.py).
+MAD_DOORBELL_DIR = Path(tempfile.gettempdir()) / "mad_doorbell"
+
+# Maximum number of LLM requests a process keeps in flight at once
+MAD_LLM_CONCURRENCY = 4
+
+# Stream LLM responses and queue the commands in them as they arrive
+MAD_LLM_STREAM = False
+
+# How long an LLM worker owns a claimed request before another worker may
+# take it over (e.g. because the first one crashed)
+MAD_LLM_LEASE_SECONDS = 300
+
+# How long a command worker owns a claimed command before it is handed back to
+# the queue (e.g. because the worker was killed mid-batch)
+MAD_COMMAND_LEASE_SECONDS = 60
+
+# How long an API key is left alone after the LLM API throttled it (HTTP 429)
+MAD_LLM_KEY_COOLDOWN_SECONDS = 60
+
+# zlib-compress stored prompt segments (see mad_multi_agent_dungeon/prompt_store.py)
+MAD_PROMPT_COMPRESSION = False
+
+# How an agent's token_budget is split between the prompt segments. A share a
+# segment doesn't use goes to the others.
+MAD_PROMPT_BUDGET_SHARES = {"base": 0.3, "memories": 0.3, "perception": 0.4}
+
+# Count prompt tokens with the LLM API instead of the local estimator
+MAD_EXACT_TOKEN_COUNTS = False
+
+# Where map.json and objects.json are read from, and how often (in seconds) to
+# check them for changes to reload
+MAD_WORLD_DATA_DIR = BASE_DIR / "mad_multi_agent_dungeon" / "data"
+MAD_WORLD_RELOAD_INTERVAL = 1.0
+
+# How often (in seconds) the command worker's in-memory room occupancy index is
+# rebuilt from the database, to pick up agents moved outside the worker
+MAD_OCCUPANCY_REFRESH_SECONDS = 60
+
+# How long (in seconds) the command worker caches the objects of a room
+MAD_OBJECT_CACHE_SECONDS = 30
@@ -1,7 +1,16 @@
+from django import forms
 from django.contrib import admin
 from django.urls import reverse
 from django.utils.html import format_html
-from .models import Agent, CommandQueue, PerceptionQueue, Memory, LLMQueue, LLMAPIKey
+from .models import (
+    Agent,
+    CommandQueue,
+    PerceptionQueue,
+    Memory,
+    LLMQueue,
+    LLMAPIKey,
+    PromptSegment,
+)
 
 
 class MyAdminSite(admin.AdminSite):
@@ -18,8 +27,28 @@ class MyAdminSite(admin.AdminSite):
 admin_site = MyAdminSite(name="myadmin")
 
 
+class AgentAdminForm(forms.ModelForm):
+    # Edits the materialized perception; saving a change replaces it as a whole
+    perception = forms.CharField(widget=forms.Textarea, required=False)
+
+    class Meta:
+        model = Agent
+        exclude = ("perception_snapshot",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.initial["perception"] = self.instance.perception
+
+    def save(self, commit=True):
+        if "perception" in self.changed_data:
+            self.instance.perception = self.cleaned_data["perception"]
+        return super().save(commit)
+
+
 @admin.register(Agent, site=admin_site)
 class AgentAdmin(admin.ModelAdmin):
+    form = AgentAdminForm
     list_display = (
         "name",
         "look",
@@ -49,6 +78,7 @@ class AgentAdmin(admin.ModelAdmin):
                     "level",
                     "phase",
                     "perception_limit",
+                    "token_budget",
                     "is_running",
                     "prompt",
                     "perception",
@@ -59,7 +89,7 @@ class AgentAdmin(admin.ModelAdmin):
         (
             "Timestamps",
             {
-                "fields": ("last_command_sent", "last_retrieved"),
+                "fields": ("last_command_sent", "last_retrieved", "not_before"),
                 "classes": ("collapse",),
             },
         ),
@@ -74,7 +104,7 @@ class AgentAdmin(admin.ModelAdmin):
 
 @admin.register(CommandQueue, site=admin_site)
 class CommandQueueAdmin(admin.ModelAdmin):
-    list_display = ("agent", "command", "status", "date", "output")
+    list_display = ("agent", "command", "status", "date", "not_before", "output")
     list_filter = ("status", "agent", "date")
     search_fields = ("command", "output")
     readonly_fields = ("date", "output")
@@ -97,10 +127,27 @@ class MemoryAdmin(admin.ModelAdmin):
 
 @admin.register(LLMQueue, site=admin_site)
 class LLMQueueAdmin(admin.ModelAdmin):
-    list_display = ("agent", "prompt", "status", "yield_value", "date", "response")
+    list_display = (
+        "agent",
+        "prompt",
+        "status",
+        "yield_value",
+        "date",
+        "lease_expires",
+        "response",
+    )
     list_filter = ("status", "agent", "date")
-    search_fields = ("prompt", "response")
-    readonly_fields = ("date",)
+    search_fields = ("prompt_text", "response")
+    # Prompts built by the agent app are reassembled from their segments
+    readonly_fields = ("date", "prompt", "prompt_segments")
+
+
+@admin.register(PromptSegment, site=admin_site)
+class PromptSegmentAdmin(admin.ModelAdmin):
+    list_display = ("digest", "size", "compressed", "created_at")
+    list_filter = ("compressed",)
+    readonly_fields = ("digest", "size", "compressed", "created_at", "text")
+    exclude = ("data",)
 
 
 @admin.register(LLMAPIKey, site=admin_site)
@@ -111,6 +158,7 @@ class LLMAPIKeyAdmin(admin.ModelAdmin):
         "usage_count",
         "created_at",
         "last_used",
+        "cooldown_until",
         "description",
         "parameters",
     )
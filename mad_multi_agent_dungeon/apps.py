@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MadMultiAgentDungeonConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "mad_multi_agent_dungeon"
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
@@ -0,0 +1,80 @@
+import re
+
+from django.core.checks import Warning, register, Tags
+from django.db import DatabaseError, connections
+
+FULL_SCAN = re.compile(r"\bSCAN\b")
+
+
+def hot_queries():
+    """
+    The queries the daemons run on every poll, as (label, queryset) pairs.
+    Each of them must be answered from an index, otherwise it turns into a
+    full table scan that gets slower as the queue history piles up.
+    """
+    from .fanout import active_listeners
+    from .models import LLMQueue, ObjectInstance, PerceptionQueue
+    from .queues import claimable_llm_requests, pending_commands
+
+    return [
+        ("pending commands", pending_commands()),
+        (
+            "undelivered perceptions",
+            PerceptionQueue.objects.filter(agent_id=1, delivered=False).order_by(
+                "date"
+            ),
+        ),
+        (
+            "completed LLM responses",
+            LLMQueue.objects.filter(agent_id=1, status="completed").order_by("-date"),
+        ),
+        (
+            "open LLM requests",
+            LLMQueue.objects.filter(agent_id=1, status__in=["pending", "thinking"]),
+        ),
+        ("claimable LLM requests", claimable_llm_requests()),
+        ("active agents in a room", active_listeners("room")),
+        ("objects in a room", ObjectInstance.objects.filter(room_id="room")),
+        (
+            "objects by name in a room",
+            ObjectInstance.objects.filter(room_id="room", name_key="mirror"),
+        ),
+    ]
+
+
+def unindexed_hot_queries(using="default"):
+    """
+    Returns `(label, plan)` for every hot query that SQLite would answer with
+    a full table scan. Other backends, and databases that haven't been
+    migrated yet, aren't inspected.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return []
+    unindexed = []
+    for label, queryset in hot_queries():
+        try:
+            plan = queryset.using(using).explain()
+        except DatabaseError:
+            return []
+        # "SCAN <table>" without "USING ... INDEX" is a full table scan.
+        if any(
+            FULL_SCAN.search(line) and "INDEX" not in line for line in plan.splitlines()
+        ):
+            unindexed.append((label, plan))
+    return unindexed
+
+
+@register(Tags.database)
+def check_hot_query_indexes(app_configs, databases=None, **kwargs):
+    errors = []
+    for alias in databases or []:
+        for label, plan in unindexed_hot_queries(alias):
+            errors.append(
+                Warning(
+                    f"The {label} query is not backed by an index.",
+                    hint=f"Query plan:\n{plan}",
+                    id="mad_multi_agent_dungeon.W001",
+                )
+            )
+    return errors
@@ -1,8 +1,7 @@
-import json
 import logging
 from datetime import timedelta
-from pathlib import Path
 
+from django.db import transaction
 from django.utils import timezone
 
 from .memory_commands import (
@@ -13,19 +12,15 @@ from .memory_commands import (
     load_handler,
     unload_handler,
 )
-from .models import Agent, ObjectInstance, PerceptionQueue
-
-# Load data
-OBJECT_DATA = json.loads(
-    Path(
-        "/home/edward/Desktop/mad-django/mad_multi_agent_dungeon/data/objects.json"
-    ).read_text()
-)
-MAP_DATA = json.loads(
-    Path(
-        "/home/edward/Desktop/mad-django/mad_multi_agent_dungeon/data/map.json"
-    ).read_text()
-)
+from .fanout import active_agent_names, deliver, room_perceptions
+from .models import Agent
+from .occupancy import occupancy
+from .room_objects import room_objects
+from .triggers import trigger_engine
+from .results import completed, failed
+from .queues import LeaseExpired, finish_command
+from .scheduler import defer_agent
+from .world import world
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -33,16 +28,14 @@ logger = logging.getLogger(__name__)
 
 def ping_handler(command_entry):
     logger.debug(f"Executing ping for agent {command_entry.agent.name}")
-    command_entry.output = "pong"
-    command_entry.status = "completed"
-    command_entry.save()
+    return completed("pong")
 
 
 def look_handler(command_entry):
     agent = command_entry.agent
     logger.debug(f"Executing look for agent {agent.name} in room {agent.location}")
     room_id = agent.location
-    room_data = MAP_DATA["rooms"].get(room_id)
+    room_data = world.room(room_id)
 
     if room_data:
         room_title = room_data.get("title", f"Room {room_id}")
@@ -58,25 +51,53 @@ def look_handler(command_entry):
     output_lines = [f"{room_title}", f"{room_description}"]
     output_lines.append(f"Exits: {available_exits}")
 
-    active_agents = [
-        a.name
-        for a in Agent.objects.filter(location=room_id).exclude(pk=agent.pk)
-        if a.is_active()
-    ]
+    active_agents = active_agent_names(room_id, exclude=agent)
     if active_agents:
         output_lines.append(f"Other agents here: {', '.join(active_agents)}")
 
-    objects_in_room = ObjectInstance.objects.filter(room_id=room_id)
-    if objects_in_room.exists():
-        object_names = ", ".join(
-            [obj.data.get("name", obj.object_id) for obj in objects_in_room]
-        )
-        output_lines.append(f"Objects here: {object_names}")
+    object_names = room_objects.names(room_id)
+    if object_names:
+        output_lines.append(f"Objects here: {', '.join(object_names)}")
 
-    command_entry.output = "\n".join(output_lines)
-    command_entry.status = "completed"
-    command_entry.save()
     logger.info(f"Agent {agent.name} looked around in {room_id}.")
+    return completed("\n".join(output_lines))
+
+
+OPPOSITE_DIRECTIONS = {
+    "north": "south",
+    "south": "north",
+    "east": "west",
+    "west": "east",
+    "up": "down",
+    "down": "up",
+}
+
+
+def _move(agent, direction, target_room_id):
+    """
+    Moves the agent (in memory) through one exit and returns the perceptions
+    of the agents in the rooms it leaves and enters.
+    """
+    perceptions = room_perceptions(
+        agent.location, f"{agent.name} leaves to the {direction}.", source_agent=agent
+    )
+    agent.location = target_room_id
+    arrives_from = OPPOSITE_DIRECTIONS.get(direction, "somewhere")
+    perceptions += room_perceptions(
+        target_room_id,
+        f"{agent.name} arrives from the {arrives_from}.",
+        source_agent=agent,
+    )
+    return perceptions
+
+
+def _arrival_description(room_id):
+    room_data = world.room(room_id)
+    if not room_data:
+        return f"Moved to unknown room: {room_id}"
+    exits = room_data.get("exits", {})
+    available_exits = ", ".join(exits.keys()) if exits else "none"
+    return f"{room_data['title']}\n{room_data['description']}\nExits: {available_exits}"
 
 
 def go_handler(command_entry):
@@ -86,83 +107,62 @@ def go_handler(command_entry):
     logger.debug(f"Executing go for agent {agent.name} towards {direction}")
 
     if not direction:
-        command_entry.output = "Go where?"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Go where?")
 
     old_room_id = agent.location
-    current_room_data = MAP_DATA["rooms"].get(old_room_id)
+    current_room_data = world.room(old_room_id)
 
     if not current_room_data:
         logger.error(f"Agent {agent.name} in invalid room {old_room_id}")
-        command_entry.output = f"Error: Unknown room ID: {old_room_id}"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed(f"Error: Unknown room ID: {old_room_id}")
 
-    target_room_id = current_room_data.get("exits", {}).get(direction)
+    target_room_id = world.exits(old_room_id).get(direction)
 
     if target_room_id:
-        for other_agent in Agent.objects.filter(location=old_room_id).exclude(
-            pk=agent.pk
-        ):
-            if other_agent.is_active():
-                PerceptionQueue.objects.create(
-                    agent=other_agent,
-                    source_agent=agent,
-                    type="none",
-                    text=f"{agent.name} leaves to the {direction}.",
-                )
-                logger.debug(
-                    f"Notified {other_agent.name} of {agent.name}'s departure."
-                )
-
-        agent.location = target_room_id
-        agent.save()
-
-        opposite_directions = {
-            "north": "south",
-            "south": "north",
-            "east": "west",
-            "west": "east",
-            "up": "down",
-            "down": "up",
-        }
-        arrives_from = opposite_directions.get(direction, "somewhere")
-
-        for other_agent in Agent.objects.filter(location=target_room_id).exclude(
-            pk=agent.pk
-        ):
-            if other_agent.is_active():
-                PerceptionQueue.objects.create(
-                    agent=other_agent,
-                    source_agent=agent,
-                    type="none",
-                    text=f"{agent.name} arrives from the {arrives_from}.",
-                )
-                logger.debug(f"Notified {other_agent.name} of {agent.name}'s arrival.")
-
-        target_room_data = MAP_DATA["rooms"].get(target_room_id)
-        if target_room_data:
-            exits = target_room_data.get("exits", {})
-            available_exits = ", ".join(exits.keys()) if exits else "none"
-            command_entry.output = f"{target_room_data['title']}\n{target_room_data['description']}\nExits: {available_exits}"
-        else:
-            command_entry.output = f"Moved to unknown room: {target_room_id}"
-        command_entry.status = "completed"
+        perceptions = _move(agent, direction, target_room_id)
         logger.info(f"Agent {agent.name} moved from {old_room_id} to {target_room_id}.")
-    else:
-        available_exits = ", ".join(current_room_data.get("exits", {}).keys()) or "none"
-        command_entry.output = (
-            f"You can't go {direction} from here.\nAvailable exits: {available_exits}"
-        )
-        command_entry.status = "completed"
-        logger.warning(
-            f"Agent {agent.name} failed to move {direction} from {old_room_id}."
+        return completed(
+            _arrival_description(target_room_id), "location", perceptions=perceptions
         )
 
-    command_entry.save()
+    available_exits = ", ".join(current_room_data.get("exits", {}).keys()) or "none"
+    logger.warning(f"Agent {agent.name} failed to move {direction} from {old_room_id}.")
+    return completed(
+        f"You can't go {direction} from here.\nAvailable exits: {available_exits}"
+    )
+
+
+def travel_handler(command_entry):
+    agent = command_entry.agent
+    parts = command_entry.command.split()
+    target_room_id = parts[1] if len(parts) > 1 else None
+    logger.debug(f"Executing travel for agent {agent.name} to {target_room_id}")
+
+    if not target_room_id:
+        return failed("Travel where?")
+    if world.room(target_room_id) is None:
+        return failed(f"Error: Unknown room ID: {target_room_id}")
+
+    old_room_id = agent.location
+    directions = world.path(old_room_id, target_room_id)
+    if directions is None:
+        return completed(f"You can't find a way to {target_room_id} from here.")
+    if not directions:
+        return completed("You are already there.")
+
+    # Walk the whole way at once; every room passed through sees the agent
+    # leave and arrive as if it had gone step by step.
+    perceptions = []
+    for direction in directions:
+        perceptions += _move(agent, direction, world.exits(agent.location)[direction])
+    logger.info(
+        f"Agent {agent.name} travelled from {old_room_id} to {target_room_id} in {len(directions)} steps."
+    )
+    return completed(
+        f"You travel {', '.join(directions)}.\n" + _arrival_description(target_room_id),
+        "location",
+        perceptions=perceptions,
+    )
 
 
 def inventory_handler(command_entry):
@@ -170,11 +170,8 @@ def inventory_handler(command_entry):
     logger.debug(f"Executing inventory for agent {agent.name}")
     if agent.inventory:
         items_list = "\n".join([f"- {item}" for item in agent.inventory])
-        command_entry.output = f"Your inventory:\n{items_list}"
-    else:
-        command_entry.output = "Your inventory is empty."
-    command_entry.status = "completed"
-    command_entry.save()
+        return completed(f"Your inventory:\n{items_list}")
+    return completed("Your inventory is empty.")
 
 
 def examine_handler(command_entry):
@@ -184,38 +181,22 @@ def examine_handler(command_entry):
     logger.debug(f"Executing examine for agent {agent.name} on item '{item_name}'")
 
     if not item_name:
-        command_entry.output = "Examine what?"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
-
-    current_room_id = agent.location
-    current_room_data = MAP_DATA["rooms"].get(current_room_id)
-
-    if current_room_data and "items" in current_room_data:
-        for item_id, item_data in current_room_data["items"].items():
-            if (
-                item_id.lower() == item_name
-                or item_data.get("title", "").lower() == item_name
-            ):
-                command_entry.output = item_data.get(
-                    "description", "You see nothing special."
-                )
-                command_entry.status = "completed"
-                command_entry.save()
-                logger.info(f"Agent {agent.name} examined '{item_name}'.")
-                return
+        return failed("Examine what?")
+
+    item = world.find_item(agent.location, item_name)
+    if item:
+        item_id, item_data = item
+        logger.info(f"Agent {agent.name} examined '{item_name}'.")
+        return completed(item_data.get("description", "You see nothing special."))
 
-    command_entry.output = f"You don't see any '{item_name}' here."
-    command_entry.status = "completed"
-    command_entry.save()
+    return completed(f"You don't see any '{item_name}' here.")
 
 
 def where_handler(command_entry):
     agent = command_entry.agent
     logger.debug(f"Executing where for agent {agent.name}")
     room_id = agent.location
-    room_data = MAP_DATA["rooms"].get(room_id, {})
+    room_data = world.room(room_id) or {}
     room_title = room_data.get("title", f"Room {room_id}")
 
     output_lines = [f"You are in: {room_title} ({room_id})"]
@@ -228,9 +209,7 @@ def where_handler(command_entry):
         for other_agent in active_agents:
             output_lines.append(f"- {other_agent.name} ({other_agent.location})")
 
-    command_entry.output = "\n".join(output_lines)
-    command_entry.status = "completed"
-    command_entry.save()
+    return completed("\n".join(output_lines))
 
 
 def shout_handler(command_entry):
@@ -242,62 +221,60 @@ def shout_handler(command_entry):
     )
     logger.debug(f"Executing shout for agent {agent.name}")
     if not message:
-        command_entry.output = "Shout what?"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
-    else:
-        command_entry.output = f'You shout: "{message}"'
-        logger.info(f"Agent {agent.name} shouted: '{message}'")
-    command_entry.status = "completed"
-    command_entry.save()
+        return failed("Shout what?")
+
+    logger.info(f"Agent {agent.name} shouted: '{message}'")
+    return completed(
+        f'You shout: "{message}"',
+        perceptions=room_perceptions(
+            agent.location,
+            f'{agent.name} shouted "{message}"',
+            source_agent=agent,
+            command=command_entry,  # Link to the original command
+        ),
+    )
 
 
-def use_handler(command_entry):
-    from .models import ObjectInstance
+def trigger_handler(verb, missing_message):
+    """A handler that fires the `verb` trigger of an object in the room."""
 
-    agent = command_entry.agent
-    parts = command_entry.command.split(maxsplit=1)
-    object_name = parts[1].lower() if len(parts) > 1 else None
-    logger.debug(f"Executing use for agent {agent.name} on object '{object_name}'")
+    def handler(command_entry):
+        agent = command_entry.agent
+        parts = command_entry.command.split(maxsplit=1)
+        object_name = parts[1].lower() if len(parts) > 1 else None
+        logger.debug(
+            f"Executing {verb} for agent {agent.name} on object '{object_name}'"
+        )
 
-    if not object_name:
-        command_entry.output = "Use what?"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        if not object_name:
+            return failed(f"{verb.capitalize()} what?")
+
+        obj_instance = room_objects.find(agent.location, object_name)
+        if obj_instance:
+            result = trigger_engine.fire(verb, agent, obj_instance)
+            if result is not None:
+                logger.info(
+                    f"Agent {agent.name} triggered '{verb}' on '{object_name}'."
+                )
+                return result
+            return completed(missing_message.format(name=object_name))
+        return completed(f"You don't see a {object_name} here.")
+
+    return handler
 
-    try:
-        obj_instance = ObjectInstance.objects.get(
-            room_id=agent.location, data__name__iexact=object_name
-        )
-        obj = obj_instance.data
-        if "use" in obj.get("triggers", {}):
-            trigger = obj["triggers"]["use"]
-            if trigger.get("type") == "response":
-                command_entry.output = trigger.get("value", "You use the object.")
-                command_entry.status = "completed"
-                command_entry.save()
-                logger.info(f"Agent {agent.name} used '{object_name}'.")
-                return
-    except ObjectInstance.DoesNotExist:
-        pass
-
-    command_entry.output = f"You don't see a {object_name} here."
-    command_entry.status = "completed"
-    command_entry.save()
+
+use_handler = trigger_handler("use", "You don't see a {name} here.")
+take_handler = trigger_handler("take", "You can't take the {name}.")
 
 
 def help_handler(command_entry):
     logger.debug(f"Executing help for agent {command_entry.agent.name}")
     available_commands = [
         "ping", "look", "go", "inventory", "examine", "where", "shout", "use",
-        "help", "meditate", "wait", "score", "say", "edit",
+        "take", "help", "meditate", "wait", "travel", "score", "say", "edit",
         "remember", "remember-append", "forget", "list", "load", "unload"
     ]
-    command_entry.output = f"Available commands: {', '.join(sorted(available_commands))}"
-    command_entry.status = "completed"
-    command_entry.save()
+    return completed(f"Available commands: {', '.join(sorted(available_commands))}")
 
 
 def meditate_handler(command_entry):
@@ -309,10 +286,7 @@ def meditate_handler(command_entry):
     logger.debug(f"Executing meditate for agent {agent.name} for '{duration_str}'")
 
     if not duration_str:
-        command_entry.output = "Meditate for how long? (e.g., meditate 10m)"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Meditate for how long? (e.g., meditate 10m)")
 
     try:
         value = int(duration_str[:-1])
@@ -326,21 +300,17 @@ def meditate_handler(command_entry):
         else:
             raise ValueError("Invalid time unit")
     except (ValueError, TypeError):
-        command_entry.output = (
+        return completed(
             "Invalid duration format. Use 'm' for minutes or 'h' for hours."
         )
-        command_entry.status = "completed"
-        command_entry.save()
-        return
 
     meditation_end = datetime.now(timezone.utc) + delta
-    agent.flags["meditating"] = meditation_end.isoformat()
-    agent.save()
+    defer_agent(agent, "meditating", meditation_end)
 
-    command_entry.output = f"You begin to meditate for {value} {unit_str}."
-    command_entry.status = "completed"
-    command_entry.save()
     logger.info(f"Agent {agent.name} started meditating for {value} {unit_str}.")
+    return completed(
+        f"You begin to meditate for {value} {unit_str}.", "flags", "not_before"
+    )
 
 
 def wait_handler(command_entry):
@@ -352,10 +322,7 @@ def wait_handler(command_entry):
     logger.debug(f"Executing wait for agent {agent.name} for '{duration_str}'")
 
     if not duration_str:
-        command_entry.output = "Wait for how long? (e.g., wait 15s, wait 5m)"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Wait for how long? (e.g., wait 15s, wait 5m)")
 
     try:
         value = int(duration_str[:-1])
@@ -369,27 +336,23 @@ def wait_handler(command_entry):
         else:
             raise ValueError("Invalid time unit")
     except (ValueError, TypeError):
-        command_entry.output = (
+        return completed(
             "Invalid duration format. Use 's' for seconds or 'm' for minutes."
         )
-        command_entry.status = "completed"
-        command_entry.save()
-        return
 
     wait_until = datetime.now(timezone.utc) + delta
-    agent.flags["waiting"] = wait_until.isoformat()
-    agent.save()
+    defer_agent(agent, "waiting", wait_until)
 
-    command_entry.output = f"You begin to wait for {value} {unit_str}."
-    command_entry.status = "completed"
-    command_entry.save()
     logger.info(f"Agent {agent.name} started waiting for {value} {unit_str}.")
+    return completed(
+        f"You begin to wait for {value} {unit_str}.", "flags", "not_before"
+    )
 
 
 def go_wrapper(direction):
     def handler(command_entry):
         command_entry.command = f"go {direction}"
-        go_handler(command_entry)
+        return go_handler(command_entry)
 
     return handler
 
@@ -403,14 +366,10 @@ def score_handler(command_entry):
         f"Tokens: {agent.tokens}",
         f"Location: {agent.location}",
     ]
-    command_entry.output = "\n".join(output_lines)
-    command_entry.status = "completed"
-    command_entry.save()
+    return completed("\n".join(output_lines))
 
 
 def say_handler(command_entry):
-    from .models import Agent, PerceptionQueue
-
     agent = command_entry.agent
     message = (
         command_entry.command.split(maxsplit=1)[1]
@@ -420,27 +379,15 @@ def say_handler(command_entry):
     logger.debug(f"Executing say for agent {agent.name}")
 
     if not message:
-        command_entry.output = "Say what?"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
-
-    command_entry.output = f'You say: "{message}"'
-    command_entry.status = "completed"
-    command_entry.save()
-    logger.info(f"Agent {agent.name} said: '{message}'")
+        return failed("Say what?")
 
-    for other_agent in Agent.objects.filter(location=agent.location).exclude(
-        pk=agent.pk
-    ):
-        if other_agent.is_active():
-            PerceptionQueue.objects.create(
-                agent=other_agent,
-                source_agent=agent,
-                type="none",
-                text=f'{agent.name} says: "{message}"',
-            )
-            logger.debug(f"Notified {other_agent.name} of {agent.name}'s message.")
+    logger.info(f"Agent {agent.name} said: '{message}'")
+    return completed(
+        f'You say: "{message}"',
+        perceptions=room_perceptions(
+            agent.location, f'{agent.name} says: "{message}"', source_agent=agent
+        ),
+    )
 
 
 def edit_profile_handler(command_entry):
@@ -449,30 +396,22 @@ def edit_profile_handler(command_entry):
     logger.debug(f"Executing edit profile for agent {agent.name}")
 
     if len(parts) < 4:
-        command_entry.output = "Usage: edit profile <field> <new_value> (e.g., edit profile look a tall, dark figure)"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed(
+            "Usage: edit profile <field> <new_value> (e.g., edit profile look a tall, dark figure)"
+        )
 
     field = parts[2].lower()
     new_value = parts[3]
 
     if field in ["look", "description"]:
         setattr(agent, field, new_value)
-        agent.save()
-        command_entry.output = f"Your {field} has been updated to: {new_value}"
-        command_entry.status = "completed"
         logger.info(f"Agent {agent.name} updated their {field}.")
-    else:
-        command_entry.output = (
-            "Invalid field. You can only edit 'look' or 'description'."
-        )
-        command_entry.status = "completed"
-        logger.warning(
-            f"Agent {agent.name} failed to update invalid profile field '{field}'."
-        )
+        return completed(f"Your {field} has been updated to: {new_value}", field)
 
-    command_entry.save()
+    logger.warning(
+        f"Agent {agent.name} failed to update invalid profile field '{field}'."
+    )
+    return completed("Invalid field. You can only edit 'look' or 'description'.")
 
 
 COMMAND_HANDLERS = {
@@ -484,9 +423,11 @@ COMMAND_HANDLERS = {
     "where": where_handler,
     "shout": shout_handler,
     "use": use_handler,
+    "take": take_handler,
     "help": help_handler,
     "meditate": meditate_handler,
     "wait": wait_handler,
+    "travel": travel_handler,
     "north": go_wrapper("north"),
     "n": go_wrapper("north"),
     "south": go_wrapper("south"),
@@ -513,12 +454,16 @@ COMMAND_HANDLERS = {
 }
 
 
-def handle_command(command_entry):
-    from django.utils import timezone
-
+def execute_command(command_entry):
+    """
+    Runs the handler for `command_entry` and returns its `CommandResult`
+    without writing anything except the handler's own side tables (e.g.
+    memories, or an object taken). Use `persist_result()` to commit the
+    outcome, in the same transaction so that those writes only stick if it
+    does.
+    """
     agent = command_entry.agent
     agent.last_command_sent = timezone.now()
-    agent.save()
 
     command_parts = command_entry.command.split()
     base_command = command_parts[0] if command_parts else ""
@@ -528,17 +473,46 @@ def handle_command(command_entry):
 
     if handler:
         try:
-            handler(command_entry)
+            # A failing handler leaves none of its writes behind
+            with transaction.atomic():
+                result = handler(command_entry)
             logger.info(f"Successfully handled '{base_command}' for agent {agent.name}")
         except Exception as e:
             logger.exception(
                 f"Error executing handler for command '{base_command}' for agent {agent.name}"
             )
-            command_entry.output = f"An error occurred: {e}"
-            command_entry.status = "failed"
-            command_entry.save()
+            result = failed(f"An error occurred: {e}")
     else:
         logger.warning(f"No handler found for command '{base_command}'")
-        command_entry.output = f"Unknown command: {command_entry.command}"
-        command_entry.status = "failed"
-        command_entry.save()
+        result = failed(f"Unknown command: {command_entry.command}")
+
+    result.agent_fields.add("last_command_sent")
+    return result
+
+
+def persist_result(command_entry, result):
+    """
+    Commits a command's output and status, the agent fields its handler
+    changed and the perceptions it produced in one transaction, writing each
+    row once with `update_fields`. Raises LeaseExpired, writing nothing, if
+    the worker's lease on the command ran out, as another worker may be
+    running it again.
+    """
+    command_entry.output = result.output
+    command_entry.status = result.status
+    with transaction.atomic():
+        if not finish_command(
+            command_entry, output=result.output, status=result.status
+        ):
+            raise LeaseExpired(f"Lease on command {command_entry.pk} expired.")
+        if result.agent_fields:
+            command_entry.agent.save(update_fields=sorted(result.agent_fields))
+        deliver(result.perceptions)
+    occupancy.record(command_entry.agent)
+
+
+def handle_command(command_entry):
+    with transaction.atomic():
+        result = execute_command(command_entry)
+        persist_result(command_entry, result)
+    return result
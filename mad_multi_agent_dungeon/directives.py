@@ -0,0 +1,69 @@
+import re
+from dataclasses import dataclass
+
+# [command|say|Hello], [load|key] and [remember|key|value] tags in LLM output.
+# One pattern finds every kind in a single pass; a tag never spans lines.
+DIRECTIVE_PATTERN = re.compile(r"\[(command|load|remember)\|(.+?)\]")
+
+
+@dataclass(frozen=True)
+class Directive:
+    kind: str  # "command", "load" or "remember"
+    content: str  # The tag's text after the kind
+    command: str  # The command it queues
+
+
+def directive_to_command(kind, content):
+    """
+    Turns the contents of a directive tag into the text of the command to
+    queue, or None if the tag is malformed.
+    """
+    if kind == "command":
+        parts = content.split("|")
+        return f"{parts[0]} {' '.join(parts[1:])}".strip()
+    if kind == "load":
+        return f"load {content}"
+    if kind == "remember":
+        parts = content.split("|")
+        if len(parts) >= 2:
+            return f"remember {parts[0]} {'|'.join(parts[1:])}"
+    return None
+
+
+def parse_directives(text):
+    """
+    Returns the well-formed directives in `text` in the order they were
+    written, whatever their kind.
+    """
+    directives = []
+    for match in DIRECTIVE_PATTERN.finditer(text):
+        kind, content = match.groups()
+        command = directive_to_command(kind, content)
+        if command:
+            directives.append(Directive(kind, content, command))
+    return directives
+
+
+class DirectiveScanner:
+    """
+    Finds directive tags in text that arrives in chunks, such as a streamed
+    LLM response. `feed()` returns the commands of the tags completed by each
+    chunk, so they can be queued as soon as their closing bracket arrives.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0  # Nothing before this can start a tag any more
+
+    def feed(self, chunk):
+        self.text += chunk
+        commands = []
+        for match in DIRECTIVE_PATTERN.finditer(self.text, self._pos):
+            command = directive_to_command(match.group(1), match.group(2))
+            if command:
+                commands.append(command)
+            self._pos = match.end()
+        # Tags don't span lines, so an unclosed tag before the last newline
+        # will never complete.
+        self._pos = max(self._pos, self.text.rfind("\n") + 1)
+        return commands
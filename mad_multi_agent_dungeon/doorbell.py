@@ -0,0 +1,107 @@
+import logging
+import os
+import select
+import socket
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Channels the daemons listen on.
+COMMANDS = "commands"  # run_command_worker: new CommandQueue rows
+AGENTS = "agents"  # run_agent_app: new perceptions and LLM queue changes
+LLM = "llm"  # run_llm_worker: new LLMQueue requests
+
+HAS_UNIX_SOCKETS = hasattr(socket, "AF_UNIX")
+
+
+def doorbell_dir():
+    return Path(
+        getattr(
+            settings,
+            "MAD_DOORBELL_DIR",
+            Path(tempfile.gettempdir()) / "mad_doorbell",
+        )
+    )
+
+
+class Doorbell:
+    """
+    A wake-up channel for a daemon loop, backed by a Unix datagram socket.
+
+    Each listening process binds its own socket (`<channel>-<pid>.sock`), so
+    several workers on one channel are all woken. `wait()` returns as soon as
+    somebody rings, or after `timeout` seconds as a polling fallback. On
+    platforms without Unix sockets it degrades to a plain sleep.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.path = doorbell_dir() / f"{channel}-{os.getpid()}.sock"
+        self._sock = None
+        if not HAS_UNIX_SOCKETS:
+            logger.warning("Unix sockets unavailable; falling back to polling.")
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.unlink(missing_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(str(self.path))
+        self._sock.setblocking(False)
+        logger.debug(f"Listening for '{channel}' wake-ups on {self.path}")
+
+    def wait(self, timeout):
+        """Blocks until rung or `timeout` seconds pass. Returns True if rung."""
+        if self._sock is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return False
+        # Coalesce every ring that arrived while we were busy into one wake-up.
+        while True:
+            try:
+                self._sock.recv(16)
+            except BlockingIOError:
+                return True
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self.path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def ring(channel):
+    """Wakes every process waiting on `channel`. Never blocks or raises."""
+    if not HAS_UNIX_SOCKETS:
+        return
+    listeners = list(doorbell_dir().glob(f"{channel}-*.sock"))
+    if not listeners:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+        sender.setblocking(False)
+        for path in listeners:
+            try:
+                sender.sendto(b"\x01", str(path))
+            except BlockingIOError:
+                pass  # The listener's buffer is full, so it is already due to wake
+            except (ConnectionRefusedError, FileNotFoundError):
+                logger.debug(f"Removing stale doorbell socket {path}")
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"Could not ring doorbell {path}: {e}")
+
+
+def ring_on_commit(channel):
+    """Rings `channel` once the current transaction commits."""
+    transaction.on_commit(lambda: ring(channel))
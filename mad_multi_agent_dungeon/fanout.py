@@ -0,0 +1,88 @@
+import logging
+from datetime import timedelta
+
+from django.utils import timezone
+
+from . import doorbell
+from .models import Agent, PerceptionQueue
+from .occupancy import occupancy
+
+logger = logging.getLogger(__name__)
+
+
+def active_listeners(room_id, exclude=None, now=None):
+    """
+    The active agents in `room_id`, using the same activity window as
+    `Agent.is_active()`.
+    """
+    now = now or timezone.now()
+    listeners = Agent.objects.filter(
+        location=room_id,
+        last_command_sent__gt=now - timedelta(seconds=Agent.ACTIVE_WINDOW_SECONDS),
+    )
+    if exclude is not None:
+        listeners = listeners.exclude(pk=exclude.pk)
+    return listeners
+
+
+def _present(room_id, exclude, now):
+    return occupancy.present(room_id, exclude.pk if exclude is not None else None, now)
+
+
+def active_listener_ids(room_id, exclude=None, now=None):
+    """
+    Returns the ids of the active agents in `room_id`, from the occupancy
+    index when it is enabled or else with a single query.
+    """
+    if occupancy.enabled:
+        return [agent_id for agent_id, _ in _present(room_id, exclude, now)]
+    return list(active_listeners(room_id, exclude, now).values_list("pk", flat=True))
+
+
+def active_agent_names(room_id, exclude=None, now=None):
+    """Like `active_listener_ids`, but returns the agents' names."""
+    if occupancy.enabled:
+        return [name for _, name in _present(room_id, exclude, now)]
+    return list(
+        active_listeners(room_id, exclude, now)
+        .order_by("id")
+        .values_list("name", flat=True)
+    )
+
+
+def room_perceptions(room_id, text, source_agent=None, command=None, type="none"):
+    """
+    Builds (without saving) a perception of `text` for every active agent in
+    `room_id` except `source_agent`. Costs at most a single SELECT.
+    """
+    return [
+        PerceptionQueue(
+            agent_id=listener_id,
+            source_agent=source_agent,
+            type=type,
+            command=command,
+            text=text,
+        )
+        for listener_id in active_listener_ids(room_id, exclude=source_agent)
+    ]
+
+
+def deliver(perceptions):
+    """Writes `perceptions` with one bulk INSERT and wakes the agent app."""
+    if not perceptions:
+        return
+    PerceptionQueue.objects.bulk_create(perceptions)
+    # bulk_create skips post_save, so ring the doorbell explicitly.
+    doorbell.ring_on_commit(doorbell.AGENTS)
+    logger.debug(f"Delivered {len(perceptions)} perceptions.")
+
+
+def broadcast_to_room(room_id, text, source_agent=None, command=None, type="none"):
+    """
+    Delivers `text` as a perception to every active agent in `room_id` except
+    `source_agent`. Costs one SELECT and one bulk INSERT however crowded the
+    room is. Returns the number of listeners reached.
+    """
+    perceptions = room_perceptions(room_id, text, source_agent, command, type)
+    deliver(perceptions)
+    return len(perceptions)
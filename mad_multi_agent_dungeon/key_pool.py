@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import LLMAPIKey
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60
+
+
+def is_rate_limited(error):
+    """True if `error` is the LLM API saying "too many requests" (HTTP 429)."""
+    return getattr(error, "code", None) == 429
+
+
+class KeyPool:
+    """
+    Spreads LLM requests over every active `LLMAPIKey`.
+
+    Each request goes to the least-loaded key (fewest requests in flight, then
+    fewest requests in the last minute) that still has room under the "rpm"
+    and "tpm" limits declared in its `parameters`. Usage is tracked in a
+    sliding one-minute window per process, so with several LLM workers each
+    one should get its share of a key's limits. Keys that were throttled
+    (HTTP 429) are skipped until their `cooldown_until`, which is stored on
+    the key and therefore shared by all workers.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._keys = []
+        self._requests = defaultdict(deque)  # key id -> request timestamps
+        self._tokens = defaultdict(deque)  # key id -> (timestamp, tokens)
+        self._in_flight = defaultdict(int)  # key id -> running requests
+        self._lock = threading.Lock()
+
+    @property
+    def keys(self):
+        return list(self._keys)
+
+    def refresh(self):
+        """Reloads the active keys. Returns how many there are."""
+        self._keys = list(LLMAPIKey.objects.filter(is_active=True).order_by("id"))
+        return len(self._keys)
+
+    def _prune(self, key_id, now):
+        requests, tokens = self._requests[key_id], self._tokens[key_id]
+        while requests and requests[0] <= now - WINDOW_SECONDS:
+            requests.popleft()
+        while tokens and tokens[0][0] <= now - WINDOW_SECONDS:
+            tokens.popleft()
+
+    def _has_room(self, key, tokens, now):
+        self._prune(key.id, now)
+        if key.cooldown_until and key.cooldown_until > timezone.now():
+            return False
+        rpm = key.rate_limit("rpm")
+        if rpm is not None and len(self._requests[key.id]) >= rpm:
+            return False
+        tpm = key.rate_limit("tpm")
+        used_tokens = sum(count for _, count in self._tokens[key.id])
+        if tpm is not None and used_tokens + tokens > tpm:
+            return False
+        return True
+
+    def acquire(self, tokens=1):
+        """
+        Picks a key for a request of about `tokens` tokens and counts the
+        request against it. Returns None when every key is at its limit or
+        cooling down. Every acquired key must be given back with `release`.
+        """
+        with self._lock:
+            now = self.clock()
+            candidates = [key for key in self._keys if self._has_room(key, tokens, now)]
+            if not candidates:
+                return None
+            key = min(
+                candidates,
+                key=lambda k: (self._in_flight[k.id], len(self._requests[k.id])),
+            )
+            self._requests[key.id].append(now)
+            self._tokens[key.id].append((now, tokens))
+            self._in_flight[key.id] += 1
+            return key
+
+    def release(self, key, tokens=0):
+        """
+        Gives `key` back once its request is over, counting the `tokens` of
+        the response against its "tpm" limit.
+        """
+        with self._lock:
+            self._in_flight[key.id] = max(self._in_flight[key.id] - 1, 0)
+            if tokens:
+                self._tokens[key.id].append((self.clock(), tokens))
+
+    def cool_down(self, key, seconds=None):
+        """Takes `key` out of rotation for `seconds` after a 429."""
+        seconds = seconds or settings.MAD_LLM_KEY_COOLDOWN_SECONDS
+        key.cooldown_until = timezone.now() + timedelta(seconds=seconds)
+        LLMAPIKey.objects.filter(pk=key.pk).update(cooldown_until=key.cooldown_until)
+        logger.warning(f"{key} was rate limited; cooling down for {seconds}s.")
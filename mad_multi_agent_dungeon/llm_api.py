@@ -1,8 +1,81 @@
+import json
 import logging
+import threading
+
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MODEL = "gemini-1.5-flash"
+
+# API clients per key and models per (key, model, generation config). They are
+# built once and reused, so every call after the first skips the transport and
+# connection setup. The underlying gRPC clients are safe to share between
+# threads; nothing here touches genai's global configuration.
+_clients = {}
+_models = {}
+_cache_lock = threading.Lock()
+
+
+def _config_key(parameters):
+    return json.dumps(parameters or {}, sort_keys=True, default=str)
+
+
+def get_client(api_key: str):
+    """Returns the cached API client for `api_key`, creating it on first use."""
+    with _cache_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            _clients[api_key] = client
+        return client
+
+
+def get_model(api_key: str, model_name: str = DEFAULT_MODEL, parameters: dict = None):
+    """
+    Returns the cached `GenerativeModel` for this key, model and generation
+    config, bound to the key's own client.
+    """
+    cache_key = (api_key, model_name, _config_key(parameters))
+    model = _models.get(cache_key)
+    if model is not None:
+        return model
+    client = get_client(api_key)
+    with _cache_lock:
+        model = _models.get(cache_key)
+        if model is None:
+            generation_config = None
+            if parameters:
+                generation_config = genai.types.GenerationConfig(**parameters)
+            model = genai.GenerativeModel(
+                model_name, generation_config=generation_config
+            )
+            model._client = client
+            _models[cache_key] = model
+        return model
+
+
+def clear_client_cache():
+    with _cache_lock:
+        _clients.clear()
+        _models.clear()
+
+
+def warm_up(api_key: str, model_name: str = DEFAULT_MODEL, parameters: dict = None):
+    """
+    Builds the client for `api_key` and opens its connection with a cheap
+    token-count request, so that the first real request doesn't pay for it.
+    Returns False if that failed.
+    """
+    try:
+        get_model(api_key, model_name, parameters).count_tokens("ping")
+        logger.info(f"Warmed up Gemini client for API Key: {api_key[:5]}...")
+        return True
+    except Exception as e:
+        logger.warning(f"Could not warm up Gemini client: {e}")
+        return False
+
 
 def call_gemini_api(prompt: str, api_key: str, parameters: dict = None) -> str:
     """
@@ -12,17 +85,27 @@ def call_gemini_api(prompt: str, api_key: str, parameters: dict = None) -> str:
     logger.info(f"Using API Key: {api_key[:5]}...")
 
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash")
-
-        generation_config = None
-        if parameters:
-            generation_config = genai.types.GenerationConfig(**parameters)
-
-        response = model.generate_content(prompt, generation_config=generation_config)
+        model = get_model(api_key, DEFAULT_MODEL, parameters)
+        response = model.generate_content(prompt)
 
         logger.info("Gemini API call completed.")
         return response.text
     except Exception as e:
         logger.error(f"Error calling Gemini API: {e}")
         raise  # Re-raise the exception to be handled by the caller
+
+
+def stream_gemini_api(prompt: str, api_key: str, parameters: dict = None):
+    """
+    Like `call_gemini_api`, but yields the response text chunk by chunk as
+    the API produces it.
+    """
+    logger.info(
+        f"Streaming Gemini API response for prompt (first 100 chars): {prompt[:100]}..."
+    )
+    model = get_model(api_key, DEFAULT_MODEL, parameters)
+    for chunk in model.generate_content(prompt, stream=True):
+        text = chunk.text
+        if text:
+            yield text
+    logger.info("Gemini API stream completed.")
@@ -0,0 +1,252 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Empty, SimpleQueue
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import doorbell
+from .key_pool import KeyPool, is_rate_limited
+from .directives import DirectiveScanner
+from .llm_api import call_gemini_api, stream_gemini_api, warm_up
+from .models import CommandQueue, LLMAPIKey, LLMQueue
+from .prompt_store import MissingPromptSegment
+from .queues import append_llm_response, claim_llm_requests, release_llm_request
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class LLMDispatcher:
+    """
+    Runs claimed LLM requests on a bounded thread pool, spreading them over the
+    API keys with a `KeyPool`. The worker threads only talk to the LLM API;
+    every database write happens on the thread that calls `dispatch()`.
+
+    `call` is the function that performs the API request (`call_gemini_api`
+    by default), and `wake_channel` is the doorbell rung whenever a call
+    finishes so that the owning loop collects the result right away.
+
+    With `stream=True` responses are read chunk by chunk through
+    `stream_call` instead. Every chunk is appended to `LLMQueue.response` and
+    each directive tag is queued as a command as soon as it is complete,
+    rather than when the agent app reads the finished response.
+    """
+
+    def __init__(
+        self,
+        concurrency=None,
+        lease_seconds=None,
+        call=None,
+        wake_channel=doorbell.LLM,
+        stream=None,
+        stream_call=None,
+    ):
+        self.concurrency = concurrency or settings.MAD_LLM_CONCURRENCY
+        self.lease_seconds = lease_seconds or settings.MAD_LLM_LEASE_SECONDS
+        self.call = call or call_gemini_api
+        self.wake_channel = wake_channel
+        self.stream = settings.MAD_LLM_STREAM if stream is None else stream
+        self.stream_call = stream_call or stream_gemini_api
+        self.key_pool = KeyPool()
+        self._executor = None
+        self._in_flight = {}  # future -> (LLMQueue entry, LLMAPIKey)
+        self._chunks = SimpleQueue()  # (LLMQueue id, text) from streaming threads
+        self._scanners = {}  # LLMQueue id -> DirectiveScanner
+
+    @property
+    def free_slots(self):
+        return self.concurrency - len(self._in_flight)
+
+    def warm_up(self):
+        """Opens a connection for every active key ahead of the first request."""
+        self.key_pool.refresh()
+        return sum(
+            warm_up(key.key, parameters=key.generation_parameters())
+            for key in self.key_pool.keys
+        )
+
+    def dispatch(self, block=False):
+        """
+        Records the requests that have finished and claims new ones for the
+        free slots. With `block=True` it waits for all in-flight requests.
+        Returns how many requests were sent to the API.
+        """
+        self.collect()
+        sent = 0
+        if self.free_slots > 0:
+            has_keys = self.key_pool.refresh()
+            for llm_request in claim_llm_requests(self.free_slots, self.lease_seconds):
+                if self._submit(llm_request, has_keys):
+                    sent += 1
+        if block and self._in_flight:
+            wait(self._in_flight)
+            self.collect()
+        return sent
+
+    def _submit(self, llm_request, has_keys=True):
+        if llm_request.directives_queued:
+            # Taken over from a worker that died while streaming it. Another
+            # response would queue its commands on top of the ones queued.
+            logger.warning(
+                f"LLM request {llm_request.id} already queued {llm_request.directives_queued} commands before its worker stopped. Marking it as failed."
+            )
+            self._finish(llm_request, "failed", llm_request.response)
+            return False
+
+        if not has_keys:
+            logger.error("No active LLM API key found. Marking LLM request as failed.")
+            self._finish(llm_request, "failed", "Error: No active API key found.")
+            return False
+
+        try:
+            prompt = llm_request.prompt
+        except MissingPromptSegment as e:
+            logger.error(f"Cannot send LLM request {llm_request.id}: {e}")
+            self._finish(llm_request, "failed", f"Error: {e}")
+            return False
+
+        tokens = estimate_tokens(prompt)
+        api_key_obj = self.key_pool.acquire(tokens)
+        if api_key_obj is None:
+            # Every key is at its rate limit or cooling down; try again later
+            self._requeue(llm_request)
+            return False
+
+        logger.info(
+            f"Processing pending LLM request {llm_request.id} for agent {llm_request.agent.name}"
+        )
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="llm"
+            )
+        if self.stream:
+            self._scanners[llm_request.pk] = DirectiveScanner()
+            future = self._executor.submit(
+                self._read_stream,
+                llm_request.pk,
+                prompt,
+                api_key_obj.key,
+                api_key_obj.generation_parameters(),
+            )
+        else:
+            future = self._executor.submit(
+                self.call,
+                prompt,
+                api_key_obj.key,
+                api_key_obj.generation_parameters(),
+            )
+        future.add_done_callback(lambda _: doorbell.ring(self.wake_channel))
+        self._in_flight[future] = (llm_request, api_key_obj)
+        return True
+
+    def _read_stream(self, request_id, prompt, api_key, parameters):
+        # Runs on a pool thread: hands chunks over instead of writing them
+        chunks = []
+        for chunk in self.stream_call(prompt, api_key, parameters):
+            chunks.append(chunk)
+            self._chunks.put((request_id, chunk))
+            doorbell.ring(self.wake_channel)
+        return "".join(chunks)
+
+    def _record_streamed_chunks(self):
+        """Appends streamed chunks and queues the directives they complete."""
+        received = {}
+        while True:
+            try:
+                request_id, chunk = self._chunks.get_nowait()
+            except Empty:
+                break
+            received[request_id] = received.get(request_id, "") + chunk
+        if not received:
+            return
+        requests = {
+            llm_request.pk: llm_request for llm_request, _ in self._in_flight.values()
+        }
+        for request_id, text in received.items():
+            llm_request = requests.get(request_id)
+            scanner = self._scanners.get(request_id)
+            if llm_request is None or scanner is None:
+                continue
+            commands = scanner.feed(text)
+            with transaction.atomic():
+                if not append_llm_response(llm_request, text, len(commands)):
+                    continue
+                if commands:
+                    CommandQueue.objects.bulk_create(
+                        CommandQueue(agent_id=llm_request.agent_id, command=command)
+                        for command in commands
+                    )
+                    # bulk_create skips post_save, so ring the doorbell here
+                    doorbell.ring_on_commit(doorbell.COMMANDS)
+            llm_request.directives_queued += len(commands)
+            for command in commands:
+                logger.info(
+                    f"Queued command '{command}' from streamed LLM response for agent '{llm_request.agent.name}'."
+                )
+
+    def collect(self):
+        """Writes back the results of the calls that have finished."""
+        # Take the finished calls before draining their chunks: a stream that
+        # ends in between must not be popped with its last chunk still queued.
+        done = [f for f in self._in_flight if f.done()]
+        self._record_streamed_chunks()
+        for future in done:
+            llm_request, api_key_obj = self._in_flight.pop(future)
+            self._scanners.pop(llm_request.pk, None)
+            try:
+                response = future.result()
+            except Exception as e:
+                self.key_pool.release(api_key_obj)
+                # A retry would queue the streamed commands a second time
+                if is_rate_limited(e) and not llm_request.directives_queued:
+                    self.key_pool.cool_down(api_key_obj)
+                    self._requeue(llm_request)
+                    continue
+                logger.error(f"Error calling LLM API for request {llm_request.id}: {e}")
+                self._finish(llm_request, "failed", f"Error: {e}")
+                continue
+            self.key_pool.release(api_key_obj, estimate_tokens(response))
+            LLMAPIKey.objects.filter(pk=api_key_obj.pk).update(
+                last_used=timezone.now(), usage_count=F("usage_count") + 1
+            )
+            if self._finish(llm_request, "completed", response):
+                logger.info(
+                    f"LLM request {llm_request.id} completed for agent {llm_request.agent.name}."
+                )
+
+    def _requeue(self, llm_request):
+        """Hands a claimed request back to the queue for a later attempt."""
+        if release_llm_request(llm_request, "pending", llm_request.response):
+            logger.info(f"LLM request {llm_request.id} returned to the queue.")
+
+    def _finish(self, llm_request, status, response):
+        if not release_llm_request(llm_request, status, response):
+            logger.warning(
+                f"Lease on LLM request {llm_request.id} expired; its result was dropped."
+            )
+            return False
+        llm_request.status = status
+        llm_request.response = response
+        # release_llm_request writes with update(), which sends no post_save
+        doorbell.ring_on_commit(doorbell.AGENTS)
+        return True
+
+    def shutdown(self):
+        """Stops the pool and hands unfinished requests back to the queue."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._scanners = {}
+        unfinished = []
+        for llm_request, api_key_obj in self._in_flight.values():
+            self.key_pool.release(api_key_obj)
+            unfinished.append(llm_request.pk)
+        if unfinished:
+            LLMQueue.objects.filter(pk__in=unfinished, status="thinking").update(
+                status="pending", lease_expires=None
+            )
+            logger.info(f"Released {len(unfinished)} unfinished LLM requests.")
+        self._in_flight = {}
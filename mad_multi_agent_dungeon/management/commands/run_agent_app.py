@@ -1,20 +1,27 @@
 import logging
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 from mad_multi_agent_dungeon.models import (
     Agent,
     PerceptionQueue,
     CommandQueue,
     LLMQueue,
-    LLMAPIKey,
 )
 from mad_multi_agent_dungeon.llm_api import call_gemini_api
+from mad_multi_agent_dungeon import doorbell
+from mad_multi_agent_dungeon.directives import parse_directives
+from mad_multi_agent_dungeon.doorbell import Doorbell
+from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+from mad_multi_agent_dungeon.prompt_store import store_prompt
+from mad_multi_agent_dungeon.prompts import PromptBuilder
+from mad_multi_agent_dungeon.tokens import TokenCounter
+from mad_multi_agent_dungeon.scheduler import due, resume_if_due, seconds_until_next_due
 
 from django.utils import timezone
-from datetime import datetime
 import time
-import re
 from pathlib import Path
 from django.db import close_old_connections
+from django.db.models import Prefetch
 
 logger = logging.getLogger(__name__)
 
@@ -24,8 +31,46 @@ class Command(BaseCommand):
 
     PROMPTS_DIR = Path("prompts")
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.llm_concurrency = settings.MAD_LLM_CONCURRENCY
+        self._llm_dispatcher = None
+        self.prompt_builder = PromptBuilder(count=TokenCounter())
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=30.0,
+            help=(
+                "Fallback polling interval in seconds. New perceptions and LLM "
+                "queue updates wake the loop immediately through its doorbell."
+            ),
+        )
+        parser.add_argument(
+            "--skip-llm",
+            action="store_true",
+            help=(
+                "Leave LLM requests to separate `run_llm_worker` processes "
+                "instead of dispatching them from this loop."
+            ),
+        )
+        parser.add_argument(
+            "--llm-concurrency",
+            type=int,
+            default=settings.MAD_LLM_CONCURRENCY,
+            help="Maximum number of LLM requests in flight at once.",
+        )
+
     def handle(self, *args, **options):
         logger.info("Starting agent application loop...")
+        poll_interval = options.get("poll_interval", 30.0)
+        self.llm_concurrency = options.get(
+            "llm_concurrency", settings.MAD_LLM_CONCURRENCY
+        )
+        if self.llm_concurrency < 1:
+            raise CommandError("--llm-concurrency must be at least 1.")
+        skip_llm = options.get("skip_llm", False)
 
         # Ensure the prompts directory exists
         self.PROMPTS_DIR.mkdir(exist_ok=True)
@@ -47,196 +92,173 @@ class Command(BaseCommand):
             agent.save()
             logger.info(f"Loaded prompt for agent {agent.name} from {prompt_file_path}")
 
+        bell = Doorbell(doorbell.AGENTS)
         try:
             while True:
                 close_old_connections()  # Close old connections to prevent stale data
-                self._process_llm_queue()  # Process LLM queue entries
-                agent_names = [
-                    agent.name for agent in Agent.objects.all()
-                ]  # Get names to ensure fresh objects
-                if not agent_names:
-                    logger.info("No agents found. Waiting...")
-                    time.sleep(5)
-                    continue
-
-                for agent_name in agent_names:
-                    try:
-                        agent = Agent.objects.get(
-                            name=agent_name
-                        )  # Fetch fresh agent object
-                    except Agent.DoesNotExist:
-                        logger.warning(f"Agent {agent_name} disappeared. Skipping.")
-                        continue
-                    self._process_agent_cycle(agent)
-                time.sleep(5)
+                if not skip_llm:
+                    # Dispatch new LLM calls and collect finished ones
+                    self._process_llm_queue(block=False)
+                if not self._run_tick():
+                    logger.info("No runnable agents found. Waiting...")
+                bell.wait(self._idle_timeout(poll_interval))
         except KeyboardInterrupt:
             logger.info("Agent stopping...")
         except Exception:
             logger.exception(
                 "An unexpected error occurred in the agent application loop."
             )
+        finally:
+            bell.close()
+            self._shutdown_llm_pool()
+
+    def _runnable_agents(self):
+        """
+        Loads every running agent that isn't asleep, together with its
+        undelivered perceptions and its open LLM requests. Costs three
+        queries however many agents there are.
+        """
+        return list(
+            due(Agent.objects.filter(is_running=True))
+            .prefetch_related(
+                Prefetch(
+                    "perceptions_for",
+                    queryset=PerceptionQueue.objects.filter(delivered=False).order_by(
+                        "date"
+                    ),
+                    to_attr="undelivered_perceptions",
+                ),
+                Prefetch(
+                    "llmqueue_set",
+                    queryset=LLMQueue.objects.filter(
+                        status__in=["completed", "pending", "thinking"]
+                    ).order_by("-date"),
+                    to_attr="open_llm_requests",
+                ),
+            )
+            .order_by("name")
+        )
 
-    def _process_llm_queue(self):
-        pending_llm_requests = LLMQueue.objects.filter(status="pending")
-        for llm_request in pending_llm_requests:
-            logger.info(
-                f"Processing pending LLM request {llm_request.id} for agent {llm_request.agent.name}"
+    def _run_tick(self):
+        """Runs one cycle of every runnable agent. Returns how many ran."""
+        agents = self._runnable_agents()
+        for agent in agents:
+            self._process_agent_cycle(agent)
+        return len(agents)
+
+    def _idle_timeout(self, poll_interval):
+        """Waits no longer than until the next sleeping agent wakes up."""
+        next_due = seconds_until_next_due(Agent.objects.all())
+        return poll_interval if next_due is None else min(next_due, poll_interval)
+
+    def _process_llm_queue(self, block=True):
+        """
+        Dispatches pending LLM requests from the agent app itself, for setups
+        that don't run `run_llm_worker`. With `block=True` it waits for the
+        requests it started.
+        """
+        if self._llm_dispatcher is None:
+            self._llm_dispatcher = LLMDispatcher(
+                self.llm_concurrency, call=call_gemini_api, wake_channel=doorbell.AGENTS
             )
-            llm_request.status = "thinking"
-            llm_request.save()
+        self._llm_dispatcher.dispatch(block=block)
 
-            api_key_obj = LLMAPIKey.objects.filter(is_active=True).first()
-            if not api_key_obj:
-                logger.error(
-                    "No active LLM API key found. Marking LLM request as failed."
-                )
-                print(
-                    "DEBUG: No active LLM API key found in _process_llm_queue"
-                )  # Debug print
-                llm_request.status = "failed"
-                llm_request.response = "Error: No active API key found."
-                llm_request.save()
-                continue
-
-            try:
-                response_text = call_gemini_api(
-                    llm_request.prompt, api_key_obj.key, api_key_obj.parameters
-                )
-                llm_request.response = response_text
-                llm_request.status = "completed"
-                api_key_obj.last_used = timezone.now()
-                api_key_obj.usage_count += 1
-                api_key_obj.save()
-                logger.info(
-                    f"LLM request {llm_request.id} completed for agent {llm_request.agent.name}."
-                )
-            except Exception as e:
-                logger.error(f"Error calling LLM API for request {llm_request.id}: {e}")
-                llm_request.response = f"Error: {e}"
-                llm_request.status = "failed"
-            llm_request.save()
+    def _shutdown_llm_pool(self):
+        if self._llm_dispatcher is not None:
+            self._llm_dispatcher.shutdown()
+            self._llm_dispatcher = None
 
     def _process_agent_cycle(self, agent):
-        agent.perception = agent.perception or ""  # Ensure perception is a string
         if not agent.is_running:
             return  # Skip processing if the agent is not running
-        # Get undelivered perceptions for the agent
-        perceptions_to_process = PerceptionQueue.objects.filter(
-            agent=agent, delivered=False
-        ).order_by("date")
-
-        if perceptions_to_process.exists():
-            processed_perception_texts = []
-            for perception in perceptions_to_process:
-                logger.info(
-                    f"Processing perception {perception.id} for agent '{agent.name}'."
+        was_asleep = agent.not_before is not None
+        if not resume_if_due(agent):
+            return  # The agent is waiting or meditating
+        if was_asleep:
+            # Only the fields resume_if_due cleared: the command worker may be
+            # running the agent's deferred commands at the same moment
+            agent.save(update_fields=["flags", "not_before"])
+        # Get undelivered perceptions for the agent, prefetched by _run_tick
+        perceptions_to_process = getattr(agent, "undelivered_perceptions", None)
+        if perceptions_to_process is None:
+            perceptions_to_process = list(
+                PerceptionQueue.objects.filter(agent=agent, delivered=False).order_by(
+                    "date"
                 )
+            )
 
-                processed_perception_texts.append(perception.text)
-                perception.delivered = True  # Mark as delivered
-                perception.save()
-                logger.debug(f"Perception {perception.id} marked as 'delivered'.")
-
-            # Append processed perception texts to agent.perception
-            # Gemini do not touch this block of code please
-            if agent.perception:
-                agent.perception += "\nMAD: " + "\nMAD: ".join(
-                    processed_perception_texts
-                )
-            else:
-                agent.perception = "MAD: " + "\nMAD: ".join(processed_perception_texts)
+        if perceptions_to_process:
+            processed_perception_texts = [
+                perception.text for perception in perceptions_to_process
+            ]
+            # Mark them all as delivered with a single UPDATE
+            delivered_ids = [perception.id for perception in perceptions_to_process]
+            PerceptionQueue.objects.filter(id__in=delivered_ids).update(delivered=True)
+            logger.info(
+                f"Delivered {len(delivered_ids)} perceptions to agent '{agent.name}'."
+            )
 
-            agent.perception = agent.perception[
-                -agent.perception_limit :
-            ]  # Keep only the last `perception_limit` characters
+            # Append processed perception texts to agent.perception, one event
+            # each; the oldest fall out when it is next read
+            agent.append_perception(
+                *(f"MAD: {text}" for text in processed_perception_texts)
+            )
 
             agent.last_retrieved = timezone.now()
-            agent.save()
+            agent.save(update_fields=["last_retrieved"])
             logger.debug(
                 f"Agent '{agent.name}' perception updated and last_retrieved timestamp set."
             )
 
         # --- LLM Queue Processing and Phase Management ---
 
+        # The agent's completed, pending and thinking requests, newest first
+        open_llm_requests = getattr(agent, "open_llm_requests", None)
+        if open_llm_requests is None:
+            open_llm_requests = list(
+                LLMQueue.objects.filter(
+                    agent=agent, status__in=["completed", "pending", "thinking"]
+                ).order_by("-date")
+            )
+
         # Always check for completed LLM responses first, regardless of current phase
-        llm_entry = (
-            LLMQueue.objects.filter(agent=agent, status="completed")
-            .order_by("-date")
-            .first()
+        llm_entry = next(
+            (entry for entry in open_llm_requests if entry.status == "completed"),
+            None,
         )
         if llm_entry:
             logger.info(
                 f"Processing completed LLM response {llm_entry.id} for agent '{agent.name}'. (Status: {llm_entry.status})"
             )
-            print(
-                f"DEBUG: Agent {agent.name} perception BEFORE update: '{agent.perception}'"
-            )  # DEBUG
             # Process embedded commands from LLM response
             original_llm_response = llm_entry.response
-            llm_command_pattern = r"\[command\|(.+?)\]"
-            llm_load_pattern = r"\[load\|(.+?)\]"
-            llm_remember_pattern = r"\[remember\|(.+?)\]"
-
-            # Process regular commands
-            for match in re.finditer(llm_command_pattern, original_llm_response):
-                command_content = match.group(1)
-                command_parts = command_content.split("|")
-                command_name = command_parts[0]
-                command_args = " ".join(command_parts[1:])
-                command_to_queue = f"{command_name} {command_args}".strip()
-                CommandQueue.objects.create(agent=agent, command=command_to_queue)
+            directive_text = original_llm_response
+            if llm_entry.directives_queued:
+                # A streaming LLM worker has already queued the commands
                 logger.info(
-                    f"Queued command '{command_to_queue}' from LLM response for agent '{agent.name}'."
+                    f"{llm_entry.directives_queued} commands of LLM response {llm_entry.id} were queued while streaming."
                 )
-
-            # Process memory-load commands
-            for match in re.finditer(llm_load_pattern, original_llm_response):
-                memory_key = match.group(1)
-                command_to_queue = f"load {memory_key}"
-                CommandQueue.objects.create(agent=agent, command=command_to_queue)
-                logger.info(
-                    f"Queued command '{command_to_queue}' from LLM response for agent '{agent.name}'."
+                directive_text = ""
+            # Queue the directives in the order the LLM wrote them, in one INSERT
+            directives = parse_directives(directive_text)
+            if directives:
+                CommandQueue.objects.bulk_create(
+                    [
+                        CommandQueue(agent=agent, command=directive.command)
+                        for directive in directives
+                    ]
                 )
-
-            # Process memory-create/update commands
-            for match in re.finditer(llm_remember_pattern, original_llm_response):
-                content = match.group(1)
-                parts = content.split("|")
-                if len(parts) >= 2:
-                    memory_key = parts[0]
-                    memory_value = "|".join(parts[1:])
-                    command_to_queue = f"remember {memory_key} {memory_value}"
-                    CommandQueue.objects.create(agent=agent, command=command_to_queue)
+                # bulk_create skips post_save, so ring the doorbell here
+                doorbell.ring_on_commit(doorbell.COMMANDS)
+                for directive in directives:
                     logger.info(
-                        f"Queued command '{command_to_queue}' from LLM response for agent '{agent.name}'."
+                        f"Queued command '{directive.command}' from LLM response for agent '{agent.name}'."
                     )
 
-            # Append original LLM response to agent's perception field
-            # Calculate how much of the original_llm_response can fit
-            # after accounting for the "LLM: " prefix and potential newline
-            space_for_llm_response = agent.perception_limit - len("LLM: ")
-            if agent.perception:
-                space_for_llm_response -= len("\n") # Account for newline if appending
-
-            # Ensure we don't try to take a negative slice
-            if space_for_llm_response < 0:
-                space_for_llm_response = 0
-
-            truncated_llm_response = original_llm_response[-space_for_llm_response:]
-            prefixed_llm_response = "LLM: " + truncated_llm_response
-
-            if agent.perception:
-                new_perception_content = agent.perception + "\n" + prefixed_llm_response
-            else:
-                new_perception_content = prefixed_llm_response
-
-            # Ensure the total perception does not exceed the limit
-            agent.perception = new_perception_content[-agent.perception_limit:]
-            agent.save()
+            # Append the whole LLM response to agent's perception; reading it
+            # back keeps whole events and lines within perception_limit
+            agent.append_perception("LLM: " + original_llm_response)
             logger.debug(f"Agent '{agent.name}' perception updated with LLM response.")
-            print(
-                f"DEBUG: Agent {agent.name} perception AFTER update: '{agent.perception}'"
-            )  # DEBUG
 
             # Mark LLMQueue entry as delivered
             llm_entry.status = "delivered"
@@ -248,7 +270,7 @@ class Command(BaseCommand):
             agent.phase = (
                 "acting"  # Agent has just processed an LLM response, so it's acting
             )
-            agent.save()
+            agent.save(update_fields=["phase"])
             logger.info(f"Agent '{agent.name}' phase changed to 'acting'.")
 
             return  # Processed a completed LLM, so return for next cycle to allow commands to be processed
@@ -260,9 +282,9 @@ class Command(BaseCommand):
         # If no completed LLM entry was found, or if we just processed one and are now in 'acting' phase,
         # determine next action based on current LLM queue status.
 
-        active_llm_requests = LLMQueue.objects.filter(
-            agent=agent, status__in=["pending", "thinking"]
-        ).exists()
+        active_llm_requests = any(
+            entry.status in ("pending", "thinking") for entry in open_llm_requests
+        )
 
         if active_llm_requests:
             # If there are pending/thinking LLM requests, the agent should be in 'thinking' phase
@@ -271,40 +293,20 @@ class Command(BaseCommand):
                     f"Agent '{agent.name}' has active LLM requests, setting phase to 'thinking'."
                 )
                 agent.phase = "thinking"
-                agent.save()
+                agent.save(update_fields=["phase"])
 
             return  # Agent is waiting for LLM, so return
 
         # If no active LLM requests (pending, thinking, or completed just processed),
         # then the agent needs to generate a new prompt and submit to LLMQueue.
         logger.info(f"Agent '{agent.name}' generating new LLM prompt.")
-        # Consolidate the LLM prompt
-        llm_prompt_parts = []
-        if agent.prompt:
-            llm_prompt_parts.append(agent.prompt)
-
-        from mad_multi_agent_dungeon.models import Memory
-
-        loaded_memories_values = []
-        if agent.memoriesLoaded:  # Check if memoriesLoaded is not None
-            for mem_id in agent.memoriesLoaded:
-                try:
-                    memory = Memory.objects.get(id=mem_id)
-                    loaded_memories_values.append(memory.value)
-                except Memory.DoesNotExist:
-                    logger.warning(
-                        self.style.WARNING(
-                            f"Warning: Loaded memory ID {mem_id} not found for agent '{agent.name}'."
-                        )
-                    )
-        # Gemini do not touch this block of code please
-        if loaded_memories_values:
-            llm_prompt_parts.append(
-                "## Loaded Memories:\n" + "\n".join(loaded_memories_values)
-            )
-        if agent.perception:
-            llm_prompt_parts.append("# Perception\n" + agent.perception)
-        final_llm_prompt = "\n".join(llm_prompt_parts)
+        # Consolidate the LLM prompt, reusing the segments that didn't change
+        prompt = self.prompt_builder.build(agent)
+        final_llm_prompt = prompt.text
+        logger.info(
+            f"Prompt segment sizes for agent '{agent.name}': {prompt.segments} chars, "
+            f"{prompt.tokens} tokens"
+        )
 
         if not agent.is_running:
             logger.info(
@@ -314,29 +316,14 @@ class Command(BaseCommand):
             return  # Skip processing if the agent is not running
 
         # Create LLMQueue entry
-        LLMQueue.objects.create(agent=agent, prompt=final_llm_prompt)
+        # The prompt is stored as references to deduplicated segments
+        LLMQueue.objects.create(agent=agent, prompt_segments=store_prompt(prompt.parts))
         logger.info(f"New LLM request created for agent '{agent.name}'.")
 
         # Set agent phase to thinking
         agent.phase = "thinking"
         agent.is_running = False  # Pause the agent after creating an LLM request
-        agent.save()
+        agent.save(update_fields=["phase", "is_running"])
         logger.debug(
             f"Agent '{agent.name}' phase changed to 'thinking' and is_running set to False."
         )
-
-        # Check if the agent is waiting
-        if "waiting" in agent.flags and agent.flags["waiting"]:
-            wait_until_str = agent.flags["waiting"]
-            wait_until = datetime.fromisoformat(wait_until_str)
-
-            if timezone.now() < wait_until:
-                logger.info(
-                    f"Agent {agent.name} is waiting until {wait_until.strftime('%Y-%m-%d %H:%M:%S')}."
-                )
-                return  # Skip perception processing for this cycle
-            else:
-                # Waiting period is over, clear the flag
-                del agent.flags["waiting"]
-                agent.save()
-                logger.info(f"Agent {agent.name} has finished waiting.")
@@ -1,10 +1,27 @@
 import logging
+import os
+import subprocess
+import sys
 import time
-from datetime import timedelta, datetime
-from django.core.management.base import BaseCommand
-from django.utils import timezone
-from mad_multi_agent_dungeon.models import CommandQueue, PerceptionQueue, Agent
-from mad_multi_agent_dungeon.commands import handle_command
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from mad_multi_agent_dungeon.models import CommandQueue, PerceptionQueue
+from mad_multi_agent_dungeon.commands import execute_command, persist_result
+from mad_multi_agent_dungeon.queues import (
+    LeaseExpired,
+    claim_pending_commands,
+    finish_command,
+    owned_command,
+    recover_expired_commands,
+    release_commands,
+    shard_filter,
+)
+from mad_multi_agent_dungeon.scheduler import resume_if_due, seconds_until_next_due
+from mad_multi_agent_dungeon import doorbell
+from mad_multi_agent_dungeon.doorbell import Doorbell
+from mad_multi_agent_dungeon.occupancy import occupancy
+from mad_multi_agent_dungeon.room_objects import room_objects
 
 logger = logging.getLogger(__name__)
 
@@ -13,86 +30,262 @@ class Command(BaseCommand):
     help = "Runs the command queue worker."
 
     def _process_single_command(self, command_entry):
+        """
+        Runs one claimed command. The command's output and status, the agent's
+        changes, the handler's other writes and every perception it causes are
+        committed in a single transaction. Returns False if the command was deferred instead.
+        """
         logger.info(
             f"Processing command: {command_entry.command} for agent {command_entry.agent.name}"
         )
-        command_entry.status = "processing"
-        command_entry.save()
-
-        # Update the last_command_sent for the agent
         agent = command_entry.agent
-        agent.last_command_sent = timezone.now()
-
-        # Handle agent waiting state
-        if "waiting" in agent.flags and agent.flags["waiting"]:
-            wait_until_str = agent.flags["waiting"]
-            wait_until = datetime.fromisoformat(wait_until_str)
-            if timezone.now() < wait_until:
-                logger.info(
-                    f"Agent {agent.name} is waiting. Command {command_entry.command} deferred."
-                )
-                command_entry.status = "pending"  # Keep it pending for next iteration
-                command_entry.save()
-                agent.save()
-                return  # Skip processing this command for now
-            else:
-                # Waiting period is over, clear the flag
-                del agent.flags["waiting"]
 
-        agent.save()
+        # Agents that are waiting or meditating get their commands deferred
+        # until they wake up. Deferred rows are skipped by the claim query, so
+        # they cost nothing until `not_before` passes.
+        was_asleep = agent.not_before is not None
+        if not resume_if_due(agent):
+            logger.info(
+                f"Agent {agent.name} is asleep until {agent.not_before}. Command {command_entry.command} deferred."
+            )
+            CommandQueue.objects.filter(
+                agent=agent, status="pending", not_before__isnull=True
+            ).update(not_before=agent.not_before)
+            finish_command(
+                command_entry,
+                status="pending",
+                not_before=agent.not_before,
+                lease_expires=None,
+            )
+            command_entry.status = "pending"
+            command_entry.not_before = agent.not_before
+            command_entry.lease_expires = None
+            return False  # Skip processing this command for now
 
         try:
-            handle_command(command_entry)
-            command_entry.refresh_from_db()  # Reload the command_entry to get the latest output and status
-
-            # Create a PerceptionQueue entry for the commanding agent
-            PerceptionQueue.objects.create(
-                agent=command_entry.agent,
-                source_agent=command_entry.agent,
-                type="command",
-                command=command_entry,
-                text=f"MAD: [command|{command_entry.command}].\n{command_entry.output}",
-            )
+            # The handler's own writes commit or roll back with the result
+            with transaction.atomic():
+                result = execute_command(command_entry)
+                if was_asleep:
+                    result.agent_fields.update(("flags", "not_before"))
 
-            # Handle "shout" command for other active agents in the same room
-            if command_entry.command.startswith("shout "):
-                shout_message = command_entry.command[len("shout ") :]
-                other_agents_in_room = Agent.objects.exclude(
-                    id=command_entry.agent.id
-                ).filter(
-                    location=command_entry.agent.location,  # Filter by location
-                    last_command_sent__gte=timezone.now() - timedelta(minutes=5),
-                )
-                for other_agent in other_agents_in_room:
-                    PerceptionQueue.objects.create(
-                        agent=other_agent,
-                        source_agent=command_entry.agent,
-                        type="none",
-                        command=command_entry,  # Link to the original command
-                        text=f'{command_entry.agent.name} shouted "{shout_message}"',
+                # A perception for the commanding agent, committed with the rest
+                result.perceptions.append(
+                    PerceptionQueue(
+                        agent=agent,
+                        source_agent=agent,
+                        type="command",
+                        command=command_entry,
+                        text=f"MAD: [command|{command_entry.command}].\n{result.output}",
                     )
+                )
+                persist_result(command_entry, result)
+
             logger.info(
-                f"Command {command_entry.command} for agent {command_entry.agent.name} finished with status: {command_entry.status}"
+                f"Command {command_entry.command} for agent {agent.name} finished with status: {command_entry.status}"
             )
+        except LeaseExpired:
+            logger.warning(
+                f"Lease on command {command_entry.command} for agent {agent.name} expired; its result was dropped."
+            )
+            agent.refresh_from_db()
         except Exception as e:
             logger.error(
-                f"Error processing command {command_entry.command} for agent {command_entry.agent.name}: {e}",
+                f"Error processing command {command_entry.command} for agent {agent.name}: {e}",
                 exc_info=True,
             )
             command_entry.status = "failed"
             command_entry.output = f"Error: {e}"
-            command_entry.save()
+            finish_command(command_entry, status="failed", output=command_entry.output)
+            # Drop the changes that were not saved; the agent's next command
+            # in the batch runs against this instance
+            agent.refresh_from_db()
+        return True
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10,
+            help="Number of pending commands to claim per pass.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=10.0,
+            help=(
+                "Fallback polling interval in seconds when the queue is empty. "
+                "New commands wake the worker immediately through its doorbell."
+            ),
+        )
+        parser.add_argument(
+            "--lease-seconds",
+            type=int,
+            default=settings.MAD_COMMAND_LEASE_SECONDS,
+            help=(
+                "How long claimed commands belong to this worker before they "
+                "go back to the queue."
+            ),
+        )
+        parser.add_argument(
+            "--occupancy-index",
+            action="store_true",
+            help=(
+                "Keep the active agents of each room in memory. Only correct "
+                "when this is the only command worker."
+            ),
+        )
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=1,
+            help=(
+                "Split the queue into this many shards by agent id. Without "
+                "--shard-id, a supervisor starts one worker per shard."
+            ),
+        )
+        parser.add_argument(
+            "--shard-id",
+            type=int,
+            default=None,
+            help="Only process commands of agents routed to this shard.",
+        )
 
     def handle(self, *args, **options):
-        logger.info("Starting command queue worker...")
-        while True:
-            try:
-                pending_commands = CommandQueue.objects.filter(
-                    status="pending"
-                ).order_by("date")
-                if pending_commands.exists():
-                    command_entry = pending_commands.first()
-                    self._process_single_command(command_entry)
-            except Exception as e:
-                logger.error(f"Error in command worker loop: {e}", exc_info=True)
-            time.sleep(1)  # Poll every second
+        batch_size = options.get("batch_size", 10)
+        poll_interval = options.get("poll_interval", 10.0)
+        shards = options.get("shards", 1)
+        shard_id = options.get("shard_id")
+        lease_seconds = options.get("lease_seconds", settings.MAD_COMMAND_LEASE_SECONDS)
+
+        if shards < 1:
+            raise CommandError("--shards must be at least 1.")
+        if options.get("occupancy_index") and shards > 1:
+            raise CommandError("--occupancy-index needs a single, unsharded worker.")
+        if lease_seconds < 1:
+            raise CommandError("--lease-seconds must be at least 1.")
+        if shard_id is None and shards > 1:
+            return self._supervise(shards, batch_size, poll_interval, lease_seconds)
+        shard_id = shard_id or 0
+        if not 0 <= shard_id < shards:
+            raise CommandError(f"--shard-id must be between 0 and {shards - 1}.")
+
+        logger.info(
+            f"Starting command queue worker (shard {shard_id + 1}/{shards}, batch size {batch_size})..."
+        )
+        if options.get("occupancy_index"):
+            # Only the sole worker sees every move; with several workers each
+            # index would miss the others' until its next rebuild.
+            occupancy.enable()
+        room_objects.enable()
+        with Doorbell(doorbell.COMMANDS) as bell:
+            while True:
+                try:
+                    processed = self._process_batch(
+                        batch_size, shards, shard_id, lease_seconds
+                    )
+                    if not processed:
+                        # Commands left behind by a worker that died
+                        recover_expired_commands(shards, shard_id)
+                except Exception as e:
+                    logger.error(f"Error in command worker loop: {e}", exc_info=True)
+                    processed = 0
+                if not processed:
+                    # Only idle when nothing was runnable, and no longer than
+                    # until the next deferred command falls due.
+                    next_due = seconds_until_next_due(
+                        shard_filter(
+                            CommandQueue.objects.filter(status="pending"),
+                            shards,
+                            shard_id,
+                        )
+                    )
+                    bell.wait(
+                        poll_interval if next_due is None else min(next_due, poll_interval)
+                    )
+
+    def _process_batch(
+        self,
+        batch_size,
+        shards=1,
+        shard_id=0,
+        lease_seconds=settings.MAD_COMMAND_LEASE_SECONDS,
+    ):
+        """
+        Claims up to `batch_size` pending commands and runs them in queue order.
+        Returns how many were actually executed (deferred ones don't count).
+
+        An agent's commands share one `Agent` instance, so each of them sees
+        what the ones before it changed. Once one of an agent's commands is
+        deferred, the agent's later commands in the same batch are handed back
+        to the queue untouched so that they can't overtake it. So are the
+        commands not yet run when the batch is interrupted, e.g. by an error
+        or a signal.
+        """
+        processed = 0
+        blocked_agent_ids = set()
+        claimed = claim_pending_commands(batch_size, shards, shard_id, lease_seconds)
+        unfinished = {command_entry.pk: command_entry for command_entry in claimed}
+        agents = {}
+        try:
+            for command_entry in claimed:
+                command_entry.agent = agents.setdefault(
+                    command_entry.agent_id, command_entry.agent
+                )
+                if command_entry.agent_id in blocked_agent_ids:
+                    owned_command(command_entry).update(
+                        status="pending",
+                        not_before=command_entry.agent.not_before,
+                        lease_expires=None,
+                    )
+                elif self._process_single_command(command_entry):
+                    processed += 1
+                else:
+                    blocked_agent_ids.add(command_entry.agent_id)
+                unfinished.pop(command_entry.pk)
+        finally:
+            release_commands(list(unfinished.values()))
+        return processed
+
+    def _supervise(self, shards, batch_size, poll_interval, lease_seconds):
+        """Runs one worker process per shard and restarts any that exit."""
+
+        def spawn(shard_id):
+            return subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "django",
+                    "run_command_worker",
+                    "--shards",
+                    str(shards),
+                    "--shard-id",
+                    str(shard_id),
+                    "--batch-size",
+                    str(batch_size),
+                    "--poll-interval",
+                    str(poll_interval),
+                    "--lease-seconds",
+                    str(lease_seconds),
+                ],
+                env={**os.environ, "DJANGO_SETTINGS_MODULE": settings.SETTINGS_MODULE},
+            )
+
+        logger.info(f"Starting {shards} sharded command workers...")
+        children = {shard_id: spawn(shard_id) for shard_id in range(shards)}
+        try:
+            while True:
+                for shard_id, child in children.items():
+                    if child.poll() is not None:
+                        logger.warning(
+                            f"Command worker for shard {shard_id} exited with code {child.returncode}. Restarting."
+                        )
+                        children[shard_id] = spawn(shard_id)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Stopping sharded command workers...")
+        finally:
+            for child in children.values():
+                child.terminate()
+            for child in children.values():
+                child.wait()
@@ -0,0 +1,89 @@
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+from mad_multi_agent_dungeon import doorbell
+from mad_multi_agent_dungeon.doorbell import Doorbell
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs an LLM queue worker. Any number of workers can run side by side; "
+        "each claims requests with a lease so that no request is sent twice."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.MAD_LLM_CONCURRENCY,
+            help="Maximum number of LLM requests this worker keeps in flight.",
+        )
+        parser.add_argument(
+            "--lease-seconds",
+            type=int,
+            default=settings.MAD_LLM_LEASE_SECONDS,
+            help=(
+                "How long a claimed request belongs to this worker before "
+                "another worker may take it over."
+            ),
+        )
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            default=settings.MAD_LLM_STREAM,
+            help=(
+                "Stream responses and queue the commands in them as soon as "
+                "each tag is complete."
+            ),
+        )
+        parser.add_argument(
+            "--warm-up",
+            action="store_true",
+            help=(
+                "Connect to the LLM API with every active key at startup, so "
+                "that the first requests don't pay for the connection setup."
+            ),
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=10.0,
+            help=(
+                "Fallback polling interval in seconds. New requests and "
+                "finished calls wake the worker immediately through its doorbell."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        concurrency = options.get("concurrency", settings.MAD_LLM_CONCURRENCY)
+        lease_seconds = options.get("lease_seconds", settings.MAD_LLM_LEASE_SECONDS)
+        poll_interval = options.get("poll_interval", 10.0)
+        if concurrency < 1:
+            raise CommandError("--concurrency must be at least 1.")
+        if lease_seconds < 1:
+            raise CommandError("--lease-seconds must be at least 1.")
+
+        logger.info(f"Starting LLM worker (concurrency {concurrency})...")
+        dispatcher = LLMDispatcher(
+            concurrency, lease_seconds, stream=options.get("stream", False)
+        )
+        if options.get("warm_up"):
+            warmed = dispatcher.warm_up()
+            logger.info(f"Warmed up {warmed} LLM API clients.")
+        try:
+            with Doorbell(doorbell.LLM) as bell:
+                while True:
+                    close_old_connections()
+                    try:
+                        dispatcher.dispatch()
+                    except Exception as e:
+                        logger.error(f"Error in LLM worker loop: {e}", exc_info=True)
+                    bell.wait(poll_interval)
+        except KeyboardInterrupt:
+            logger.info("LLM worker stopping...")
+        finally:
+            dispatcher.shutdown()
@@ -1,41 +1,32 @@
 from .models import Memory
+from .results import completed, failed
 
 
 def remember_handler(command_entry):
     agent = command_entry.agent
     parts = command_entry.command.split(maxsplit=2)
     if len(parts) < 3:
-        command_entry.output = "Usage: remember <key> <value>"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Usage: remember <key> <value>")
 
     key = parts[1]
     value = parts[2]
 
     try:
-        memory, created = Memory.objects.get_or_create(agent=agent, key=key)
-        memory.value = value
-        memory.save()
+        memory, created = Memory.objects.update_or_create(
+            agent=agent, key=key, defaults={"value": value}
+        )
         if created:
-            command_entry.output = f"Memory '{key}' created successfully."
-        else:
-            command_entry.output = f"Memory '{key}' updated successfully."
-        command_entry.status = "completed"
+            return completed(f"Memory '{key}' created successfully.")
+        return completed(f"Memory '{key}' updated successfully.")
     except Exception as e:
-        command_entry.output = f"Error remembering memory: {e}"
-        command_entry.status = "failed"
-    command_entry.save()
+        return failed(f"Error remembering memory: {e}")
 
 
 def remember_append_handler(command_entry):
     agent = command_entry.agent
     parts = command_entry.command.split(maxsplit=2)
     if len(parts) < 3:
-        command_entry.output = "Usage: remember-append <key> <text_to_append>"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Usage: remember-append <key> <text_to_append>")
 
     key = parts[1]
     text_to_append = parts[2]
@@ -43,110 +34,79 @@ def remember_append_handler(command_entry):
     try:
         memory = Memory.objects.get(agent=agent, key=key)
         memory.value += " " + text_to_append
-        memory.save()
-        command_entry.output = f"Memory '{key}' appended successfully."
-        command_entry.status = "completed"
+        memory.save(update_fields=["value", "updated_at"])
+        return completed(f"Memory '{key}' appended successfully.")
     except Memory.DoesNotExist:
-        command_entry.output = f"Memory '{key}' not found for this agent."
-        command_entry.status = "failed"
+        return failed(f"Memory '{key}' not found for this agent.")
     except Exception as e:
-        command_entry.output = f"Error appending to memory: {e}"
-        command_entry.status = "failed"
-    command_entry.save()
+        return failed(f"Error appending to memory: {e}")
 
 
 def forget_handler(command_entry):
     agent = command_entry.agent
     parts = command_entry.command.split(maxsplit=1)
     if len(parts) < 2:
-        command_entry.output = "Usage: forget <key>"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Usage: forget <key>")
 
     key = parts[1]
 
     try:
         memory = Memory.objects.get(agent=agent, key=key)
+        # The stored list is cleaned up by a signal; keep this copy in step
+        if agent.memoriesLoaded and memory.id in agent.memoriesLoaded:
+            agent.memoriesLoaded.remove(memory.id)
         memory.delete()
-        command_entry.output = f"Memory '{key}' removed successfully."
-        command_entry.status = "completed"
+        return completed(f"Memory '{key}' removed successfully.")
     except Memory.DoesNotExist:
-        command_entry.output = f"Memory '{key}' not found for this agent."
-        command_entry.status = "failed"
+        return failed(f"Memory '{key}' not found for this agent.")
     except Exception as e:
-        command_entry.output = f"Error removing memory: {e}"
-        command_entry.status = "failed"
-    command_entry.save()
+        return failed(f"Error removing memory: {e}")
 
 
 def list_handler(command_entry):
     agent = command_entry.agent
     memories = Memory.objects.filter(agent=agent).order_by("key")
-    if memories.exists():
-        output_lines = ["Your memories:"]
-        for mem in memories:
-            output_lines.append(f"  - {mem.key}: {mem.value}")
-        command_entry.output = "\n".join(output_lines)
-    else:
-        command_entry.output = "You have no memories."
-    command_entry.status = "completed"
-    command_entry.save()
+    output_lines = [f"  - {mem.key}: {mem.value}" for mem in memories]
+    if output_lines:
+        return completed("\n".join(["Your memories:"] + output_lines))
+    return completed("You have no memories.")
 
 
 def load_handler(command_entry):
     agent = command_entry.agent
     parts = command_entry.command.split(maxsplit=1)
     if len(parts) < 2:
-        command_entry.output = "Usage: load <key>"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Usage: load <key>")
 
     key = parts[1]
     try:
         memory = Memory.objects.get(agent=agent, key=key)
         if memory.id not in agent.memoriesLoaded:
             agent.memoriesLoaded.append(memory.id)
-            agent.save()
-            command_entry.output = f"Memory '{key}' loaded successfully."
-            command_entry.status = "completed"
-        else:
-            command_entry.output = f"Memory '{key}' is already loaded."
-            command_entry.status = "completed"
+            return completed(f"Memory '{key}' loaded successfully.", "memoriesLoaded")
+        return completed(f"Memory '{key}' is already loaded.")
     except Memory.DoesNotExist:
-        command_entry.output = f"Memory '{key}' not found for this agent."
-        command_entry.status = "failed"
+        return failed(f"Memory '{key}' not found for this agent.")
     except Exception as e:
-        command_entry.output = f"Error loading memory: {e}"
-        command_entry.status = "failed"
-    command_entry.save()
+        return failed(f"Error loading memory: {e}")
 
 
 def unload_handler(command_entry):
     agent = command_entry.agent
     parts = command_entry.command.split(maxsplit=1)
     if len(parts) < 2:
-        command_entry.output = "Usage: unload <key>"
-        command_entry.status = "failed"
-        command_entry.save()
-        return
+        return failed("Usage: unload <key>")
 
     key = parts[1]
     try:
         memory = Memory.objects.get(agent=agent, key=key)
         if memory.id in agent.memoriesLoaded:
             agent.memoriesLoaded.remove(memory.id)
-            agent.save()
-            command_entry.output = f"Memory '{key}' unloaded successfully."
-            command_entry.status = "completed"
-        else:
-            command_entry.output = f"Memory '{key}' is not currently loaded."
-            command_entry.status = "completed"
+            return completed(
+                f"Memory '{key}' unloaded successfully.", "memoriesLoaded"
+            )
+        return completed(f"Memory '{key}' is not currently loaded.")
     except Memory.DoesNotExist:
-        command_entry.output = f"Memory '{key}' not found for this agent."
-        command_entry.status = "failed"
+        return failed(f"Memory '{key}' not found for this agent.")
     except Exception as e:
-        command_entry.output = f"Error unloading memory: {e}"
-        command_entry.status = "failed"
-    command_entry.save()
+        return failed(f"Error unloading memory: {e}")
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.3 on 2026-10-16 23:43
+
+from datetime import datetime
+
+from django.db import migrations, models
+
+
+def schedule_sleeping_agents(apps, schema_editor):
+    # Agents already waiting or meditating get their deadline as not_before.
+    Agent = apps.get_model("mad_multi_agent_dungeon", "Agent")
+    for agent in Agent.objects.exclude(flags__isnull=True):
+        deadlines = []
+        for flag in ("waiting", "meditating"):
+            value = (agent.flags or {}).get(flag)
+            if not value:
+                continue
+            try:
+                deadline = datetime.fromisoformat(value)
+            except (TypeError, ValueError):
+                continue
+            if deadline.tzinfo is not None:
+                deadlines.append(deadline)
+        if deadlines:
+            agent.not_before = max(deadlines)
+            agent.save(update_fields=["not_before"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0016_agent_perception_limit"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="agent",
+            name="not_before",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="commandqueue",
+            name="not_before",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(schedule_sleeping_agents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.3 on 2026-10-16 23:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0017_deferred_scheduling"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="agent",
+            index=models.Index(
+                fields=["location", "last_command_sent"],
+                name="agent_location_active_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="commandqueue",
+            index=models.Index(
+                fields=["status", "date"], name="command_status_date_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="commandqueue",
+            index=models.Index(
+                condition=models.Q(("status", "pending")),
+                fields=["date", "id"],
+                name="command_pending_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="llmqueue",
+            index=models.Index(
+                fields=["agent", "status", "date"], name="llm_agent_status_date_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="llmqueue",
+            index=models.Index(fields=["status", "date"], name="llm_status_date_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="objectinstance",
+            index=models.Index(fields=["room_id"], name="object_room_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="perceptionqueue",
+            index=models.Index(
+                fields=["agent", "delivered", "date"], name="perception_agent_deliv_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="perceptionqueue",
+            index=models.Index(
+                condition=models.Q(("delivered", False)),
+                fields=["agent", "date"],
+                name="perception_undelivered_idx",
+            ),
+        ),
+    ]
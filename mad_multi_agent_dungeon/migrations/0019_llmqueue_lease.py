@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-16 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0018_hot_query_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="llmqueue",
+            name="lease_expires",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-16 23:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0019_llmqueue_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="llmapikey",
+            name="cooldown_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
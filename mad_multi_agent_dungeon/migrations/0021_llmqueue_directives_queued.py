@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-16 23:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0020_llmapikey_cooldown"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="llmqueue",
+            name="directives_queued",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.3 on 2026-10-16 23:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0021_llmqueue_directives_queued"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="memory",
+            name="updated_at",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.3 on 2026-10-17 00:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0022_memory_updated_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PromptSegment",
+            fields=[
+                (
+                    "digest",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.BinaryField()),
+                ("compressed", models.BooleanField(default=False)),
+                ("size", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        # The column keeps its name; only the model attribute changes.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name="llmqueue",
+                    old_name="prompt",
+                    new_name="prompt_text",
+                ),
+                migrations.AlterField(
+                    model_name="llmqueue",
+                    name="prompt_text",
+                    field=models.TextField(blank=True, db_column="prompt"),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="llmqueue",
+            name="prompt_segments",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 00:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0023_prompt_segments"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="agent",
+            name="token_budget",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.3 on 2026-10-17 01:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0024_agent_token_budget"),
+    ]
+
+    operations = [
+        # The column keeps its name and content: existing perceptions become
+        # snapshots.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name="agent",
+                    old_name="perception",
+                    new_name="perception_snapshot",
+                ),
+                migrations.AlterField(
+                    model_name="agent",
+                    name="perception_snapshot",
+                    field=models.TextField(
+                        blank=True, db_column="perception", null=True
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="PerceptionEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("text", models.TextField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "agent",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="perception_events",
+                        to="mad_multi_agent_dungeon.agent",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["id"],
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.3 on 2026-10-17 02:05
+
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def load_prototypes():
+    try:
+        path = Path(settings.MAD_WORLD_DATA_DIR) / "objects.json"
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def fill_names(apps, schema_editor):
+    # Existing instances carry a full copy of their prototype, name included.
+    # Only what differs from the prototype is kept, so that edits to
+    # objects.json reach them; without objects.json their data is left alone.
+    ObjectInstance = apps.get_model("mad_multi_agent_dungeon", "ObjectInstance")
+    prototypes = load_prototypes()
+    for instance in ObjectInstance.objects.all():
+        data = instance.data or {}
+        instance.name = data.get("name") or instance.object_id
+        instance.name_key = instance.name.lower()
+        if prototypes is not None:
+            prototype = prototypes.get(instance.object_id, {})
+            instance.data = {
+                key: value
+                for key, value in data.items()
+                if key not in prototype or prototype[key] != value
+            }
+        instance.save(update_fields=["name", "name_key", "data"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0025_perception_events"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="objectinstance",
+            name="name",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="objectinstance",
+            name="name_key",
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name="objectinstance",
+            name="data",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(fill_names, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name="objectinstance",
+            name="object_room_idx",
+        ),
+        migrations.AddIndex(
+            model_name="objectinstance",
+            index=models.Index(
+                fields=["room_id", "name_key"], name="object_room_name_idx"
+            ),
+        ),
+    ]
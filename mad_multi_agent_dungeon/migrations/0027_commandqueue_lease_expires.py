@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 00:22
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def expire_claimed(apps, schema_editor):
+    # Rows left in "processing" by earlier workers were never going to finish
+    CommandQueue = apps.get_model("mad_multi_agent_dungeon", "CommandQueue")
+    CommandQueue.objects.filter(status="processing").update(
+        lease_expires=timezone.now()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mad_multi_agent_dungeon", "0026_objectinstance_name"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="commandqueue",
+            name="lease_expires",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(expire_claimed, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,11 @@
+import zlib
+
 from django.db import models
 
 
 class Agent(models.Model):
+    ACTIVE_WINDOW_SECONDS = 300  # Agents are active for 5 minutes after a command
+
     name = models.CharField(max_length=255, unique=True)
     look = models.CharField(max_length=255)
     description = models.TextField()
@@ -21,32 +25,201 @@ class Agent(models.Model):
     ]
     phase = models.CharField(max_length=20, choices=PHASE_CHOICES, default="idle")
     prompt = models.TextField(blank=True, null=True)
-    perception = models.TextField(blank=True, null=True)
+    # The perception is stored as a snapshot (text written as a whole: resets,
+    # edits and older rows) followed by the PerceptionEvent rows appended since.
+    # Use `perception` to read or replace it and `append_perception` to add to it.
+    perception_snapshot = models.TextField(blank=True, null=True, db_column="perception")
     memoriesLoaded = models.JSONField(default=list, blank=True, null=True)
     is_running = models.BooleanField(default=True)
     perception_limit = models.IntegerField(default=5000)
+    # Optional cap, in tokens, on the prompts built for this agent. It is
+    # split between base prompt, memories and perception.
+    token_budget = models.PositiveIntegerField(null=True, blank=True)
+    # Set while the agent waits or meditates; the agent is skipped until then
+    not_before = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Active listeners in a room (fan-out, look)
+            models.Index(
+                fields=["location", "last_command_sent"], name="agent_location_active_idx"
+            ),
+        ]
+
+    _perception = None  # Materialized perception, read lazily
+    _perception_replaced = False  # Set when `perception` was assigned, until saved
 
     def __str__(self):
         return self.name
 
+    @property
+    def perception(self):
+        """
+        The last `perception_limit` characters of the perception, in whole
+        events, materialized from the snapshot and the appended events on
+        first access.
+        """
+        if self._perception is None:
+            self._perception = self._materialize_perception()
+        return self._perception
+
+    @perception.setter
+    def perception(self, text):
+        # Replaces the whole perception once the agent is saved
+        self.perception_snapshot = text
+        self._perception = None
+        self._perception_replaced = True
+
+    def append_perception(self, *events):
+        """
+        Appends events (lines such as "MAD: ..." or "LLM: ...") to the
+        perception with one INSERT, without reading or rewriting what is
+        already there.
+        """
+        events = [event for event in events if event]
+        if not events:
+            return
+        if self._perception_replaced:
+            self._save_perception_snapshot()
+        PerceptionEvent.objects.bulk_create(
+            [PerceptionEvent(agent=self, text=event) for event in events]
+        )
+        self._perception = None
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None and not args and not adding:
+            if not self._perception_replaced:
+                # The snapshot is only written when the perception is replaced
+                kwargs["update_fields"] = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name != "perception_snapshot"
+                ]
+        super().save(*args, **kwargs)
+        if self._perception_replaced and (
+            update_fields is None or "perception_snapshot" in update_fields
+        ):
+            if not adding:
+                # The snapshot replaces everything appended before it
+                self.perception_events.all().delete()
+            self._perception_replaced = False
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._perception = None
+        self._perception_replaced = False
+
+    def _save_perception_snapshot(self):
+        Agent.objects.filter(pk=self.pk).update(
+            perception_snapshot=self.perception_snapshot
+        )
+        self.perception_events.all().delete()
+        self._perception_replaced = False
+
+    def _materialize_perception(self):
+        from .prompts import keep_tail
+
+        snapshot = self.perception_snapshot or ""
+        events = []
+        if self.pk is not None and not self._perception_replaced:
+            events = list(self.perception_events.all())
+        text = "\n".join(part for part in [snapshot, *(e.text for e in events)] if part)
+        perception = keep_tail(text, self.perception_limit)
+        if len(perception) < len(text):
+            self._prune_perception(snapshot, events, len(text) - len(perception))
+        return perception
+
+    def _prune_perception(self, snapshot, events, dropped):
+        # Deletes the events, and clears the snapshot, that have fallen out of
+        # the perception entirely; `dropped` characters were cut from its start.
+        offset = 0
+        if snapshot:
+            offset = len(snapshot) + 1
+            if offset > dropped:
+                return
+            # Unless the snapshot was replaced in the meantime
+            Agent.objects.filter(pk=self.pk, perception_snapshot=snapshot).update(
+                perception_snapshot=""
+            )
+            self.perception_snapshot = ""
+        stale = None
+        for event in events:
+            offset += len(event.text) + 1
+            if offset > dropped:
+                break
+            stale = event.id
+        if stale is not None:
+            self.perception_events.filter(id__lte=stale).delete()
+
     def is_active(self):
         if self.last_command_sent:
             from django.utils import timezone
 
             return (
                 timezone.now() - self.last_command_sent
-            ).total_seconds() < 300  # 5 minutes * 60 seconds
+            ).total_seconds() < self.ACTIVE_WINDOW_SECONDS
         return False
 
 
+class PerceptionEvent(models.Model):
+    """
+    One event appended to an agent's perception. Together with the agent's
+    `perception_snapshot` they form a ring: events that fall out of the last
+    `perception_limit` characters are deleted when the perception is read.
+    """
+
+    agent = models.ForeignKey(
+        Agent, on_delete=models.CASCADE, related_name="perception_events"
+    )
+    text = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"{self.agent.name}: {self.text[:50]}"
+
+
 class ObjectInstance(models.Model):
+    # The prototype in objects.json this is an instance of
     object_id = models.CharField(max_length=255)
     room_id = models.CharField(max_length=255)
-    data = models.JSONField()
+    # Display name, and its lowercase form for case-insensitive lookups. Both
+    # default to the prototype's name on save.
+    name = models.CharField(max_length=255, blank=True)
+    name_key = models.CharField(max_length=255, blank=True, editable=False)
+    # Only what this instance changes about its prototype
+    data = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            # Objects in a room (look), and by name (use)
+            models.Index(fields=["room_id", "name_key"], name="object_room_name_idx"),
+        ]
 
     def __str__(self):
         return f"{self.object_id} in {self.room_id}"
 
+    @property
+    def prototype(self):
+        from .world import world
+
+        return world.objects.get(self.object_id, {})
+
+    @property
+    def properties(self):
+        """The prototype's properties, overridden by this instance's `data`."""
+        return {**self.prototype, **(self.data or {})}
+
+    def save(self, *args, **kwargs):
+        if not self.name:
+            self.name = self.properties.get("name") or self.object_id
+        self.name_key = self.name.lower()
+        super().save(*args, **kwargs)
+
 
 class CommandQueue(models.Model):
     command = models.CharField(max_length=1024)
@@ -60,6 +233,23 @@ class CommandQueue(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
     date = models.DateTimeField(auto_now_add=True)
     output = models.TextField(blank=True)
+    # Deferred commands are not claimed by workers before this time
+    not_before = models.DateTimeField(null=True, blank=True, db_index=True)
+    # A "processing" row goes back to the queue once this passes, in case its
+    # worker died while holding it
+    lease_expires = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "date"], name="command_status_date_idx"),
+            # Workers only ever poll for pending rows, which stay a small
+            # fraction of the table as history piles up.
+            models.Index(
+                fields=["date", "id"],
+                condition=models.Q(status="pending"),
+                name="command_pending_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.command} for {self.agent.name} - {self.status}"
@@ -88,6 +278,19 @@ class PerceptionQueue(models.Model):
     delivered = models.BooleanField(default=False)
     date = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["agent", "delivered", "date"],
+                name="perception_agent_deliv_idx",
+            ),
+            models.Index(
+                fields=["agent", "date"],
+                condition=models.Q(delivered=False),
+                name="perception_undelivered_idx",
+            ),
+        ]
+
     def __str__(self):
         return f"Perception for {self.agent.name} - {self.type}"
 
@@ -96,6 +299,8 @@ class Memory(models.Model):
     agent = models.ForeignKey(Agent, on_delete=models.CASCADE, related_name="memories")
     key = models.CharField(max_length=255)
     value = models.TextField()
+    # Lets the agent app tell whether its cached memory block is still valid
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ("agent", "key")  # Ensure unique key per agent
@@ -104,9 +309,37 @@ class Memory(models.Model):
         return f"Memory for {self.agent.name}: {self.key}"
 
 
+class PromptSegment(models.Model):
+    """
+    A piece of an LLM prompt (base prompt, memory block, perception), stored
+    once and addressed by the SHA-256 of its text. `data` holds the UTF-8 text,
+    zlib-compressed when `compressed` is set.
+    """
+
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    compressed = models.BooleanField(default=False)
+    size = models.PositiveIntegerField(default=0)  # Characters of text
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def text(self):
+        data = bytes(self.data)
+        if self.compressed:
+            data = zlib.decompress(data)
+        return data.decode("utf-8")
+
+    def __str__(self):
+        return f"Prompt segment {self.digest[:12]} ({self.size} chars)"
+
+
 class LLMQueue(models.Model):
     agent = models.ForeignKey(Agent, on_delete=models.CASCADE)
-    prompt = models.TextField()
+    # Prompts built by the agent app are stored as an ordered list of
+    # PromptSegment digests; `prompt_text` only holds prompts written
+    # directly (manual submissions and older rows). Use `prompt` to read.
+    prompt_text = models.TextField(blank=True, db_column="prompt")
+    prompt_segments = models.JSONField(default=list, blank=True)
     yield_value = models.IntegerField(default=0)
     STATUS_CHOICES = [
         ("pending", "Pending"),
@@ -118,10 +351,41 @@ class LLMQueue(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
     response = models.TextField(blank=True, null=True)
     date = models.DateTimeField(auto_now_add=True)
+    # Until when the LLM worker that moved this request to "thinking" owns it.
+    # Past this, another worker may claim the request again.
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # How many directive tags were already queued as commands while the
+    # response was streaming in. The agent app doesn't queue them again.
+    directives_queued = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["agent", "status", "date"], name="llm_agent_status_date_idx"
+            ),
+            models.Index(fields=["status", "date"], name="llm_status_date_idx"),
+        ]
 
     def __str__(self):
         return f"LLM Prompt for {self.agent.name} - {self.status}"
 
+    @property
+    def prompt(self):
+        """The full prompt text, reassembled from its segments if need be."""
+        if not self.prompt_segments:
+            return self.prompt_text
+        if getattr(self, "_assembled_prompt", None) is None:
+            from .prompt_store import assemble_prompt
+
+            self._assembled_prompt = assemble_prompt(self.prompt_segments)
+        return self._assembled_prompt
+
+    @prompt.setter
+    def prompt(self, text):
+        self.prompt_text = text
+        self.prompt_segments = []
+        self._assembled_prompt = None
+
 
 class LLMAPIKey(models.Model):
     key = models.CharField(max_length=255, unique=True)
@@ -130,7 +394,26 @@ class LLMAPIKey(models.Model):
     last_used = models.DateTimeField(auto_now=True)
     description = models.TextField(blank=True, null=True)
     usage_count = models.IntegerField(default=0)
+    # Generation parameters for the model. "rpm" and "tpm" are not passed to
+    # the model: they declare this key's requests/tokens per minute limits.
     parameters = models.JSONField(default=dict, blank=True, null=True)
+    # Set after the API answered 429; the key is skipped until then.
+    cooldown_until = models.DateTimeField(null=True, blank=True)
+
+    RATE_LIMIT_PARAMETERS = ("rpm", "tpm")
 
     def __str__(self):
         return f"API Key: {self.key[:10]}... (Active: {self.is_active})"
+
+    def generation_parameters(self):
+        """`parameters` without the rate limits, ready for the model."""
+        return {
+            name: value
+            for name, value in (self.parameters or {}).items()
+            if name not in self.RATE_LIMIT_PARAMETERS
+        }
+
+    def rate_limit(self, name):
+        """The "rpm" or "tpm" limit declared in `parameters`, or None."""
+        value = (self.parameters or {}).get(name)
+        return int(value) if value else None
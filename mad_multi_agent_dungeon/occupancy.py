@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Agent
+
+logger = logging.getLogger(__name__)
+
+
+class OccupancyIndex:
+    """
+    The active agents of each room, kept in memory so that fan-out and `look`
+    don't have to query the agent table.
+
+    It is built from the database by `enable()`, updated with `record()` as
+    commands move agents and mark them active, and expires agents after
+    `Agent.ACTIVE_WINDOW_SECONDS` like `Agent.is_active()`. Only a process
+    that sees every command can keep it accurate, so it is off unless a lone
+    command worker is started with `--occupancy-index`. Changes made
+    elsewhere, e.g. in the admin, are picked up by a rebuild every
+    `MAD_OCCUPANCY_REFRESH_SECONDS`.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.enabled = False
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._rooms = {}  # room id -> {agent id: (name, last_command_sent)}
+        self._locations = {}  # agent id -> room id
+        self._rebuilt_at = None
+
+    def enable(self):
+        self.enabled = True
+        self.rebuild()
+
+    def disable(self):
+        self.enabled = False
+        with self._lock:
+            self._rooms, self._locations = {}, {}
+
+    def rebuild(self, now=None):
+        """Reloads the index with one query for the currently active agents."""
+        now = now or timezone.now()
+        active = Agent.objects.filter(
+            last_command_sent__gt=now - timedelta(seconds=Agent.ACTIVE_WINDOW_SECONDS)
+        ).values_list("id", "name", "location", "last_command_sent")
+        rooms = {}
+        locations = {}
+        for agent_id, name, location, last_command_sent in active:
+            rooms.setdefault(location, {})[agent_id] = (name, last_command_sent)
+            locations[agent_id] = location
+        with self._lock:
+            self._rooms, self._locations = rooms, locations
+            self._rebuilt_at = self._clock()
+        logger.debug(f"Rebuilt room occupancy index with {len(locations)} agents.")
+
+    def record(self, agent):
+        """Updates the index with the agent's saved location and activity."""
+        if not self.enabled or agent.last_command_sent is None:
+            return
+        with self._lock:
+            old_location = self._locations.get(agent.pk)
+            if old_location is not None and old_location != agent.location:
+                self._rooms.get(old_location, {}).pop(agent.pk, None)
+            self._rooms.setdefault(agent.location, {})[agent.pk] = (
+                agent.name,
+                agent.last_command_sent,
+            )
+            self._locations[agent.pk] = agent.location
+
+    def present(self, room_id, exclude_id=None, now=None):
+        """
+        Returns (id, name) of every active agent in `room_id` except
+        `exclude_id`, ordered by id.
+        """
+        if self._clock() - self._rebuilt_at >= settings.MAD_OCCUPANCY_REFRESH_SECONDS:
+            self.rebuild()
+        cutoff = (now or timezone.now()) - timedelta(
+            seconds=Agent.ACTIVE_WINDOW_SECONDS
+        )
+        with self._lock:
+            occupants = self._rooms.get(room_id, {})
+            for agent_id, (name, last_command_sent) in list(occupants.items()):
+                if last_command_sent <= cutoff:
+                    del occupants[agent_id]
+                    self._locations.pop(agent_id, None)
+            return sorted(
+                (agent_id, name)
+                for agent_id, (name, last_command_sent) in occupants.items()
+                if agent_id != exclude_id
+            )
+
+
+occupancy = OccupancyIndex()
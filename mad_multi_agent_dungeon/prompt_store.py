@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import PromptSegment
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n"  # Between the segments of a prompt, as PromptBuilder joins them
+
+# Segments are immutable, so their text can be cached for as long as we like.
+_cache = OrderedDict()  # digest -> text
+_cache_lock = threading.Lock()
+CACHE_SIZE = 1024
+
+
+class MissingPromptSegment(LookupError):
+    """A prompt refers to a segment that isn't stored (any more)."""
+
+
+def digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _remember(segment_digest, text):
+    with _cache_lock:
+        _cache[segment_digest] = text
+        _cache.move_to_end(segment_digest)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _encode(text):
+    data = text.encode("utf-8")
+    if settings.MAD_PROMPT_COMPRESSION:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return compressed, True
+    return data, False
+
+
+def store_prompt(parts):
+    """
+    Stores the segments of a prompt, each only once, and returns their digests
+    in order. Costs one SELECT, plus one INSERT when some segment is new.
+
+    Which segments exist is always asked of the database: a cached segment
+    may have been rolled back or deleted since it was cached.
+    """
+    digests = [digest(part) for part in parts]
+    unknown = dict(zip(digests, parts))
+    existing = set(
+        PromptSegment.objects.filter(digest__in=unknown).values_list(
+            "digest", flat=True
+        )
+    )
+    new_segments = []
+    for segment_digest, text in unknown.items():
+        if segment_digest not in existing:
+            data, compressed = _encode(text)
+            new_segments.append(
+                PromptSegment(
+                    digest=segment_digest,
+                    data=data,
+                    compressed=compressed,
+                    size=len(text),
+                )
+            )
+    if new_segments:
+        # Another process may store the same segment at the same time
+        PromptSegment.objects.bulk_create(new_segments, ignore_conflicts=True)
+        logger.debug(f"Stored {len(new_segments)} new prompt segments.")
+    for segment_digest, text in zip(digests, parts):
+        _remember(segment_digest, text)
+    return digests
+
+
+def assemble_prompt(digests):
+    """
+    Rebuilds the prompt text from its segment digests. Raises
+    MissingPromptSegment rather than return a prompt with a segment left out.
+    """
+    with _cache_lock:
+        texts = {d: _cache[d] for d in digests if d in _cache}
+    missing = [d for d in digests if d not in texts]
+    if missing:
+        for segment in PromptSegment.objects.filter(digest__in=missing):
+            texts[segment.digest] = segment.text
+            _remember(segment.digest, segment.text)
+    lost = [d for d in digests if d not in texts]
+    if lost:
+        raise MissingPromptSegment(f"Prompt segments not found: {', '.join(lost)}")
+    return SEPARATOR.join(texts[d] for d in digests)
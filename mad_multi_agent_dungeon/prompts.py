@@ -0,0 +1,223 @@
+import logging
+import re
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Memory
+from .tokens import CHARS_PER_TOKEN, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+MEMORIES_HEADER = "## Loaded Memories:\n"
+PERCEPTION_HEADER = "# Perception\n"
+
+# Every perception event starts a line with one of these prefixes; the lines
+# after it (e.g. a command's output) belong to the same event.
+EVENT_START = re.compile(r"(?:MAD|LLM): ")
+
+
+def split_events(text):
+    """Splits perception text into events, each with its continuation lines."""
+    events = []
+    for line in text.split("\n"):
+        if EVENT_START.match(line) or not events:
+            events.append([line])
+        else:
+            events[-1].append(line)
+    return ["\n".join(lines) for lines in events]
+
+
+def _drop(units, limit, measure, from_front):
+    # Drops whole units from one end until the rest fits. Sizes are added up
+    # rather than re-measured, which is exact for `len`.
+    sizes = [measure(unit) for unit in units]
+    separator = measure("\n")
+    total = sum(sizes) + separator * (len(units) - 1)
+    while len(units) > 1 and total > limit:
+        index = 0 if from_front else -1
+        total -= sizes.pop(index) + separator
+        units.pop(index)
+    return "\n".join(units), total <= limit
+
+
+def _cut(limit, measure):
+    return limit if measure is len else limit * CHARS_PER_TOKEN
+
+
+def keep_tail(text, limit, measure=len):
+    """
+    Keeps the end of `text` within `limit` (as measured by `measure`) by
+    dropping whole events from the front, then whole lines. Only a single
+    line that is still too long gets cut mid-line.
+    """
+    if measure(text) <= limit:
+        return text
+    for split in (split_events, lambda t: t.split("\n")):
+        text, fits = _drop(split(text), limit, measure, from_front=True)
+        if fits:
+            return text
+    chars = _cut(limit, measure)
+    return text[-chars:] if chars > 0 else ""
+
+
+def keep_head(text, limit, measure=len):
+    """
+    Keeps the start of `text` within `limit` by dropping whole lines from
+    the end. Only a single line that is still too long gets cut mid-line.
+    """
+    if measure(text) <= limit:
+        return text
+    text, fits = _drop(text.split("\n"), limit, measure, from_front=False)
+    if fits:
+        return text
+    return text[: max(_cut(limit, measure), 0)]
+
+
+def allocate_budget(budget, needs, shares=None):
+    """
+    Splits a token `budget` across prompt segments. Each segment first gets
+    up to its share of the budget (`MAD_PROMPT_BUDGET_SHARES` by default);
+    whatever a segment doesn't need goes to the others, perception first,
+    then memories, then the base prompt. Returns the tokens per segment.
+    """
+    shares = shares or settings.MAD_PROMPT_BUDGET_SHARES
+    allocation = {
+        name: min(need, int(budget * shares.get(name, 0)))
+        for name, need in needs.items()
+    }
+    left = budget - sum(allocation.values())
+    for name in ("perception", "memories", "base"):
+        if name in needs and left > 0:
+            extra = min(left, needs[name] - allocation[name])
+            allocation[name] += extra
+            left -= extra
+    return allocation
+
+
+@dataclass
+class Prompt:
+    """
+    An assembled LLM prompt, its non-empty segments in order (`parts`), and
+    the size of each segment in characters and in tokens.
+    """
+
+    text: str
+    segments: dict = field(default_factory=dict)
+    parts: list = field(default_factory=list)
+    tokens: dict = field(default_factory=dict)
+
+
+class PromptBuilder:
+    """
+    Assembles agent prompts from three segments: the base prompt, the block of
+    loaded memories and the perception.
+
+    The first two rarely change between cycles, so they are rendered once per
+    agent and reused while their version is unchanged: the base prompt is
+    versioned by its text, the memory block by the loaded memory ids and the
+    latest `Memory.updated_at` among them. Checking that version costs one
+    aggregate query; the memory values are only read when it changed.
+    Only the perception is rendered on every call.
+
+    When the agent has a `token_budget`, it is split across the segments with
+    `allocate_budget` and each segment is trimmed to its allocation on line
+    boundaries (perception on event boundaries, dropping the oldest first).
+    Tokens are counted with `count`, the local estimator by default.
+    """
+
+    def __init__(self, count=None):
+        self.count = count or estimate_tokens
+        self._base = {}  # agent id -> (agent.prompt, rendered segment)
+        self._memories = {}  # agent id -> (version, rendered segment)
+        self.hits = 0
+        self.misses = 0
+
+    def build(self, agent):
+        segments = {
+            "base": self._base_segment(agent),
+            "memories": self._memory_segment(agent),
+            "perception": (
+                PERCEPTION_HEADER + agent.perception if agent.perception else ""
+            ),
+        }
+        tokens = {name: self.count(segment) for name, segment in segments.items()}
+        if agent.token_budget is not None and sum(tokens.values()) > agent.token_budget:
+            segments = self._fit(agent, segments, tokens)
+            tokens = {name: self.count(segment) for name, segment in segments.items()}
+        parts = [segment for segment in segments.values() if segment]
+        prompt = Prompt(
+            text="\n".join(parts),
+            segments={name: len(segment) for name, segment in segments.items()},
+            parts=parts,
+            tokens=tokens,
+        )
+        logger.debug(
+            f"Prompt for agent '{agent.name}': {prompt.segments} chars, {prompt.tokens} tokens"
+        )
+        return prompt
+
+    def _fit(self, agent, segments, tokens):
+        allocation = allocate_budget(agent.token_budget, tokens)
+        # Trimming measures pieces with the local estimator, even when exact
+        # counts are used for the totals.
+        fitted = {
+            "base": keep_head(segments["base"], allocation["base"], estimate_tokens),
+            "memories": keep_head(
+                segments["memories"], allocation["memories"], estimate_tokens
+            ),
+            "perception": "",
+        }
+        room = allocation["perception"] - estimate_tokens(PERCEPTION_HEADER)
+        if agent.perception and room > 0:
+            perception = keep_tail(agent.perception, room, estimate_tokens)
+            if perception:
+                fitted["perception"] = PERCEPTION_HEADER + perception
+        return fitted
+
+    def _cached(self, cache, agent, version, render):
+        cached = cache.get(agent.id)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        segment = render()
+        cache[agent.id] = (version, segment)
+        return segment
+
+    def _base_segment(self, agent):
+        return self._cached(self._base, agent, agent.prompt, lambda: agent.prompt or "")
+
+    def _memory_segment(self, agent):
+        memory_ids = list(agent.memoriesLoaded or [])
+        if not memory_ids:
+            self._memories.pop(agent.id, None)
+            return ""
+        version = (
+            tuple(memory_ids),
+            Memory.objects.filter(id__in=memory_ids).aggregate(
+                count=Count("id"), updated=Max("updated_at")
+            ),
+        )
+        return self._cached(
+            self._memories,
+            agent,
+            version,
+            lambda: self._render_memories(agent, memory_ids),
+        )
+
+    def _render_memories(self, agent, memory_ids):
+        # One query for all of them, in the order they were loaded
+        memories = Memory.objects.only("value").in_bulk(memory_ids)
+        values = []
+        for mem_id in memory_ids:
+            if mem_id in memories:
+                values.append(memories[mem_id].value)
+            else:
+                logger.warning(
+                    f"Warning: Loaded memory ID {mem_id} not found for agent '{agent.name}'."
+                )
+        if not values:
+            return ""
+        return MEMORIES_HEADER + "\n".join(values)
@@ -0,0 +1,224 @@
+import logging
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce, Concat, Mod
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def claim_rows(queryset, claimed_status, batch_size=1, select_related=(), **fields):
+    """
+    Atomically claims up to `batch_size` rows of `queryset` by moving them to
+    `claimed_status` (and setting any extra `fields`, such as a lease), and
+    returns them in queryset order.
+
+    Safe to call from several worker processes at once: a row is only ever
+    handed to one caller. Where the backend supports it (PostgreSQL, MySQL 8)
+    the candidates are locked with SELECT ... FOR UPDATE SKIP LOCKED so that
+    concurrent workers pick disjoint batches. Elsewhere (SQLite) each row is
+    claimed with a conditional UPDATE and only rows whose status actually
+    flipped are returned.
+    """
+    model = queryset.model
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            claimed_ids = list(
+                queryset.select_for_update(skip_locked=True).values_list(
+                    "pk", flat=True
+                )[:batch_size]
+            )
+            if claimed_ids:
+                model.objects.filter(pk__in=claimed_ids).update(
+                    status=claimed_status, **fields
+                )
+    else:
+        claimed_ids = []
+        for pk in list(queryset.values_list("pk", flat=True)[:batch_size]):
+            # Re-applying the queryset filters makes the UPDATE a no-op when
+            # another worker has claimed the row in the meantime.
+            if queryset.filter(pk=pk).update(status=claimed_status, **fields):
+                claimed_ids.append(pk)
+
+    if not claimed_ids:
+        return []
+
+    rows = model.objects.select_related(*select_related).in_bulk(claimed_ids)
+    logger.debug(f"Claimed {len(rows)} {model.__name__} rows as '{claimed_status}'.")
+    return [rows[pk] for pk in claimed_ids if pk in rows]
+
+
+def shard_filter(queryset, shards, shard_id, field="agent_id"):
+    """
+    Restricts `queryset` to the rows routed to shard `shard_id` out of `shards`,
+    using `field % shards`. Routing by agent keeps every agent's rows on a
+    single shard, so one worker per shard preserves their FIFO order.
+    """
+    if shards <= 1:
+        return queryset
+    return queryset.annotate(queue_shard=Mod(field, shards)).filter(
+        queue_shard=shard_id
+    )
+
+
+def pending_commands(shards=1, shard_id=0):
+    """
+    The runnable `CommandQueue` rows of a shard, oldest first. Commands
+    deferred to a later `not_before` are skipped.
+    """
+    from .models import CommandQueue
+    from .scheduler import due
+
+    return shard_filter(
+        due(CommandQueue.objects.filter(status="pending")), shards, shard_id
+    ).order_by("date", "id")
+
+
+def claim_pending_commands(batch_size=1, shards=1, shard_id=0, lease_seconds=60):
+    """
+    Claims the oldest pending `CommandQueue` rows for the calling worker, with
+    a lease of `lease_seconds` after which `recover_expired_commands` hands
+    them back to the queue.
+    """
+    return claim_rows(
+        pending_commands(shards, shard_id),
+        "processing",
+        batch_size=batch_size,
+        select_related=("agent",),
+        lease_expires=timezone.now() + timedelta(seconds=lease_seconds),
+    )
+
+
+class LeaseExpired(Exception):
+    """A worker's lease on a claimed row ran out; another worker may own it."""
+
+
+def owned_command(command_entry):
+    """
+    The row of `command_entry`, as long as the worker that claimed it still
+    owns it. Commands that were never claimed by a worker have no lease.
+    """
+    from .models import CommandQueue
+
+    rows = CommandQueue.objects.filter(pk=command_entry.pk)
+    if command_entry.lease_expires is None:
+        return rows
+    return rows.filter(status="processing", lease_expires=command_entry.lease_expires)
+
+
+def finish_command(command_entry, **fields):
+    """
+    Writes `fields` to a claimed command. Returns False, writing nothing, if
+    the lease ran out and another worker may have taken the command over.
+    """
+    return bool(owned_command(command_entry).update(**fields))
+
+
+def release_commands(command_entries):
+    """
+    Hands claimed commands that were not run back to the queue, leaving out
+    those whose lease ran out in the meantime.
+    """
+    from .models import CommandQueue
+
+    if not command_entries:
+        return 0
+    owned = Q()
+    for command_entry in command_entries:
+        owned |= Q(pk=command_entry.pk, lease_expires=command_entry.lease_expires)
+    return CommandQueue.objects.filter(owned, status="processing").update(
+        status="pending", lease_expires=None
+    )
+
+
+def recover_expired_commands(shards=1, shard_id=0, now=None):
+    """
+    Moves the "processing" commands of a shard whose lease has run out back to
+    "pending", so that the commands of a worker that died are run after all.
+    Returns how many were recovered.
+    """
+    from .models import CommandQueue
+
+    expired = CommandQueue.objects.filter(
+        status="processing", lease_expires__lt=now or timezone.now()
+    )
+    expired_ids = list(
+        shard_filter(expired, shards, shard_id).values_list("pk", flat=True)
+    )
+    # Re-applying the filters skips rows finished in the meantime
+    recovered = expired.filter(pk__in=expired_ids).update(
+        status="pending", lease_expires=None
+    )
+    if recovered:
+        logger.warning(
+            f"Returned {recovered} commands with expired leases to the queue."
+        )
+    return recovered
+
+
+def claimable_llm_requests(now=None):
+    """
+    The `LLMQueue` rows an LLM worker may claim, oldest first: pending ones,
+    and "thinking" ones whose lease has run out because their worker died.
+    """
+    from .models import LLMQueue
+
+    now = now or timezone.now()
+    return LLMQueue.objects.filter(
+        Q(status="pending") | Q(status="thinking", lease_expires__lt=now)
+    ).order_by("date", "id")
+
+
+def claim_llm_requests(batch_size=1, lease_seconds=300):
+    """
+    Claims the oldest claimable `LLMQueue` rows by moving them to "thinking"
+    with a lease of `lease_seconds`. The returned rows carry their lease, which
+    `release_llm_request` uses to make sure the worker still owns them.
+    """
+    now = timezone.now()
+    return claim_rows(
+        claimable_llm_requests(now),
+        "thinking",
+        batch_size=batch_size,
+        select_related=("agent",),
+        lease_expires=now + timedelta(seconds=lease_seconds),
+    )
+
+
+def release_llm_request(llm_request, status, response):
+    """
+    Stores the outcome of a claimed LLM request. Returns False, writing
+    nothing, if the lease ran out and another worker took the request over.
+    """
+    from .models import LLMQueue
+
+    return bool(
+        LLMQueue.objects.filter(
+            pk=llm_request.pk,
+            status="thinking",
+            lease_expires=llm_request.lease_expires,
+        ).update(status=status, response=response, lease_expires=None)
+    )
+
+
+def append_llm_response(llm_request, text, directives_queued=0):
+    """
+    Appends a streamed chunk to the response of a claimed LLM request and
+    counts the directives queued from it. Returns False, writing nothing, if
+    the worker no longer owns the request.
+    """
+    from .models import LLMQueue
+
+    return bool(
+        LLMQueue.objects.filter(
+            pk=llm_request.pk,
+            status="thinking",
+            lease_expires=llm_request.lease_expires,
+        ).update(
+            response=Concat(Coalesce("response", Value("")), Value(text)),
+            directives_queued=F("directives_queued") + directives_queued,
+        )
+    )
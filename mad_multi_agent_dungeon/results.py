@@ -0,0 +1,28 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class CommandResult:
+    """
+    What a command handler did, applied to the database in a single step by
+    `commands.persist_result()`.
+
+    Handlers mutate `command_entry.agent` in memory and list the touched
+    fields in `agent_fields`; perceptions for other agents are collected as
+    unsaved `PerceptionQueue` instances.
+    """
+
+    output: str
+    status: str = "completed"
+    agent_fields: set = field(default_factory=set)
+    perceptions: list = field(default_factory=list)
+
+
+def completed(output, *agent_fields, perceptions=None):
+    return CommandResult(
+        output, "completed", set(agent_fields), list(perceptions or [])
+    )
+
+
+def failed(output):
+    return CommandResult(output, "failed")
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .models import ObjectInstance
+
+logger = logging.getLogger(__name__)
+
+
+class RoomObjectCache:
+    """
+    The object instances in each room, cached in memory for `look` and `use`.
+
+    Saving or deleting an instance in this process clears the cache (see
+    signals); entries also expire after `MAD_OBJECT_CACHE_SECONDS`, which
+    bounds how long changes made by other processes go unseen. It is off
+    unless enabled, as the command worker does; without it every lookup is a
+    query on the (room_id, name_key) index.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.enabled = False
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._rooms = {}  # room id -> (loaded at, [instances ordered by id])
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._rooms = {}
+
+    def names(self, room_id):
+        """The names of the objects in `room_id`, in creation order."""
+        if not self.enabled:
+            return list(
+                ObjectInstance.objects.filter(room_id=room_id)
+                .order_by("id")
+                .values_list("name", flat=True)
+            )
+        return [instance.name for instance in self._objects(room_id)]
+
+    def find(self, room_id, name):
+        """The first object in `room_id` called `name`, ignoring case, or None."""
+        name_key = name.lower()
+        if not self.enabled:
+            return (
+                ObjectInstance.objects.filter(room_id=room_id, name_key=name_key)
+                .order_by("id")
+                .first()
+            )
+        return next(
+            (
+                instance
+                for instance in self._objects(room_id)
+                if instance.name_key == name_key
+            ),
+            None,
+        )
+
+    def _objects(self, room_id):
+        now = self._clock()
+        with self._lock:
+            cached = self._rooms.get(room_id)
+        if cached is not None and now - cached[0] < settings.MAD_OBJECT_CACHE_SECONDS:
+            return cached[1]
+        instances = list(ObjectInstance.objects.filter(room_id=room_id).order_by("id"))
+        with self._lock:
+            self._rooms[room_id] = (now, instances)
+        return instances
+
+
+room_objects = RoomObjectCache()
@@ -0,0 +1,63 @@
+import logging
+
+from django.db.models import Min, Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Agent flags that put an agent to sleep until the ISO timestamp they hold.
+DEFERRING_FLAGS = ("waiting", "meditating")
+
+
+def due(queryset, now=None):
+    """
+    Restricts `queryset` to rows whose `not_before` has passed (or is unset).
+    `not_before` is indexed, so deferred rows cost nothing until they are due.
+    """
+    now = now or timezone.now()
+    return queryset.filter(Q(not_before__isnull=True) | Q(not_before__lte=now))
+
+
+def seconds_until_next_due(queryset, now=None):
+    """
+    Returns how long until the earliest deferred row in `queryset` becomes due,
+    or None when nothing is scheduled. Daemons use it to cap their idle wait.
+    """
+    now = now or timezone.now()
+    next_due = queryset.filter(not_before__gt=now).aggregate(
+        next_due=Min("not_before")
+    )["next_due"]
+    if next_due is None:
+        return None
+    return max((next_due - now).total_seconds(), 0)
+
+
+def defer_agent(agent, flag, until):
+    """
+    Puts `agent` to sleep until `until` because of `flag` ("waiting" or
+    "meditating"). The flag keeps the human-readable deadline, while
+    `not_before` is what the daemons actually schedule on. The caller saves.
+    """
+    agent.flags = agent.flags or {}
+    agent.flags[flag] = until.isoformat()
+    if agent.not_before is None or agent.not_before < until:
+        agent.not_before = until
+
+
+def resume_if_due(agent, now=None):
+    """
+    Returns True if `agent` may run now. When its deadline has passed, the
+    deferring flags and `not_before` are cleared on the instance (and the
+    caller is expected to save). Returns False while the agent is still
+    asleep.
+    """
+    if agent.not_before is None:
+        return True
+    now = now or timezone.now()
+    if agent.not_before > now:
+        return False
+    for flag in DEFERRING_FLAGS:
+        if agent.flags and agent.flags.pop(flag, None):
+            logger.info(f"Agent {agent.name} has finished {flag}.")
+    agent.not_before = None
+    return True
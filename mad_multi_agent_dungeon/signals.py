@@ -0,0 +1,72 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import doorbell
+from .models import (
+    Agent,
+    CommandQueue,
+    LLMQueue,
+    Memory,
+    ObjectInstance,
+    PerceptionQueue,
+)
+from .room_objects import room_objects
+from .triggers import trigger_engine
+
+
+@receiver(post_save, sender=CommandQueue)
+def wake_command_worker(sender, instance, created, **kwargs):
+    # Only new rows: a deferred command saved back to "pending" must not wake
+    # the worker that just deferred it.
+    if created and instance.status == "pending":
+        doorbell.ring_on_commit(doorbell.COMMANDS)
+
+
+@receiver(post_save, sender=PerceptionQueue)
+def wake_agent_app_on_perception(sender, instance, created, **kwargs):
+    if created:
+        doorbell.ring_on_commit(doorbell.AGENTS)
+
+
+@receiver(post_save, sender=LLMQueue)
+def wake_agent_app_on_llm_update(sender, instance, **kwargs):
+    if instance.status in ("pending", "completed"):
+        doorbell.ring_on_commit(doorbell.AGENTS)
+    if instance.status == "pending":
+        doorbell.ring_on_commit(doorbell.LLM)
+
+
+@receiver(post_save, sender=Agent)
+def wake_agent_app_on_start(sender, instance, update_fields=None, **kwargs):
+    # Saves that may have (re)started the agent, e.g. from the dashboard or the
+    # admin. Agent writes of the daemons name their fields and leave it out.
+    if instance.is_running and (update_fields is None or "is_running" in update_fields):
+        doorbell.ring_on_commit(doorbell.AGENTS)
+
+
+@receiver(post_delete, sender=Memory)
+def unload_deleted_memory(sender, instance, **kwargs):
+    # Loaded memory ids are kept in a JSON list, which the database can't
+    # cascade into. Memories are only ever loaded by the agent they belong to.
+    with transaction.atomic():
+        agent = (
+            Agent.objects.select_for_update()
+            .only("id", "memoriesLoaded")
+            .filter(pk=instance.agent_id)
+            .first()
+        )
+        if agent is not None and instance.id in (agent.memoriesLoaded or []):
+            Agent.objects.filter(pk=agent.pk).update(
+                memoriesLoaded=[
+                    mem_id for mem_id in agent.memoriesLoaded if mem_id != instance.id
+                ]
+            )
+
+
+@receiver(post_save, sender=ObjectInstance)
+@receiver(post_delete, sender=ObjectInstance)
+def clear_object_caches(sender, instance, **kwargs):
+    # An instance may have moved between rooms, so drop every room
+    room_objects.clear()
+    trigger_engine.clear_instances()
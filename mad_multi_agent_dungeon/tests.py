@@ -14,9 +14,11 @@ from mad_multi_agent_dungeon.models import (
     LLMAPIKey,
 )
 from mad_multi_agent_dungeon.llm_api import call_gemini_api
-from unittest.mock import patch
+from mad_multi_agent_dungeon.scheduler import defer_agent
+from mad_multi_agent_dungeon.world import world
+from unittest.mock import MagicMock, patch
 
-from mad_multi_agent_dungeon.commands import handle_command, MAP_DATA, OBJECT_DATA
+from mad_multi_agent_dungeon.commands import handle_command
 from mad_multi_agent_dungeon.management.commands.run_command_worker import (
     Command as CommandWorker,
 )
@@ -182,7 +184,9 @@ class CommandQueueModelTest(TestCase):
 class AgentAppIntegrationTest(TestCase):
     def setUp(self):
         self.agent_name = "TestAgent"
-        self.prompt_dir = Path("/home/edward/Desktop/mad-django/prompts")
+        from django.conf import settings
+
+        self.prompt_dir = Path(settings.BASE_DIR) / "prompts"
         self.prompt_file = self.prompt_dir / f"{self.agent_name}.md"
 
         # Ensure a clean state for the agent and prompt file
@@ -343,11 +347,26 @@ class AgentAppIntegrationTest(TestCase):
         self.agent = Agent.objects.get(pk=self.agent.pk)  # Re-fetch agent
         llm_entry.refresh_from_db()  # Re-fetch llm_entry
 
-        # Assert agent's perception is truncated to the custom limit
+        # Assert agent's perception is truncated to the custom limit; a
+        # single line too long for it is the only thing cut mid-line
         self.assertEqual(len(self.agent.perception), self.agent.perception_limit)
-        # Account for "LLM: " prefix (4 characters) when checking content
-        expected_content = "LLM: " + long_response[-(self.agent.perception_limit - 5):]
-        self.assertEqual(self.agent.perception, expected_content)
+        self.assertEqual(
+            self.agent.perception, long_response[-self.agent.perception_limit :]
+        )
+
+        # Longer responses lose whole lines from their start
+        lines = [f"Line {i}: " + "b" * 90 for i in range(20)]
+        LLMQueue.objects.create(
+            agent=self.agent,
+            prompt="Test prompt for truncation",
+            response="\n".join(lines),
+            status="completed",
+        )
+        agent_app_command._process_agent_cycle(self.agent)
+        self.agent = Agent.objects.get(pk=self.agent.pk)
+
+        self.assertLessEqual(len(self.agent.perception), self.agent.perception_limit)
+        self.assertEqual(self.agent.perception, "\n".join(lines[-10:]))
 
     def test_reset_agent_memory_api(self):
         # Ensure a clean slate for memories before this test
@@ -389,31 +408,15 @@ class CommandHandlerTest(TestCase):
         self._setup_map_data()
 
     def _setup_map_data(self):
-        # Clear and reload MAP_DATA and OBJECT_DATA for each test
-        MAP_DATA["rooms"].clear()
-        OBJECT_DATA.clear()
-
-        # Load original data from files
-        MAP_DATA.update(
-            json.loads(
-                Path(
-                    "/home/edward/Desktop/mad-django/mad_multi_agent_dungeon/data/map.json"
-                ).read_text()
-            )
-        )
-        OBJECT_DATA.update(
-            json.loads(
-                Path(
-                    "/home/edward/Desktop/mad-django/mad_multi_agent_dungeon/data/objects.json"
-                ).read_text()
-            )
-        )
+        # Load the original data from the world data files for each test
+        map_data = json.loads((world.data_dir / "map.json").read_text())
+        object_data = json.loads((world.data_dir / "objects.json").read_text())
 
         # Add dummy room for testing purposes
         dummy_room_id = "dummy_room_001"
         dummy_room_title = "A Test Room"
         dummy_room_description = "This is a room for testing the look command."
-        MAP_DATA["rooms"][dummy_room_id] = {
+        map_data["rooms"][dummy_room_id] = {
             "title": dummy_room_title,
             "description": dummy_room_description,
             "exits": {},
@@ -456,32 +459,32 @@ class CommandHandlerTest(TestCase):
         room_f_description = "This is room F."
         room_f_exits = {"down": "room_A"}
 
-        MAP_DATA["rooms"][room_a_id] = {
+        map_data["rooms"][room_a_id] = {
             "title": room_a_title,
             "description": room_a_description,
             "exits": room_a_exits,
         }
-        MAP_DATA["rooms"][room_b_id] = {
+        map_data["rooms"][room_b_id] = {
             "title": room_b_title,
             "description": room_b_description,
             "exits": room_b_exits,
         }
-        MAP_DATA["rooms"][room_c_id] = {
+        map_data["rooms"][room_c_id] = {
             "title": room_c_title,
             "description": room_c_description,
             "exits": room_c_exits,
         }
-        MAP_DATA["rooms"][room_d_id] = {
+        map_data["rooms"][room_d_id] = {
             "title": room_d_title,
             "description": room_d_description,
             "exits": room_d_exits,
         }
-        MAP_DATA["rooms"][room_e_id] = {
+        map_data["rooms"][room_e_id] = {
             "title": room_e_title,
             "description": room_e_description,
             "exits": room_e_exits,
         }
-        MAP_DATA["rooms"][room_f_id] = {
+        map_data["rooms"][room_f_id] = {
             "title": room_f_title,
             "description": room_f_description,
             "exits": room_f_exits,
@@ -489,7 +492,7 @@ class CommandHandlerTest(TestCase):
 
         # Add room with item for examine test
         room_with_item_id = "room_with_item"
-        MAP_DATA["rooms"][room_with_item_id] = {
+        map_data["rooms"][room_with_item_id] = {
             "title": "Room with Item",
             "description": "A room containing a sword.",
             "exits": {},
@@ -500,15 +503,15 @@ class CommandHandlerTest(TestCase):
                 }
             },
         }
-        # Ensure dummy_sword is in OBJECT_DATA for examine test
-        OBJECT_DATA["dummy_sword"] = {
+        # Ensure dummy_sword is in object_data for examine test
+        object_data["dummy_sword"] = {
             "name": "dummy_sword",
             "description": "A sharp, well-balanced sword.",
         }
 
         # Add room with mirror for use test
         room_with_mirror_id = "room_with_mirror"
-        MAP_DATA["rooms"][room_with_mirror_id] = {
+        map_data["rooms"][room_with_mirror_id] = {
             "title": "Room with Mirror",
             "description": "A room with a magical mirror.",
             "exits": {},
@@ -525,8 +528,8 @@ class CommandHandlerTest(TestCase):
                 }
             },
         }
-        # Ensure mirror_001 is in OBJECT_DATA for use test
-        OBJECT_DATA["mirror_001"] = {
+        # Ensure mirror_001 is in object_data for use test
+        object_data["mirror_001"] = {
             "name": "mirror",
             "description": "A shimmering mirror.",
             "triggers": {
@@ -536,6 +539,7 @@ class CommandHandlerTest(TestCase):
                 }
             },
         }
+        world.load(map_data, object_data)
 
     def test_ping_command_handler(self):
         command_entry = CommandQueue.objects.create(
@@ -683,7 +687,7 @@ class CommandHandlerTest(TestCase):
     def test_examine_command_handler(self):
         self.agent.location = "room_with_item"
         self.agent.save()
-        dummy_item_data = OBJECT_DATA["dummy_sword"]
+        dummy_item_data = world.objects["dummy_sword"]
 
         command_entry_examine_item = CommandQueue.objects.create(
             command="examine dummy_sword", agent=self.agent, status="pending", output=""
@@ -815,13 +819,8 @@ class CommandHandlerTest(TestCase):
     def test_use_command_handler(self):
         from .models import ObjectInstance
         import json
-        from pathlib import Path
 
-        object_data = json.loads(
-            Path(
-                "/home/edward/Desktop/mad-django/mad_multi_agent_dungeon/data/objects.json"
-            ).read_text()
-        )
+        object_data = json.loads((world.data_dir / "objects.json").read_text())
 
         self.agent.location = "room_with_mirror"
         self.agent.save()
@@ -1538,9 +1537,18 @@ class LLMAPIKeyModelTest(TestCase):
 
 
 class LLMAPITest(TestCase):
+    def setUp(self):
+        from mad_multi_agent_dungeon.llm_api import clear_client_cache
+
+        clear_client_cache()
+        self.addCleanup(clear_client_cache)
+
+    @patch("mad_multi_agent_dungeon.llm_api.glm.GenerativeServiceClient")
     @patch("mad_multi_agent_dungeon.llm_api.genai.GenerativeModel")
     @patch("mad_multi_agent_dungeon.llm_api.genai.configure")
-    def test_call_gemini_api_success(self, mock_configure, mock_generative_model):
+    def test_call_gemini_api_success(
+        self, mock_configure, mock_generative_model, mock_client
+    ):
         # Arrange
         mock_model_instance = mock_generative_model.return_value
         mock_model_instance.generate_content.return_value.text = "Mocked LLM Response"
@@ -1553,14 +1561,21 @@ class LLMAPITest(TestCase):
         response = call_gemini_api(prompt, api_key, parameters)
 
         # Assert
-        mock_configure.assert_called_once_with(api_key=api_key)
-        mock_generative_model.assert_called_once_with("gemini-1.5-flash")
-        mock_model_instance.generate_content.assert_called_once()
+        # The key goes to a dedicated client instead of genai's global state
+        mock_configure.assert_not_called()
+        mock_client.assert_called_once_with(client_options={"api_key": api_key})
+        mock_generative_model.assert_called_once()
+        self.assertEqual(mock_generative_model.call_args.args, ("gemini-1.5-flash",))
+        self.assertIs(mock_model_instance._client, mock_client.return_value)
+        mock_model_instance.generate_content.assert_called_once_with(prompt)
         self.assertEqual(response, "Mocked LLM Response")
 
+    @patch("mad_multi_agent_dungeon.llm_api.glm.GenerativeServiceClient")
     @patch("mad_multi_agent_dungeon.llm_api.genai.GenerativeModel")
     @patch("mad_multi_agent_dungeon.llm_api.genai.configure")
-    def test_call_gemini_api_failure(self, mock_configure, mock_generative_model):
+    def test_call_gemini_api_failure(
+        self, mock_configure, mock_generative_model, mock_client
+    ):
         # Arrange
         mock_model_instance = mock_generative_model.return_value
         mock_model_instance.generate_content.side_effect = Exception("API Error")
@@ -1573,6 +1588,36 @@ class LLMAPITest(TestCase):
             call_gemini_api(prompt, api_key)
         self.assertTrue("API Error" in str(context.exception))
 
+    @patch("mad_multi_agent_dungeon.llm_api.glm.GenerativeServiceClient")
+    @patch("mad_multi_agent_dungeon.llm_api.genai.GenerativeModel")
+    def test_clients_and_models_are_reused(self, mock_generative_model, mock_client):
+        mock_generative_model.side_effect = lambda *args, **kwargs: MagicMock()
+
+        call_gemini_api("First", "key_a", {"temperature": 0.5})
+        call_gemini_api("Second", "key_a", {"temperature": 0.5})
+        call_gemini_api("Third", "key_a", {"temperature": 0.9})
+        call_gemini_api("Fourth", "key_b", {"temperature": 0.5})
+
+        # One client per key, one model per (key, model, generation config)
+        self.assertEqual(mock_client.call_count, 2)
+        self.assertEqual(mock_generative_model.call_count, 3)
+
+    @patch("mad_multi_agent_dungeon.llm_api.glm.GenerativeServiceClient")
+    @patch("mad_multi_agent_dungeon.llm_api.genai.GenerativeModel")
+    def test_warm_up_opens_the_connection_once(
+        self, mock_generative_model, mock_client
+    ):
+        from mad_multi_agent_dungeon.llm_api import warm_up
+
+        self.assertTrue(warm_up("warm_key"))
+        mock_generative_model.return_value.count_tokens.assert_called_once()
+
+        call_gemini_api("Hello", "warm_key")
+        mock_client.assert_called_once()
+
+        mock_generative_model.return_value.count_tokens.side_effect = Exception("Down")
+        self.assertFalse(warm_up("warm_key"))
+
     def test_agent_is_running_halting_mechanism(self):
         from mad_multi_agent_dungeon.management.commands.run_agent_app import (
             Command as AgentAppCommand,
@@ -1611,3 +1656,1938 @@ class LLMAPITest(TestCase):
         agent.refresh_from_db()
         self.assertEqual(agent.phase, "thinking")
         self.assertTrue(LLMQueue.objects.filter(agent=agent).exists())
+
+
+class CommandQueueClaimTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            name="ClaimAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+        )
+
+    def test_claim_returns_oldest_pending_batch_in_order(self):
+        from mad_multi_agent_dungeon.queues import claim_pending_commands
+
+        commands = [
+            CommandQueue.objects.create(command=f"ping {i}", agent=self.agent)
+            for i in range(5)
+        ]
+        CommandQueue.objects.create(
+            command="already done", agent=self.agent, status="completed"
+        )
+
+        claimed = claim_pending_commands(batch_size=3)
+
+        self.assertEqual([c.id for c in claimed], [c.id for c in commands[:3]])
+        for command_entry in claimed:
+            self.assertEqual(command_entry.status, "processing")
+        self.assertEqual(
+            CommandQueue.objects.filter(status="pending").count(), 2
+        )
+
+    def test_claims_never_overlap(self):
+        from mad_multi_agent_dungeon.queues import claim_pending_commands
+
+        for i in range(4):
+            CommandQueue.objects.create(command=f"ping {i}", agent=self.agent)
+
+        first = claim_pending_commands(batch_size=3)
+        second = claim_pending_commands(batch_size=3)
+        third = claim_pending_commands(batch_size=3)
+
+        first_ids = {c.id for c in first}
+        second_ids = {c.id for c in second}
+        self.assertEqual(len(first_ids), 3)
+        self.assertEqual(len(second_ids), 1)
+        self.assertFalse(first_ids & second_ids)
+        self.assertEqual(third, [])
+
+    def test_row_claimed_elsewhere_is_skipped(self):
+        from mad_multi_agent_dungeon.queues import claim_rows
+
+        command_entry = CommandQueue.objects.create(command="ping", agent=self.agent)
+        pending = CommandQueue.objects.filter(status="pending")
+        # Another worker flips the row after our candidate query was built.
+        CommandQueue.objects.filter(pk=command_entry.pk).update(status="processing")
+
+        self.assertEqual(claim_rows(pending, "processing"), [])
+
+    def test_later_commands_in_a_batch_see_earlier_moves(self):
+        self.agent.location = "room_001"
+        self.agent.save()
+        for command in ("go north", "look", "go east"):
+            CommandQueue.objects.create(command=command, agent=self.agent)
+
+        self.assertEqual(CommandWorker()._process_batch(batch_size=10), 3)
+
+        go_north, look, go_east = CommandQueue.objects.order_by("id")
+        self.assertIn("Console room", look.output)
+        self.assertEqual(go_east.status, "completed")
+        self.agent.refresh_from_db()
+        self.assertEqual(self.agent.location, "room_003")
+
+    def test_interrupted_batch_hands_unrun_commands_back(self):
+        commands = [
+            CommandQueue.objects.create(command="ping", agent=self.agent)
+            for _ in range(3)
+        ]
+        worker = CommandWorker()
+        process_single_command = worker._process_single_command
+
+        def interrupted_after_first(command_entry):
+            if command_entry.pk != commands[0].pk:
+                raise KeyboardInterrupt
+            return process_single_command(command_entry)
+
+        worker._process_single_command = interrupted_after_first
+        with self.assertRaises(KeyboardInterrupt):
+            worker._process_batch(batch_size=10)
+
+        self.assertEqual(
+            list(CommandQueue.objects.order_by("id").values_list("status", flat=True)),
+            ["completed", "pending", "pending"],
+        )
+
+    def test_commands_with_expired_leases_are_recovered(self):
+        from mad_multi_agent_dungeon.queues import (
+            claim_pending_commands,
+            recover_expired_commands,
+        )
+
+        command_entry = CommandQueue.objects.create(command="ping", agent=self.agent)
+        claim_pending_commands(batch_size=1, lease_seconds=60)
+
+        self.assertEqual(recover_expired_commands(), 0)
+        later = timezone.now() + timedelta(seconds=61)
+        self.assertEqual(recover_expired_commands(now=later), 1)
+
+        command_entry.refresh_from_db()
+        self.assertEqual(command_entry.status, "pending")
+        self.assertIsNone(command_entry.lease_expires)
+        self.assertEqual(CommandWorker()._process_batch(batch_size=10), 1)
+
+    def test_result_of_a_command_taken_over_is_dropped(self):
+        from mad_multi_agent_dungeon.queues import (
+            claim_pending_commands,
+            recover_expired_commands,
+        )
+
+        CommandQueue.objects.create(command="ping", agent=self.agent)
+        (slow,) = claim_pending_commands(batch_size=1, lease_seconds=60)
+        # Another worker recovers and claims the command once the lease is over
+        recover_expired_commands(now=timezone.now() + timedelta(seconds=61))
+        (taken_over,) = claim_pending_commands(batch_size=1, lease_seconds=60)
+
+        CommandWorker()._process_single_command(slow)
+
+        command_entry = CommandQueue.objects.get()
+        self.assertEqual(command_entry.status, "processing")
+        self.assertEqual(command_entry.lease_expires, taken_over.lease_expires)
+        self.assertEqual(command_entry.output, "")
+        self.assertFalse(PerceptionQueue.objects.exists())
+
+    def test_worker_batch_processes_all_claimed_commands(self):
+        for _ in range(3):
+            CommandQueue.objects.create(command="ping", agent=self.agent)
+
+        processed = CommandWorker()._process_batch(batch_size=10)
+
+        self.assertEqual(processed, 3)
+        self.assertEqual(
+            CommandQueue.objects.filter(status="completed", output="pong").count(), 3
+        )
+        self.assertEqual(
+            PerceptionQueue.objects.filter(agent=self.agent, type="command").count(),
+            3,
+        )
+
+
+class CommandWorkerShardingTest(TestCase):
+    def setUp(self):
+        self.agents = [
+            Agent.objects.create(
+                name=f"ShardAgent{i}",
+                look="",
+                description="",
+                tokens=0,
+                level=0,
+                location="test_room",
+            )
+            for i in range(4)
+        ]
+
+    def test_shards_partition_commands_by_agent(self):
+        from mad_multi_agent_dungeon.queues import claim_pending_commands
+
+        for agent in self.agents:
+            CommandQueue.objects.create(command="ping", agent=agent)
+            CommandQueue.objects.create(command="look", agent=agent)
+
+        claimed_by_shard = [
+            claim_pending_commands(batch_size=10, shards=2, shard_id=shard_id)
+            for shard_id in range(2)
+        ]
+
+        for shard_id, claimed in enumerate(claimed_by_shard):
+            self.assertTrue(claimed)
+            for command_entry in claimed:
+                self.assertEqual(command_entry.agent_id % 2, shard_id)
+        self.assertEqual(sum(len(claimed) for claimed in claimed_by_shard), 8)
+        self.assertFalse(CommandQueue.objects.filter(status="pending").exists())
+
+    def test_shard_keeps_agent_fifo_order(self):
+        from mad_multi_agent_dungeon.queues import claim_pending_commands
+
+        agent = self.agents[0]
+        commands = [
+            CommandQueue.objects.create(command=f"ping {i}", agent=agent)
+            for i in range(3)
+        ]
+
+        claimed = claim_pending_commands(
+            batch_size=10, shards=3, shard_id=agent.id % 3
+        )
+
+        self.assertEqual([c.id for c in claimed], [c.id for c in commands])
+
+    def test_deferred_command_holds_back_later_commands_of_same_agent(self):
+        waiting_agent, other_agent = self.agents[:2]
+        defer_agent(waiting_agent, "waiting", timezone.now() + timedelta(minutes=5))
+        waiting_agent.save()
+        first = CommandQueue.objects.create(command="go north", agent=waiting_agent)
+        second = CommandQueue.objects.create(command="look", agent=waiting_agent)
+        unrelated = CommandQueue.objects.create(command="ping", agent=other_agent)
+
+        processed = CommandWorker()._process_batch(batch_size=10)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        unrelated.refresh_from_db()
+        self.assertEqual(processed, 1)
+        self.assertEqual(first.status, "pending")
+        self.assertEqual(second.status, "pending")
+        self.assertEqual(unrelated.status, "completed")
+
+
+class DoorbellTest(TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        settings_override = self.settings(MAD_DOORBELL_DIR=self.tmp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_ring_wakes_waiting_listener(self):
+        from mad_multi_agent_dungeon.doorbell import Doorbell, ring
+
+        with Doorbell("test") as bell:
+            ring("test")
+            ring("test")  # Rings are coalesced into a single wake-up
+            started = timezone.now()
+            self.assertTrue(bell.wait(5))
+            self.assertLess((timezone.now() - started).total_seconds(), 1)
+            self.assertFalse(bell.wait(0.01))
+
+    def test_wait_times_out_without_ring(self):
+        from mad_multi_agent_dungeon.doorbell import Doorbell, ring
+
+        with Doorbell("test") as bell:
+            ring("other_channel")
+            self.assertFalse(bell.wait(0.05))
+
+    def test_ring_removes_stale_sockets(self):
+        from mad_multi_agent_dungeon.doorbell import Doorbell, ring
+
+        bell = Doorbell("test")
+        bell._sock.close()  # Simulate a crashed listener leaving its socket file
+        self.assertTrue(bell.path.exists())
+
+        ring("test")
+
+        self.assertFalse(bell.path.exists())
+
+    @patch("mad_multi_agent_dungeon.doorbell.ring")
+    def test_queue_writes_ring_the_right_daemon(self, mock_ring):
+        agent = Agent.objects.create(
+            name="DoorbellAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            command_entry = CommandQueue.objects.create(command="ping", agent=agent)
+        mock_ring.assert_called_once_with("commands")
+
+        mock_ring.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            PerceptionQueue.objects.create(agent=agent, text="Hello")
+        mock_ring.assert_called_once_with("agents")
+
+        mock_ring.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            LLMQueue.objects.create(agent=agent, prompt="Prompt")
+        self.assertEqual(
+            sorted(call.args[0] for call in mock_ring.call_args_list), ["agents", "llm"]
+        )
+
+        # Deferring a command back to pending must not wake the worker again
+        mock_ring.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            command_entry.save()
+        mock_ring.assert_not_called()
+
+        # Starting an agent from the dashboard wakes the agent app
+        agent.is_running = False
+        agent.save()
+        mock_ring.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse("start_agent", args=[agent.name]))
+        mock_ring.assert_called_once_with("agents")
+
+        # Other agent writes don't
+        mock_ring.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            agent.save(update_fields=["location"])
+        mock_ring.assert_not_called()
+
+
+class DeferredSchedulingTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            name="SleepyAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+            perception="",
+        )
+
+    def test_wait_and_meditate_schedule_the_agent(self):
+        for command_text, flag in (("wait 15s", "waiting"), ("meditate 5m", "meditating")):
+            command_entry = CommandQueue.objects.create(
+                command=command_text, agent=self.agent
+            )
+            handle_command(command_entry)
+            self.agent.refresh_from_db()
+            self.assertIn(flag, self.agent.flags)
+            self.assertGreater(self.agent.not_before, timezone.now())
+
+    def test_commands_of_sleeping_agent_are_deferred_until_due(self):
+        from mad_multi_agent_dungeon.queues import claim_pending_commands
+
+        wake_at = timezone.now() + timedelta(minutes=5)
+        defer_agent(self.agent, "meditating", wake_at)
+        self.agent.save()
+        first = CommandQueue.objects.create(command="look", agent=self.agent)
+        second = CommandQueue.objects.create(command="ping", agent=self.agent)
+
+        self.assertEqual(CommandWorker()._process_batch(batch_size=1), 0)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.status, "pending")
+        self.assertEqual(first.not_before, wake_at)
+        self.assertEqual(second.not_before, wake_at)
+        # Deferred rows are invisible to the claim query until they are due
+        self.assertEqual(claim_pending_commands(batch_size=10), [])
+
+    def test_due_command_runs_and_clears_sleep_flags(self):
+        past = timezone.now() - timedelta(seconds=1)
+        defer_agent(self.agent, "waiting", past)
+        self.agent.save()
+        command_entry = CommandQueue.objects.create(
+            command="ping", agent=self.agent, not_before=past
+        )
+
+        self.assertEqual(CommandWorker()._process_batch(batch_size=10), 1)
+
+        command_entry.refresh_from_db()
+        self.agent.refresh_from_db()
+        self.assertEqual(command_entry.status, "completed")
+        self.assertNotIn("waiting", self.agent.flags)
+        self.assertIsNone(self.agent.not_before)
+
+    def test_next_due_reports_earliest_deadline(self):
+        from mad_multi_agent_dungeon.scheduler import seconds_until_next_due
+
+        self.assertIsNone(seconds_until_next_due(Agent.objects.all()))
+        defer_agent(self.agent, "waiting", timezone.now() + timedelta(seconds=30))
+        self.agent.save()
+
+        self.assertAlmostEqual(
+            seconds_until_next_due(Agent.objects.all()), 30, delta=2
+        )
+
+    def test_agent_app_skips_sleeping_agent_until_due(self):
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        agent_app_command = AgentAppCommand()
+        defer_agent(self.agent, "meditating", timezone.now() + timedelta(minutes=5))
+        self.agent.save()
+
+        agent_app_command._process_agent_cycle(self.agent)
+        self.assertFalse(LLMQueue.objects.filter(agent=self.agent).exists())
+
+        self.agent.not_before = timezone.now() - timedelta(seconds=1)
+        self.agent.save()
+        agent_app_command._process_agent_cycle(self.agent)
+
+        self.agent.refresh_from_db()
+        self.assertTrue(LLMQueue.objects.filter(agent=self.agent).exists())
+        self.assertNotIn("meditating", self.agent.flags)
+        self.assertIsNone(self.agent.not_before)
+
+
+    def test_waking_agent_keeps_moves_of_its_deferred_commands(self):
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        defer_agent(self.agent, "waiting", timezone.now() - timedelta(seconds=1))
+        self.agent.save()
+        # The command worker runs a deferred move while the tick holds a
+        # snapshot of the agent
+        Agent.objects.filter(pk=self.agent.pk).update(
+            location="elsewhere", inventory=["Gem"]
+        )
+
+        AgentAppCommand()._process_agent_cycle(self.agent)
+
+        self.agent.refresh_from_db()
+        self.assertIsNone(self.agent.not_before)
+        self.assertEqual(self.agent.location, "elsewhere")
+        self.assertEqual(self.agent.inventory, ["Gem"])
+
+class PerceptionFanoutTest(TestCase):
+    def setUp(self):
+        self.speaker = Agent.objects.create(
+            name="Speaker",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="crowded_room",
+            last_command_sent=timezone.now(),
+        )
+
+    def _add_listeners(self, count, **kwargs):
+        kwargs.setdefault("location", "crowded_room")
+        kwargs.setdefault("last_command_sent", timezone.now())
+        Agent.objects.bulk_create(
+            [
+                Agent(
+                    name=f"Listener{Agent.objects.count()}_{i}",
+                    look="",
+                    description="",
+                    **kwargs,
+                )
+                for i in range(count)
+            ]
+        )
+
+    def test_broadcast_reaches_only_active_agents_in_room(self):
+        from mad_multi_agent_dungeon.fanout import broadcast_to_room
+
+        self._add_listeners(3)
+        self._add_listeners(
+            2, last_command_sent=timezone.now() - timedelta(minutes=6)
+        )
+        self._add_listeners(2, location="quiet_room")
+
+        reached = broadcast_to_room("crowded_room", "Hello", source_agent=self.speaker)
+
+        self.assertEqual(reached, 3)
+        perceptions = PerceptionQueue.objects.filter(text="Hello")
+        self.assertEqual(perceptions.count(), 3)
+        self.assertFalse(perceptions.filter(agent=self.speaker).exists())
+        for perception in perceptions:
+            self.assertTrue(perception.agent.is_active())
+            self.assertEqual(perception.agent.location, "crowded_room")
+            self.assertEqual(perception.source_agent, self.speaker)
+
+    def test_broadcast_cost_does_not_grow_with_listeners(self):
+        from mad_multi_agent_dungeon.fanout import broadcast_to_room
+
+        self._add_listeners(2)
+        with self.assertNumQueries(2):
+            broadcast_to_room("crowded_room", "Few", source_agent=self.speaker)
+
+        # Stays below SQLite's per-statement variable limit, beyond which
+        # bulk_create splits the INSERT into fixed-size batches.
+        self._add_listeners(100)
+        with self.assertNumQueries(2):
+            broadcast_to_room("crowded_room", "Many", source_agent=self.speaker)
+        self.assertEqual(PerceptionQueue.objects.filter(text="Many").count(), 102)
+
+    def test_say_uses_single_bulk_insert(self):
+        self._add_listeners(50)
+        command_entry = CommandQueue.objects.create(
+            command="say hi", agent=self.speaker
+        )
+
+        handle_command(command_entry)
+
+        self.assertEqual(
+            PerceptionQueue.objects.filter(text='Speaker says: "hi"').count(), 50
+        )
+
+
+class CommandPersistenceTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            name="WriterAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+        )
+
+    def _writes_while(self, func, *args):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as context:
+            func(*args)
+        return [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+        ]
+
+    def test_handlers_return_results_without_writing(self):
+        from mad_multi_agent_dungeon.commands import execute_command
+        from mad_multi_agent_dungeon.results import CommandResult
+
+        command_entry = CommandQueue.objects.create(
+            command="edit profile look a quiet figure", agent=self.agent
+        )
+
+        result = None
+
+        def run():
+            nonlocal result
+            result = execute_command(command_entry)
+
+        writes = self._writes_while(run)
+
+        self.assertEqual(writes, [])
+        self.assertIsInstance(result, CommandResult)
+        self.assertEqual(result.status, "completed")
+        self.assertEqual(result.agent_fields, {"look", "last_command_sent"})
+
+    def test_worker_writes_each_row_once_per_command(self):
+        command_entry = CommandQueue.objects.create(
+            command="ping", agent=self.agent, status="processing"
+        )
+
+        writes = self._writes_while(
+            CommandWorker()._process_single_command, command_entry
+        )
+
+        # The command row, the agent row and the commanding agent's perception
+        self.assertEqual(len(writes), 3)
+        command_entry.refresh_from_db()
+        self.agent.refresh_from_db()
+        self.assertEqual(command_entry.status, "completed")
+        self.assertEqual(command_entry.output, "pong")
+        self.assertIsNotNone(self.agent.last_command_sent)
+        self.assertTrue(
+            PerceptionQueue.objects.filter(
+                agent=self.agent, type="command", command=command_entry
+            ).exists()
+        )
+
+    def test_update_fields_leave_other_agent_columns_alone(self):
+        command_entry = CommandQueue.objects.create(
+            command="go north", agent=self.agent, status="processing"
+        )
+        # Simulate another process changing the agent after it was loaded
+        Agent.objects.filter(pk=self.agent.pk).update(
+            perception_snapshot="Fresh perception"
+        )
+
+        CommandWorker()._process_single_command(command_entry)
+
+        self.agent.refresh_from_db()
+        self.assertEqual(self.agent.perception, "Fresh perception")
+
+
+class HotQueryIndexTest(TestCase):
+    def test_hot_queries_are_index_backed(self):
+        from mad_multi_agent_dungeon.checks import unindexed_hot_queries
+
+        # Fails with the offending query plans if a model change drops an index
+        self.assertEqual(unindexed_hot_queries(), [])
+
+    def test_full_table_scans_are_reported(self):
+        from mad_multi_agent_dungeon import checks
+
+        unindexed_query = (
+            "perceptions by text",
+            PerceptionQueue.objects.filter(text="x"),
+        )
+        with patch.object(checks, "hot_queries", return_value=[unindexed_query]):
+            unindexed = checks.unindexed_hot_queries()
+
+        self.assertEqual(
+            [label for label, plan in unindexed], ["perceptions by text"]
+        )
+
+    def test_system_check_passes(self):
+        from mad_multi_agent_dungeon.checks import check_hot_query_indexes
+
+        self.assertEqual(check_hot_query_indexes(None, databases=["default"]), [])
+
+
+class AgentTickBatchTest(TestCase):
+    def _create_thinking_agents(self, count, start=0):
+        for i in range(start, start + count):
+            agent = Agent.objects.create(
+                name=f"TickAgent{i}",
+                look="",
+                description="",
+                tokens=0,
+                level=0,
+                location="test_room",
+                phase="thinking",
+                perception="",
+            )
+            LLMQueue.objects.create(agent=agent, prompt="Waiting for a reply")
+
+    def test_tick_query_count_does_not_grow_with_agents(self):
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        agent_app_command = AgentAppCommand()
+        self._create_thinking_agents(5)
+        # One query for the agents, one per prefetched relation
+        with self.assertNumQueries(3):
+            self.assertEqual(agent_app_command._run_tick(), 5)
+
+        self._create_thinking_agents(50, start=5)
+        with self.assertNumQueries(3):
+            self.assertEqual(agent_app_command._run_tick(), 55)
+
+    def test_tick_skips_stopped_and_sleeping_agents(self):
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        self._create_thinking_agents(3)
+        Agent.objects.filter(name="TickAgent0").update(is_running=False)
+        Agent.objects.filter(name="TickAgent1").update(
+            not_before=timezone.now() + timedelta(minutes=5)
+        )
+
+        agents = AgentAppCommand()._runnable_agents()
+
+        self.assertEqual([agent.name for agent in agents], ["TickAgent2"])
+
+    def test_tick_delivers_prefetched_perceptions(self):
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        self._create_thinking_agents(1)
+        agent = Agent.objects.get(name="TickAgent0")
+        PerceptionQueue.objects.create(agent=agent, text="First")
+        PerceptionQueue.objects.create(agent=agent, text="Second")
+
+        AgentAppCommand()._run_tick()
+
+        agent.refresh_from_db()
+        self.assertEqual(agent.perception, "MAD: First\nMAD: Second")
+        self.assertFalse(
+            PerceptionQueue.objects.filter(agent=agent, delivered=False).exists()
+        )
+
+    def test_perceptions_are_delivered_with_one_update(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        self._create_thinking_agents(1)
+        agent = Agent.objects.get(name="TickAgent0")
+        PerceptionQueue.objects.bulk_create(
+            PerceptionQueue(agent=agent, text=f"Perception {i}") for i in range(200)
+        )
+
+        with CaptureQueriesContext(connection) as context:
+            AgentAppCommand()._run_tick()
+
+        perception_updates = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith(
+                'UPDATE "mad_multi_agent_dungeon_perceptionqueue"'
+            )
+        ]
+        self.assertEqual(len(perception_updates), 1)
+        self.assertEqual(
+            PerceptionQueue.objects.filter(agent=agent, delivered=True).count(), 200
+        )
+
+
+class ConcurrentLLMDispatchTest(TestCase):
+    def setUp(self):
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        self.agent_app_command = AgentAppCommand()
+        self.api_key = LLMAPIKey.objects.create(key="pool_test_key", is_active=True)
+        self.requests = []
+        for i in range(3):
+            agent = Agent.objects.create(
+                name=f"PoolAgent{i}",
+                look="",
+                description="",
+                tokens=0,
+                level=0,
+                location="test_room",
+            )
+            self.requests.append(
+                LLMQueue.objects.create(agent=agent, prompt=f"Prompt {i}")
+            )
+
+    def tearDown(self):
+        self.agent_app_command._shutdown_llm_pool()
+
+    @patch("mad_multi_agent_dungeon.management.commands.run_agent_app.call_gemini_api")
+    def test_requests_are_in_flight_at_the_same_time(self, mock_call_gemini_api):
+        import threading
+
+        # Only returns once all three calls are running side by side
+        barrier = threading.Barrier(3, timeout=5)
+
+        def slow_call(prompt, api_key, parameters):
+            barrier.wait()
+            return f"Reply to {prompt}"
+
+        mock_call_gemini_api.side_effect = slow_call
+
+        self.agent_app_command._process_llm_queue()
+
+        for llm_request in self.requests:
+            llm_request.refresh_from_db()
+            self.assertEqual(llm_request.status, "completed")
+            self.assertEqual(llm_request.response, f"Reply to {llm_request.prompt}")
+        self.api_key.refresh_from_db()
+        self.assertEqual(self.api_key.usage_count, 3)
+
+    @patch("mad_multi_agent_dungeon.management.commands.run_agent_app.call_gemini_api")
+    def test_concurrency_limit_is_respected(self, mock_call_gemini_api):
+        mock_call_gemini_api.return_value = "Reply"
+        self.agent_app_command.llm_concurrency = 2
+
+        self.agent_app_command._process_llm_queue()
+
+        statuses = [
+            LLMQueue.objects.get(pk=llm_request.pk).status
+            for llm_request in self.requests
+        ]
+        self.assertEqual(statuses, ["completed", "completed", "pending"])
+
+    @patch("mad_multi_agent_dungeon.management.commands.run_agent_app.call_gemini_api")
+    def test_non_blocking_dispatch_records_results_later(self, mock_call_gemini_api):
+        import threading
+
+        release = threading.Event()
+
+        def held_call(prompt, api_key, parameters):
+            release.wait(5)
+            return "Late reply"
+
+        mock_call_gemini_api.side_effect = held_call
+
+        self.agent_app_command._process_llm_queue(block=False)
+        self.assertEqual(
+            LLMQueue.objects.filter(status="thinking").count(), len(self.requests)
+        )
+
+        release.set()
+        self.agent_app_command._process_llm_queue()
+        self.assertEqual(
+            LLMQueue.objects.filter(status="completed").count(), len(self.requests)
+        )
+
+    @patch("mad_multi_agent_dungeon.management.commands.run_agent_app.call_gemini_api")
+    def test_failed_call_marks_request_failed(self, mock_call_gemini_api):
+        mock_call_gemini_api.side_effect = Exception("API Error")
+
+        self.agent_app_command._process_llm_queue()
+
+        llm_request = LLMQueue.objects.get(pk=self.requests[0].pk)
+        self.assertEqual(llm_request.status, "failed")
+        self.assertEqual(llm_request.response, "Error: API Error")
+
+
+class LLMWorkerTest(TestCase):
+    def setUp(self):
+        self.api_key = LLMAPIKey.objects.create(key="worker_test_key", is_active=True)
+        self.agent = Agent.objects.create(
+            name="WorkerAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+        )
+
+    def test_claim_sets_a_lease_and_is_exclusive(self):
+        from mad_multi_agent_dungeon.queues import claim_llm_requests
+
+        llm_request = LLMQueue.objects.create(agent=self.agent, prompt="Prompt")
+
+        claimed = claim_llm_requests(batch_size=5, lease_seconds=60)
+
+        self.assertEqual([entry.pk for entry in claimed], [llm_request.pk])
+        self.assertEqual(claimed[0].status, "thinking")
+        self.assertGreater(claimed[0].lease_expires, timezone.now())
+        # A second worker finds nothing to claim while the lease holds
+        self.assertEqual(claim_llm_requests(batch_size=5), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        from mad_multi_agent_dungeon.queues import (
+            claim_llm_requests,
+            release_llm_request,
+        )
+
+        LLMQueue.objects.create(
+            agent=self.agent,
+            prompt="Prompt",
+            status="thinking",
+            lease_expires=timezone.now() - timedelta(seconds=1),
+        )
+        stale = LLMQueue.objects.get()
+
+        claimed = claim_llm_requests(batch_size=1, lease_seconds=60)
+
+        self.assertEqual(len(claimed), 1)
+        # The worker that lost the lease can no longer write its result
+        self.assertFalse(release_llm_request(stale, "completed", "Too late"))
+        self.assertTrue(release_llm_request(claimed[0], "completed", "On time"))
+        self.assertEqual(LLMQueue.objects.get().response, "On time")
+
+    @patch("mad_multi_agent_dungeon.llm_dispatch.call_gemini_api")
+    def test_dispatcher_completes_requests(self, mock_call_gemini_api):
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+
+        mock_call_gemini_api.return_value = "Worker reply"
+        llm_request = LLMQueue.objects.create(agent=self.agent, prompt="Prompt")
+        dispatcher = LLMDispatcher(concurrency=2)
+        self.addCleanup(dispatcher.shutdown)
+
+        self.assertEqual(dispatcher.dispatch(block=True), 1)
+
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "completed")
+        self.assertEqual(llm_request.response, "Worker reply")
+        self.assertIsNone(llm_request.lease_expires)
+        self.api_key.refresh_from_db()
+        self.assertEqual(self.api_key.usage_count, 1)
+
+    def test_shutdown_returns_unfinished_requests_to_the_queue(self):
+        import threading
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+
+        release = threading.Event()
+        self.addCleanup(release.set)
+        llm_request = LLMQueue.objects.create(agent=self.agent, prompt="Prompt")
+        dispatcher = LLMDispatcher(
+            concurrency=1, call=lambda *args: release.wait(5) and "Reply"
+        )
+
+        dispatcher.dispatch()
+        dispatcher.shutdown()
+
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "pending")
+        self.assertIsNone(llm_request.lease_expires)
+
+
+class KeyPoolTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            name="KeyPoolAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+        )
+
+    def _pool(self, clock=None):
+        from mad_multi_agent_dungeon.key_pool import KeyPool
+
+        pool = KeyPool(clock=clock) if clock else KeyPool()
+        pool.refresh()
+        return pool
+
+    def test_requests_are_spread_over_keys(self):
+        first = LLMAPIKey.objects.create(key="first_key")
+        second = LLMAPIKey.objects.create(key="second_key")
+        pool = self._pool()
+
+        picked = [pool.acquire() for _ in range(4)]
+
+        self.assertEqual(
+            [key.pk for key in picked], [first.pk, second.pk, first.pk, second.pk]
+        )
+
+    def test_rpm_and_tpm_limits_are_enforced_per_window(self):
+        LLMAPIKey.objects.create(key="limited_key", parameters={"rpm": 2, "tpm": 100})
+        now = [0.0]
+        pool = self._pool(clock=lambda: now[0])
+
+        self.assertIsNotNone(pool.acquire(tokens=10))
+        self.assertIsNone(pool.acquire(tokens=200))  # Over the token budget
+        self.assertIsNotNone(pool.acquire(tokens=10))
+        self.assertIsNone(pool.acquire(tokens=10))  # Over the request budget
+
+        now[0] += 61  # The window slides past the earlier requests
+        self.assertIsNotNone(pool.acquire(tokens=10))
+
+    def test_rate_limits_are_not_sent_to_the_model(self):
+        api_key = LLMAPIKey(key="params_key", parameters={"temperature": 0.5, "rpm": 5})
+
+        self.assertEqual(api_key.generation_parameters(), {"temperature": 0.5})
+
+    def test_throttled_key_cools_down(self):
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+
+        class TooManyRequests(Exception):
+            code = 429
+
+        throttled = LLMAPIKey.objects.create(key="throttled_key")
+        llm_request = LLMQueue.objects.create(agent=self.agent, prompt="Prompt")
+
+        def call(prompt, api_key, parameters):
+            raise TooManyRequests("Resource has been exhausted")
+
+        dispatcher = LLMDispatcher(concurrency=1, call=call)
+        self.addCleanup(dispatcher.shutdown)
+        dispatcher.dispatch(block=True)
+
+        # The request goes back to the queue instead of failing...
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "pending")
+        throttled.refresh_from_db()
+        self.assertGreater(throttled.cooldown_until, timezone.now())
+        # ...and is left alone until a key is available again
+        self.assertEqual(dispatcher.dispatch(block=True), 0)
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "pending")
+
+    @patch("mad_multi_agent_dungeon.llm_dispatch.warm_up")
+    def test_dispatcher_warms_up_every_active_key(self, mock_warm_up):
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+
+        LLMAPIKey.objects.create(key="warm_a", parameters={"temperature": 1, "rpm": 5})
+        LLMAPIKey.objects.create(key="warm_b")
+        LLMAPIKey.objects.create(key="warm_off", is_active=False)
+        mock_warm_up.return_value = True
+
+        self.assertEqual(LLMDispatcher().warm_up(), 2)
+        mock_warm_up.assert_any_call("warm_a", parameters={"temperature": 1})
+
+
+class StreamingLLMTest(TestCase):
+    def setUp(self):
+        LLMAPIKey.objects.create(key="stream_key")
+        self.agent = Agent.objects.create(
+            name="StreamAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+        )
+
+    def test_scanner_returns_tags_once_their_bracket_closes(self):
+        from mad_multi_agent_dungeon.directives import DirectiveScanner
+
+        scanner = DirectiveScanner()
+
+        self.assertEqual(scanner.feed("I will [command|say|Hel"), [])
+        self.assertEqual(scanner.feed("lo there] and [lo"), ["say Hello there"])
+        self.assertEqual(scanner.feed("ad|map]\n[remember|mood"), ["load map"])
+        self.assertEqual(
+            scanner.feed("|calm|happy] [remember|bad]"), ["remember mood calm|happy"]
+        )
+        self.assertEqual(
+            scanner.text,
+            (
+                "I will [command|say|Hello there] and [load|map]\n"
+                "[remember|mood|calm|happy] [remember|bad]"
+            ),
+        )
+
+    def test_streamed_commands_are_queued_before_the_response_ends(self):
+        import threading
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+
+        llm_request = LLMQueue.objects.create(agent=self.agent, prompt="Prompt")
+        first_tag_sent = threading.Event()
+        finish = threading.Event()
+        self.addCleanup(finish.set)
+
+        def stream(prompt, api_key, parameters):
+            yield "Let me look. [command|lo"
+            yield "ok] Then"
+            first_tag_sent.set()
+            finish.wait(5)
+            yield " I go. [command|go|north]"
+
+        dispatcher = LLMDispatcher(concurrency=1, stream=True, stream_call=stream)
+        self.addCleanup(dispatcher.shutdown)
+        dispatcher.dispatch()
+        self.assertTrue(first_tag_sent.wait(5))
+
+        dispatcher.collect()
+
+        # The first command is queued while the model is still generating
+        self.assertEqual(
+            list(CommandQueue.objects.values_list("command", flat=True)), ["look"]
+        )
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "thinking")
+        self.assertEqual(llm_request.response, "Let me look. [command|look] Then")
+
+        finish.set()
+        dispatcher.dispatch(block=True)
+
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "completed")
+        self.assertEqual(llm_request.directives_queued, 2)
+        self.assertEqual(
+            list(CommandQueue.objects.order_by("id").values_list("command", flat=True)),
+            ["look", "go north"],
+        )
+
+    def test_last_chunk_of_a_stream_ending_during_collect_is_queued(self):
+        import threading
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+
+        llm_request = LLMQueue.objects.create(agent=self.agent, prompt="Prompt")
+        first_tag_sent = threading.Event()
+        finish = threading.Event()
+        self.addCleanup(finish.set)
+
+        def stream(prompt, api_key, parameters):
+            yield "[command|look]\n"
+            first_tag_sent.set()
+            finish.wait(5)
+            yield "[command|say hi]\n"
+
+        dispatcher = LLMDispatcher(concurrency=1, stream=True, stream_call=stream)
+        self.addCleanup(dispatcher.shutdown)
+        dispatcher.dispatch()
+        self.assertTrue(first_tag_sent.wait(5))
+
+        record_streamed_chunks = dispatcher._record_streamed_chunks
+
+        def stream_ends_after_draining():
+            record_streamed_chunks()
+            # The last chunk arrives and the call finishes right after
+            finish.set()
+            for future in dispatcher._in_flight:
+                future.result(5)
+
+        dispatcher._record_streamed_chunks = stream_ends_after_draining
+        dispatcher.collect()
+        dispatcher._record_streamed_chunks = record_streamed_chunks
+        dispatcher.collect()
+
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "completed")
+        self.assertEqual(llm_request.directives_queued, 2)
+        self.assertEqual(
+            list(CommandQueue.objects.order_by("id").values_list("command", flat=True)),
+            ["look", "say hi"],
+        )
+
+    def test_interrupted_stream_is_not_streamed_again(self):
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+
+        llm_request = LLMQueue.objects.create(
+            agent=self.agent,
+            prompt="Prompt",
+            status="thinking",
+            lease_expires=timezone.now() - timedelta(seconds=1),
+            response="[command|look]\n",
+            directives_queued=1,
+        )
+        CommandQueue.objects.create(agent=self.agent, command="look")
+        stream = MagicMock(return_value=iter(["[command|look]\n[command|say hi]\n"]))
+
+        dispatcher = LLMDispatcher(concurrency=1, stream=True, stream_call=stream)
+        self.addCleanup(dispatcher.shutdown)
+        dispatcher.dispatch(block=True)
+
+        stream.assert_not_called()
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "failed")
+        self.assertEqual(llm_request.directives_queued, 1)
+        self.assertEqual(CommandQueue.objects.count(), 1)
+
+    def test_agent_app_does_not_queue_streamed_commands_again(self):
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        LLMQueue.objects.create(
+            agent=self.agent,
+            prompt="Prompt",
+            status="completed",
+            response="[command|look]",
+            directives_queued=1,
+        )
+        CommandQueue.objects.create(agent=self.agent, command="look")
+
+        AgentAppCommand()._process_agent_cycle(self.agent)
+
+        self.assertEqual(CommandQueue.objects.count(), 1)
+        self.agent.refresh_from_db()
+        self.assertIn("LLM: [command|look]", self.agent.perception)
+
+
+class PromptBuilderTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            name="PromptAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+            prompt="Base prompt.",
+            perception="MAD: Hello",
+        )
+        self.first = Memory.objects.create(agent=self.agent, key="a", value="One")
+        self.second = Memory.objects.create(agent=self.agent, key="b", value="Two")
+        self.agent.memoriesLoaded = [self.first.id, self.second.id]
+
+    def test_prompt_matches_the_original_layout(self):
+        from mad_multi_agent_dungeon.prompts import PromptBuilder
+
+        prompt = PromptBuilder().build(self.agent)
+
+        self.assertEqual(
+            prompt.text,
+            "Base prompt.\n## Loaded Memories:\nOne\nTwo\n# Perception\nMAD: Hello",
+        )
+        self.assertEqual(
+            prompt.segments, {"base": 12, "memories": 27, "perception": 23}
+        )
+
+    def test_unchanged_segments_are_reused(self):
+        from mad_multi_agent_dungeon.prompts import PromptBuilder
+
+        builder = PromptBuilder()
+        builder.build(self.agent)
+        self.agent.perception = "MAD: Something new"
+
+        # Only the version check of the memory block hits the database
+        with self.assertNumQueries(1):
+            prompt = builder.build(self.agent)
+
+        self.assertEqual(builder.hits, 2)
+        self.assertTrue(prompt.text.endswith("# Perception\nMAD: Something new"))
+
+    def test_changed_memories_are_rendered_again(self):
+        from mad_multi_agent_dungeon.prompts import PromptBuilder
+
+        builder = PromptBuilder()
+        builder.build(self.agent)
+        self.first.value = "Uno"
+        self.first.save()
+        self.agent.prompt = "New base."
+
+        prompt = builder.build(self.agent)
+
+        self.assertTrue(prompt.text.startswith("New base.\n## Loaded Memories:\nUno"))
+        self.second.delete()
+        self.assertNotIn("Two", builder.build(self.agent).text)
+
+
+class PromptStoreTest(TestCase):
+    def setUp(self):
+        from mad_multi_agent_dungeon import prompt_store
+
+        # Start every test with a cold segment cache
+        prompt_store._cache.clear()
+        self.agent = Agent.objects.create(
+            name="StoreAgent",
+            look="",
+            description="",
+            tokens=0,
+            level=0,
+            location="test_room",
+        )
+
+    def test_shared_segments_are_stored_once(self):
+        from mad_multi_agent_dungeon.models import PromptSegment
+        from mad_multi_agent_dungeon.prompt_store import store_prompt
+
+        base = "Base prompt. " * 100
+        first = LLMQueue.objects.create(
+            agent=self.agent, prompt_segments=store_prompt([base, "# Perception\nA"])
+        )
+        second = LLMQueue.objects.create(
+            agent=self.agent, prompt_segments=store_prompt([base, "# Perception\nB"])
+        )
+
+        self.assertEqual(PromptSegment.objects.count(), 3)
+        self.assertEqual(first.prompt_segments[0], second.prompt_segments[0])
+        self.assertEqual(first.prompt_text, "")
+        second = LLMQueue.objects.get(pk=second.pk)
+        self.assertEqual(second.prompt, base + "\n# Perception\nB")
+
+    def test_compressed_segments_read_back_transparently(self):
+        from mad_multi_agent_dungeon import prompt_store
+        from mad_multi_agent_dungeon.models import PromptSegment
+
+        text = "The same memory, over and over. " * 50
+        with self.settings(MAD_PROMPT_COMPRESSION=True):
+            digests = prompt_store.store_prompt([text])
+
+        segment = PromptSegment.objects.get()
+        self.assertTrue(segment.compressed)
+        self.assertLess(len(bytes(segment.data)), len(text))
+        prompt_store._cache.clear()
+        self.assertEqual(prompt_store.assemble_prompt(digests), text)
+
+    def test_segments_are_stored_again_after_a_rollback(self):
+        from django.db import transaction
+        from mad_multi_agent_dungeon.models import PromptSegment
+        from mad_multi_agent_dungeon.prompt_store import store_prompt
+
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            store_prompt(["Rolled back."])
+            raise RuntimeError
+
+        digests = store_prompt(["Rolled back."])
+
+        self.assertEqual(
+            list(PromptSegment.objects.values_list("digest", flat=True)), digests
+        )
+
+    def test_missing_segment_fails_the_request(self):
+        from mad_multi_agent_dungeon import prompt_store
+        from mad_multi_agent_dungeon.llm_dispatch import LLMDispatcher
+        from mad_multi_agent_dungeon.models import PromptSegment
+
+        LLMAPIKey.objects.create(key="store_test_key", is_active=True)
+        llm_request = LLMQueue.objects.create(
+            agent=self.agent,
+            prompt_segments=prompt_store.store_prompt(["Base.", "Memories."]),
+        )
+        PromptSegment.objects.filter(digest=llm_request.prompt_segments[1]).delete()
+        prompt_store._cache.clear()
+        call = MagicMock(return_value="Reply")
+
+        LLMDispatcher(concurrency=1, call=call).dispatch(block=True)
+
+        call.assert_not_called()
+        llm_request.refresh_from_db()
+        self.assertEqual(llm_request.status, "failed")
+        self.assertIn(llm_request.prompt_segments[1], llm_request.response)
+        with self.assertRaises(prompt_store.MissingPromptSegment):
+            prompt_store.assemble_prompt(llm_request.prompt_segments)
+
+    def test_agent_detail_api_shows_reassembled_prompt(self):
+        from mad_multi_agent_dungeon.prompt_store import store_prompt
+
+        LLMQueue.objects.create(
+            agent=self.agent, prompt_segments=store_prompt(["Base.", "Memories."])
+        )
+        LLMQueue.objects.create(agent=self.agent, prompt="Written directly.")
+
+        response = self.client.get(
+            reverse("agent_detail_api", args=[self.agent.name])
+        )
+
+        prompts = [entry["prompt"] for entry in response.json()["llm_queue"]]
+        self.assertCountEqual(prompts, ["Base.\nMemories.", "Written directly."])
+
+
+class TokenBudgetTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            name="BudgetAgent", location="room1", prompt="Base prompt."
+        )
+
+    def test_estimate_tokens(self):
+        from .tokens import estimate_tokens
+
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens("abcd" * 10), 10)
+        # Never fewer tokens than words
+        self.assertEqual(estimate_tokens("a b c d e f"), 6)
+
+    def test_token_counter_falls_back_to_estimate(self):
+        from .tokens import TokenCounter, estimate_tokens
+
+        # Exact counting without an active API key
+        counter = TokenCounter(exact=True)
+        self.assertEqual(counter("some text here"), estimate_tokens("some text here"))
+
+    def test_keep_tail_drops_whole_events(self):
+        from .prompts import keep_tail
+
+        perception = "MAD: first event\noutput line\nMAD: second\nLLM: third"
+        self.assertEqual(keep_tail(perception, 30), "MAD: second\nLLM: third")
+        self.assertEqual(keep_tail(perception, 100), perception)
+
+    def test_keep_tail_cuts_a_single_long_line(self):
+        from .prompts import keep_tail
+
+        self.assertEqual(keep_tail("LLM: " + "x" * 20, 10), "x" * 10)
+
+    def test_keep_head_drops_trailing_lines(self):
+        from .prompts import keep_head
+
+        self.assertEqual(keep_head("one\ntwo\nthree", 8), "one\ntwo")
+
+    def test_allocate_budget_redistributes_unused_shares(self):
+        from .prompts import allocate_budget
+
+        shares = {"base": 0.3, "memories": 0.3, "perception": 0.4}
+        allocation = allocate_budget(
+            100, {"base": 10, "memories": 0, "perception": 500}, shares
+        )
+        self.assertEqual(allocation, {"base": 10, "memories": 0, "perception": 90})
+
+    def test_prompt_fits_agent_token_budget(self):
+        from .prompts import PromptBuilder
+
+        self.agent.perception = "\n".join(
+            f"MAD: event number {i} happened" for i in range(50)
+        )
+        self.agent.token_budget = 40
+        prompt = PromptBuilder().build(self.agent)
+
+        self.assertLessEqual(sum(prompt.tokens.values()), 40)
+        self.assertTrue(prompt.text.startswith("Base prompt."))
+        # The newest events are kept, whole
+        self.assertTrue(prompt.text.endswith("MAD: event number 49 happened"))
+        for line in prompt.text.split("\n")[2:]:
+            self.assertRegex(line, r"^MAD: event number \d+ happened$")
+
+    def test_prompt_without_budget_is_not_trimmed(self):
+        from .prompts import PromptBuilder
+
+        self.agent.perception = "MAD: " + "word " * 500
+        prompt = PromptBuilder().build(self.agent)
+        self.assertIn(self.agent.perception, prompt.text)
+        self.assertEqual(prompt.tokens["base"], 3)
+
+
+class PerceptionRingTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            name="RingAgent", location="room1", perception="MAD: Old news"
+        )
+
+    def test_append_is_a_single_insert(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            self.agent.append_perception("MAD: One", "MAD: Two")
+
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]["sql"].startswith("INSERT"))
+        agent = Agent.objects.get(pk=self.agent.pk)
+        self.assertEqual(agent.perception, "MAD: Old news\nMAD: One\nMAD: Two")
+
+    def test_events_out_of_the_limit_are_pruned_when_read(self):
+        self.agent.perception_limit = 22
+        self.agent.save()
+        self.agent.append_perception("MAD: First", "MAD: Second", "MAD: Third")
+
+        agent = Agent.objects.get(pk=self.agent.pk)
+        self.assertEqual(agent.perception, "MAD: Second\nMAD: Third")
+        self.assertEqual(
+            list(agent.perception_events.values_list("text", flat=True)),
+            ["MAD: Second", "MAD: Third"],
+        )
+        self.agent.refresh_from_db()
+        self.assertEqual(self.agent.perception_snapshot, "")
+
+    def test_assigning_replaces_appended_events(self):
+        self.agent.append_perception("MAD: Appended")
+        self.agent.perception = ""
+        self.agent.save()
+
+        agent = Agent.objects.get(pk=self.agent.pk)
+        self.assertEqual(agent.perception, "")
+        self.assertFalse(agent.perception_events.exists())
+
+    def test_save_leaves_the_perception_alone(self):
+        agent = Agent.objects.get(pk=self.agent.pk)
+        self.agent.append_perception("MAD: Appended")
+        agent.level = 3
+        agent.save()
+
+        agent = Agent.objects.get(pk=self.agent.pk)
+        self.assertEqual(agent.perception, "MAD: Old news\nMAD: Appended")
+        self.assertEqual(agent.level, 3)
+
+
+class LoadedMemoryTest(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(name="MemoryAgent", location="room1")
+        self.memories = [
+            Memory.objects.create(agent=self.agent, key=f"key{i}", value=f"Value {i}")
+            for i in range(5)
+        ]
+        # Loaded out of creation order
+        self.agent.memoriesLoaded = [m.id for m in reversed(self.memories)]
+        self.agent.save()
+
+    def test_memories_are_fetched_in_one_query(self):
+        from mad_multi_agent_dungeon.prompts import PromptBuilder
+
+        self.agent.perception  # Materialized separately
+        # The version check and one query for all the values
+        with self.assertNumQueries(2):
+            prompt = PromptBuilder().build(self.agent)
+
+        self.assertIn(
+            "## Loaded Memories:\n" + "\n".join(f"Value {i}" for i in range(4, -1, -1)),
+            prompt.text,
+        )
+
+    def test_deleting_a_memory_unloads_it(self):
+        self.memories[2].delete()
+
+        self.agent.refresh_from_db()
+        self.assertEqual(
+            self.agent.memoriesLoaded,
+            [self.memories[i].id for i in (4, 3, 1, 0)],
+        )
+
+    def test_forget_command_unloads_the_memory(self):
+        command_entry = CommandQueue.objects.create(
+            agent=self.agent, command="forget key0", status="processing"
+        )
+        CommandWorker()._process_single_command(command_entry)
+
+        self.agent.refresh_from_db()
+        self.assertNotIn(self.memories[0].id, self.agent.memoriesLoaded)
+        self.assertEqual(len(self.agent.memoriesLoaded), 4)
+
+
+class DirectiveParsingTest(TestCase):
+    def test_directives_keep_the_order_they_were_written_in(self):
+        from mad_multi_agent_dungeon.directives import Directive, parse_directives
+
+        directives = parse_directives(
+            "[remember|k|v] then [command|go|north] [load|k] [remember|bad]"
+        )
+
+        self.assertEqual(
+            directives,
+            [
+                Directive("remember", "k|v", "remember k v"),
+                Directive("command", "go|north", "go north"),
+                Directive("load", "k", "load k"),
+            ],
+        )
+
+    def test_llm_response_directives_are_queued_in_one_insert(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from mad_multi_agent_dungeon.management.commands.run_agent_app import (
+            Command as AgentAppCommand,
+        )
+
+        agent = Agent.objects.create(name="Parser", location="room1")
+        LLMQueue.objects.create(
+            agent=agent,
+            prompt="Prompt",
+            response="[load|map] [command|look] [remember|seen|a door] [command|go|north]",
+            status="completed",
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            AgentAppCommand()._process_agent_cycle(agent)
+
+        command_inserts = [
+            query
+            for query in queries
+            if query["sql"].startswith('INSERT INTO "mad_multi_agent_dungeon_commandqueue"')
+        ]
+        self.assertEqual(len(command_inserts), 1)
+        self.assertEqual(
+            list(
+                CommandQueue.objects.filter(agent=agent)
+                .order_by("date", "id")
+                .values_list("command", flat=True)
+            ),
+            ["load map", "look", "remember seen a door", "go north"],
+        )
+
+
+class WorldDataTest(TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.data_dir = Path(self.tmp_dir.name)
+        self._write_map("Hall")
+        (self.data_dir / "objects.json").write_text(json.dumps({"lamp": {}}))
+        self.now = 0.0
+        from mad_multi_agent_dungeon.world import WorldData
+
+        self.world = WorldData(self.data_dir, clock=lambda: self.now)
+
+    def _write_map(self, title, mtime=None):
+        import os
+
+        path = self.data_dir / "map.json"
+        path.write_text(
+            json.dumps(
+                {
+                    "rooms": {
+                        "hall": {
+                            "title": title,
+                            "exits": {"North": "yard"},
+                            "items": {"key_1": {"title": "Rusty Key"}},
+                        }
+                    }
+                }
+            )
+        )
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+    def test_data_is_loaded_lazily_and_once(self):
+        self.assertEqual(self.world.loads, 0)
+
+        self.assertEqual(self.world.room("hall")["title"], "Hall")
+        self.world.room("hall")
+        self.assertIn("lamp", self.world.objects)
+        self.assertEqual(self.world.loads, 1)
+
+    def test_lowercase_indexes(self):
+        self.assertEqual(self.world.exits("hall"), {"north": "yard"})
+        self.assertEqual(self.world.find_item("hall", "rusty key")[0], "key_1")
+        self.assertEqual(self.world.find_item("hall", "KEY_1")[0], "key_1")
+        self.assertIsNone(self.world.find_item("hall", "sword"))
+        self.assertEqual(self.world.exits("nowhere"), {})
+
+    def test_changed_files_are_reloaded(self):
+        self.world.room("hall")
+        self._write_map("Great Hall", mtime=10**18)
+
+        # Not checked again before the reload interval has passed
+        self.assertEqual(self.world.room("hall")["title"], "Hall")
+        self.now += 5
+        self.assertEqual(self.world.room("hall")["title"], "Great Hall")
+        self.assertEqual(self.world.loads, 2)
+
+
+class TravelCommandTest(TestCase):
+    def setUp(self):
+        def room(title, **exits):
+            return {"title": title, "description": f"This is {title}.", "exits": exits}
+
+        world.load(
+            {
+                "rooms": {
+                    "hall": room("Hall", north="corridor", up="attic"),
+                    "corridor": room("Corridor", south="hall", east="library"),
+                    "library": room("Library", west="corridor"),
+                    "attic": room("Attic", down="hall"),
+                    "island": room("Island"),
+                }
+            },
+            {},
+        )
+        self.addCleanup(world.reload)
+        self.agent = Agent.objects.create(name="Traveller", location="hall")
+
+    def _travel(self, target):
+        command_entry = CommandQueue.objects.create(
+            agent=self.agent, command=f"travel {target}", status="processing"
+        )
+        handle_command(command_entry)
+        command_entry.refresh_from_db()
+        self.agent.refresh_from_db()
+        return command_entry
+
+    def test_next_hops_follow_shortest_paths(self):
+        self.assertEqual(
+            world.next_hops("attic"),
+            {"hall": "down", "corridor": "down", "library": "down"},
+        )
+        self.assertEqual(world.path("attic", "library"), ["down", "north", "east"])
+        self.assertEqual(world.path("hall", "hall"), [])
+        self.assertIsNone(world.path("hall", "island"))
+
+    def test_travel_walks_the_whole_path_in_one_command(self):
+        watcher = Agent.objects.create(
+            name="Watcher", location="corridor", last_command_sent=timezone.now()
+        )
+
+        command_entry = self._travel("library")
+
+        self.assertEqual(command_entry.status, "completed")
+        self.assertTrue(
+            command_entry.output.startswith("You travel north, east.\nLibrary")
+        )
+        self.assertEqual(self.agent.location, "library")
+        self.assertEqual(
+            list(
+                PerceptionQueue.objects.filter(agent=watcher)
+                .order_by("id")
+                .values_list("text", flat=True)
+            ),
+            ["Traveller arrives from the south.", "Traveller leaves to the east."],
+        )
+
+    def test_travel_to_unreachable_or_unknown_rooms(self):
+        self.assertEqual(
+            self._travel("island").output,
+            "You can't find a way to island from here.",
+        )
+        self.assertEqual(self._travel("nowhere").status, "failed")
+        self.assertEqual(self._travel("hall").output, "You are already there.")
+        self.assertEqual(self.agent.location, "hall")
+
+    def test_reloading_the_map_recomputes_paths(self):
+        self.assertIsNone(world.path("hall", "island"))
+        rooms = dict(world.rooms)
+        rooms["library"] = {**rooms["library"], "exits": {"down": "island"}}
+        world.load({"rooms": rooms}, {})
+
+        self.assertEqual(world.path("hall", "island"), ["north", "east", "down"])
+
+
+class OccupancyIndexTest(TestCase):
+    def setUp(self):
+        from mad_multi_agent_dungeon.occupancy import occupancy
+
+        world.load(
+            {
+                "rooms": {
+                    "hall": {
+                        "title": "Hall",
+                        "description": "",
+                        "exits": {"north": "yard"},
+                    },
+                    "yard": {
+                        "title": "Yard",
+                        "description": "",
+                        "exits": {"south": "hall"},
+                    },
+                }
+            },
+            {},
+        )
+        self.addCleanup(world.reload)
+        now = timezone.now()
+        self.walker = Agent.objects.create(
+            name="Walker", location="hall", last_command_sent=now
+        )
+        self.listener = Agent.objects.create(
+            name="Listener", location="yard", last_command_sent=now
+        )
+        self.sleeper = Agent.objects.create(
+            name="Sleeper", location="yard", last_command_sent=now - timedelta(hours=1)
+        )
+        self.occupancy = occupancy
+        occupancy.enable()
+        self.addCleanup(occupancy.disable)
+
+    def test_index_is_built_from_active_agents(self):
+        self.assertEqual(
+            self.occupancy.present("yard"), [(self.listener.id, "Listener")]
+        )
+        self.assertEqual(self.occupancy.present("hall", exclude_id=self.walker.id), [])
+
+    def test_lookups_do_not_query_the_database(self):
+        from mad_multi_agent_dungeon.fanout import (
+            active_agent_names,
+            active_listener_ids,
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(active_listener_ids("yard"), [self.listener.id])
+            self.assertEqual(active_agent_names("hall"), ["Walker"])
+
+    def test_moves_update_the_index(self):
+        command_entry = CommandQueue.objects.create(
+            agent=self.walker, command="go north", status="processing"
+        )
+        handle_command(command_entry)
+
+        self.assertEqual(self.occupancy.present("hall"), [])
+        self.assertEqual(
+            [name for _, name in self.occupancy.present("yard")], ["Walker", "Listener"]
+        )
+        self.assertTrue(
+            PerceptionQueue.objects.filter(
+                agent=self.listener, text="Walker arrives from the south."
+            ).exists()
+        )
+
+    def test_agents_expire_from_the_index(self):
+        later = timezone.now() + timedelta(seconds=Agent.ACTIVE_WINDOW_SECONDS + 1)
+        self.assertEqual(self.occupancy.present("yard", now=later), [])
+
+    def test_sharded_workers_refuse_the_index(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        with self.assertRaises(CommandError):
+            call_command("run_command_worker", "--shards", "2", "--occupancy-index")
+
+
+class ObjectLookupTest(TestCase):
+    def setUp(self):
+        from mad_multi_agent_dungeon.room_objects import room_objects
+
+        world.load(
+            {"rooms": {"hall": {"title": "Hall", "description": "", "exits": {}}}},
+            {
+                "lamp_001": {
+                    "name": "Brass Lamp",
+                    "triggers": {"use": {"type": "response", "value": "It glows."}},
+                }
+            },
+        )
+        self.addCleanup(world.reload)
+        self.room_objects = room_objects
+        self.agent = Agent.objects.create(name="Looker", location="hall")
+        self.lamp = ObjectInstance.objects.create(object_id="lamp_001", room_id="hall")
+
+    def _run(self, command):
+        command_entry = CommandQueue.objects.create(
+            agent=self.agent, command=command, status="processing"
+        )
+        handle_command(command_entry)
+        command_entry.refresh_from_db()
+        return command_entry.output
+
+    def test_instances_reference_their_prototype(self):
+        self.assertEqual(self.lamp.data, {})
+        self.assertEqual(self.lamp.name, "Brass Lamp")
+        self.assertEqual(self.lamp.name_key, "brass lamp")
+
+        self.lamp.data = {"triggers": {}}
+        self.assertEqual(self.lamp.properties, {"name": "Brass Lamp", "triggers": {}})
+
+    def test_migration_keeps_only_what_differs_from_the_prototype(self):
+        import importlib
+        import json
+        import tempfile
+        from pathlib import Path
+
+        from django.apps import apps
+
+        migration = importlib.import_module(
+            "mad_multi_agent_dungeon.migrations.0026_objectinstance_name"
+        )
+        prototype = {"name": "Brass Lamp", "flags": [], "triggers": {}}
+        # A copy of the prototype, as instances used to be created
+        ObjectInstance.objects.filter(pk=self.lamp.pk).update(
+            name="", data={**prototype, "flags": ["lit"]}
+        )
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            (Path(data_dir) / "objects.json").write_text(
+                json.dumps({"lamp_001": prototype})
+            )
+            with self.settings(MAD_WORLD_DATA_DIR=data_dir):
+                migration.fill_names(apps, None)
+
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.data, {"flags": ["lit"]})
+        self.assertEqual(self.lamp.name_key, "brass lamp")
+
+    def test_use_and_look_go_through_the_name_column(self):
+        self.assertEqual(self._run("use BRASS LAMP"), "It glows.")
+        self.assertIn("Objects here: Brass Lamp", self._run("look"))
+
+    def test_cached_room_objects(self):
+        self.room_objects.enable()
+        self.addCleanup(self.room_objects.disable)
+
+        self.assertEqual(self.room_objects.names("hall"), ["Brass Lamp"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.room_objects.find("hall", "brass lamp"), self.lamp)
+
+        # Saving an instance clears the cache
+        ObjectInstance.objects.create(
+            object_id="lamp_001", room_id="hall", name="Torch"
+        )
+        self.assertEqual(self.room_objects.names("hall"), ["Brass Lamp", "Torch"])
+
+
+class TriggerEngineTest(TestCase):
+    def setUp(self):
+        from mad_multi_agent_dungeon.triggers import trigger_engine
+
+        world.load(
+            {"rooms": {"hall": {"title": "Hall", "description": "", "exits": {}}}},
+            {
+                "lamp_001": {
+                    "name": "Lamp",
+                    "triggers": {
+                        "use": {
+                            "type": "set_state",
+                            "state": {
+                                "triggers": {
+                                    "use": {"type": "response", "value": "Already lit."}
+                                }
+                            },
+                            "value": "You light the {name}.",
+                        },
+                        "take": {"type": "take"},
+                    },
+                },
+                "lever_001": {
+                    "name": "Lever",
+                    "triggers": {
+                        "use": {"type": "set_flag", "flag": "lever_pulled"},
+                        "push": {"type": "no_such_type"},
+                    },
+                },
+            },
+        )
+        self.addCleanup(world.reload)
+        self.engine = trigger_engine
+        self.agent = Agent.objects.create(name="Tinkerer", location="hall")
+
+    def _run(self, command):
+        command_entry = CommandQueue.objects.create(
+            agent=self.agent, command=command, status="processing"
+        )
+        handle_command(command_entry)
+        command_entry.refresh_from_db()
+        self.agent.refresh_from_db()
+        return command_entry.output
+
+    def test_triggers_are_compiled_once_per_prototype(self):
+        first = ObjectInstance.objects.create(object_id="lever_001", room_id="hall")
+        second = ObjectInstance.objects.create(object_id="lever_001", room_id="hall")
+        compiled = self.engine.compiled
+
+        table = self.engine.table(first)
+        self.assertIs(self.engine.table(second), table)
+        self.assertEqual(self.engine.compiled, compiled + 1)
+        # Unknown trigger types are left out
+        self.assertEqual(set(table), {"use"})
+
+    def test_instance_triggers_changed_elsewhere_are_recompiled(self):
+        lever = ObjectInstance.objects.create(
+            object_id="lever_001",
+            room_id="hall",
+            data={"triggers": {"use": {"type": "response", "value": "old"}}},
+        )
+        self.assertEqual(self._run("use lever"), "old")
+
+        # As another process would, without this one's signals
+        ObjectInstance.objects.filter(pk=lever.pk).update(
+            data={"triggers": {"use": {"type": "response", "value": "new"}}}
+        )
+
+        self.assertEqual(self._run("use lever"), "new")
+
+    def test_set_state_changes_the_instance(self):
+        ObjectInstance.objects.create(object_id="lamp_001", room_id="hall")
+
+        self.assertEqual(self._run("use lamp"), "You light the Lamp.")
+        self.assertEqual(self._run("use lamp"), "Already lit.")
+
+    def test_set_flag_changes_the_agent(self):
+        ObjectInstance.objects.create(object_id="lever_001", room_id="hall")
+
+        self.assertEqual(self._run("use lever"), "You use the Lever.")
+        self.assertEqual(self.agent.flags, {"lever_pulled": True})
+
+    def test_take_moves_the_object_into_the_inventory(self):
+        ObjectInstance.objects.create(object_id="lamp_001", room_id="hall")
+
+        self.assertEqual(self._run("take lamp"), "You take the Lamp.")
+        self.assertEqual(self.agent.inventory, ["Lamp"])
+        self.assertFalse(ObjectInstance.objects.filter(room_id="hall").exists())
+        self.assertEqual(self._run("take lamp"), "You don't see a lamp here.")
+
+    def test_take_keeps_the_object_when_the_result_is_not_saved(self):
+        from mad_multi_agent_dungeon.management.commands.run_command_worker import (
+            Command as CommandWorker,
+        )
+        from mad_multi_agent_dungeon.queues import (
+            claim_pending_commands,
+            recover_expired_commands,
+        )
+
+        ObjectInstance.objects.create(object_id="lamp_001", room_id="hall")
+        CommandQueue.objects.create(agent=self.agent, command="take lamp")
+        (slow,) = claim_pending_commands(batch_size=1, lease_seconds=60)
+        recover_expired_commands(now=timezone.now() + timedelta(seconds=61))
+        claim_pending_commands(batch_size=1, lease_seconds=60)
+
+        CommandWorker()._process_single_command(slow)
+
+        self.assertTrue(ObjectInstance.objects.filter(object_id="lamp_001").exists())
+        self.agent.refresh_from_db()
+        self.assertEqual(self.agent.inventory, [])
+
+    def test_take_of_an_object_already_taken_elsewhere(self):
+        from mad_multi_agent_dungeon.triggers import compile_triggers
+
+        gem = ObjectInstance.objects.create(object_id="gem_001", room_id="hall")
+        ObjectInstance.objects.filter(pk=gem.pk).delete()
+        take = compile_triggers({"take": {"type": "take"}})["take"]
+
+        result = take(self.agent, gem)
+
+        self.assertEqual(result.output, "You don't see a gem_001 here.")
+        self.assertEqual(self.agent.inventory, [])
+
+    def test_set_state_changes_the_current_row(self):
+        from mad_multi_agent_dungeon.triggers import compile_triggers
+
+        lamp = ObjectInstance.objects.create(object_id="lamp_001", room_id="hall")
+        ObjectInstance.objects.filter(pk=lamp.pk).update(data={"lit": True})
+        rename = compile_triggers(
+            {"use": {"type": "set_state", "state": {"name": "Broken Lamp"}}}
+        )["use"]
+
+        result = rename(self.agent, lamp)
+
+        lamp.refresh_from_db()
+        self.assertEqual(result.output, "You use the Broken Lamp.")
+        self.assertEqual(lamp.data, {"lit": True, "name": "Broken Lamp"})
+        self.assertEqual(lamp.name, "Broken Lamp")
+        self.assertEqual(
+            ObjectInstance.objects.get(room_id="hall", name_key="broken lamp"), lamp
+        )
+
+    def test_objects_without_the_trigger(self):
+        ObjectInstance.objects.create(object_id="lever_001", room_id="hall")
+
+        self.assertEqual(self._run("take lever"), "You can't take the lever.")
@@ -0,0 +1,52 @@
+import logging
+import math
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """
+    A fast local token estimate: about four characters per token, and never
+    fewer tokens than words.
+    """
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / CHARS_PER_TOKEN), len(text.split()))
+
+
+class TokenCounter:
+    """
+    Counts tokens with `estimate_tokens`, or exactly through the LLM API's
+    token-count endpoint when `exact` is set (`MAD_EXACT_TOKEN_COUNTS` by
+    default). Exact counting falls back to the estimate when no API key is
+    active or the API call fails.
+    """
+
+    def __init__(self, exact=None):
+        self.exact = settings.MAD_EXACT_TOKEN_COUNTS if exact is None else exact
+        self._api_key = None
+
+    def __call__(self, text):
+        if not text:
+            return 0
+        if self.exact:
+            try:
+                return self._count_exactly(text)
+            except Exception as e:
+                logger.warning(f"Exact token count failed, estimating instead: {e}")
+        return estimate_tokens(text)
+
+    def _count_exactly(self, text):
+        from .llm_api import get_model
+        from .models import LLMAPIKey
+
+        if self._api_key is None:
+            api_key_obj = LLMAPIKey.objects.filter(is_active=True).first()
+            if api_key_obj is None:
+                raise LookupError("No active LLM API key found.")
+            self._api_key = api_key_obj.key
+        return get_model(self._api_key).count_tokens(text).total_tokens
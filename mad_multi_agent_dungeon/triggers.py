@@ -0,0 +1,170 @@
+import copy
+import logging
+import threading
+
+from django.db import transaction
+
+from .models import ObjectInstance
+from .results import completed
+from .world import world
+
+logger = logging.getLogger(__name__)
+
+# Trigger type -> compiler. A compiler turns a trigger's spec from
+# objects.json into a function (agent, instance) -> CommandResult.
+TRIGGER_TYPES = {}
+
+
+def _message(text, instance):
+    # Trigger texts may mention the object as {name}
+    return text.replace("{name}", instance.name)
+
+
+def _gone(instance):
+    # Removed by another command since it was looked up
+    return completed(f"You don't see a {instance.name_key} here.")
+
+
+def trigger_type(name):
+    def register(compiler):
+        TRIGGER_TYPES[name] = compiler
+        return compiler
+
+    return register
+
+
+@trigger_type("response")
+def _response(verb, spec):
+    # {"type": "response", "value": "text"}
+    text = spec.get("value", f"You {verb} the object.")
+    return lambda agent, instance: completed(text)
+
+
+@trigger_type("set_state")
+def _set_state(verb, spec):
+    # {"type": "set_state", "state": {...}, "value": "text"}: changes the
+    # instance's properties, e.g. to replace its description or triggers.
+    changes = dict(spec["state"])
+    text = spec.get("value", f"You {verb} the {{name}}.")
+
+    def fire(agent, instance):
+        # `instance` may come from the room cache; change the current row
+        with transaction.atomic():
+            current = (
+                ObjectInstance.objects.select_for_update()
+                .filter(pk=instance.pk)
+                .first()
+            )
+            if current is None:
+                return _gone(instance)
+            current.data = {**(current.data or {}), **changes}
+            if "name" in changes:
+                current.name = changes["name"]
+            current.save(update_fields=["data", "name", "name_key"])
+        return completed(_message(text, current))
+
+    return fire
+
+
+@trigger_type("set_flag")
+def _set_flag(verb, spec):
+    # {"type": "set_flag", "flag": "name", "flag_value": value, "value": "text"}
+    flag = spec["flag"]
+    flag_value = spec.get("flag_value", True)
+    text = spec.get("value", f"You {verb} the {{name}}.")
+
+    def fire(agent, instance):
+        agent.flags = {**(agent.flags or {}), flag: flag_value}
+        return completed(_message(text, instance), "flags")
+
+    return fire
+
+
+@trigger_type("take")
+def _take(verb, spec):
+    # {"type": "take", "value": "text"}: moves the object into the inventory
+    text = spec.get("value", "You take the {name}.")
+
+    def fire(agent, instance):
+        # Only the command that deletes the row gets the object, so it can't
+        # end up in two inventories when the room cache is stale. The delete
+        # is committed together with the inventory (see execute_command).
+        deleted, _ = ObjectInstance.objects.filter(pk=instance.pk).delete()
+        if not deleted:
+            return _gone(instance)
+        agent.inventory = [*(agent.inventory or []), instance.name]
+        return completed(_message(text, instance), "inventory")
+
+    return fire
+
+
+def compile_triggers(triggers):
+    """
+    Compiles the `triggers` of an object into a dispatch table of
+    {verb: fire(agent, instance)}. Triggers of an unknown type or with a
+    malformed spec are logged and left out.
+    """
+    table = {}
+    for verb, spec in (triggers or {}).items():
+        compiler = TRIGGER_TYPES.get(spec.get("type"))
+        if compiler is None:
+            logger.warning(f"Unknown type of '{verb}' trigger: {spec.get('type')}")
+            continue
+        try:
+            table[verb.lower()] = compiler(verb, spec)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Invalid '{verb}' trigger {spec}: {e}")
+    return table
+
+
+class TriggerEngine:
+    """
+    Fires object triggers from dispatch tables compiled once per prototype
+    (`object_id`) and kept until the world data is reloaded. Instances whose
+    `data` overrides the prototype's triggers get a table of their own, reused
+    only while the instance's triggers are the ones it was compiled from, as
+    they may be changed by another process. Saving or deleting an instance in
+    this process drops these tables (see signals).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prototypes = {}  # object_id -> (world version, table)
+        self._instances = {}  # instance pk -> (triggers, table)
+        self.compiled = 0
+
+    def fire(self, verb, agent, instance):
+        """Returns the CommandResult of the object's `verb` trigger, or None."""
+        trigger = self.table(instance).get(verb)
+        return trigger(agent, instance) if trigger else None
+
+    def table(self, instance):
+        if "triggers" in (instance.data or {}):
+            triggers = instance.data["triggers"]
+            cached = self._instances.get(instance.pk)
+            if cached is not None and cached[0] == triggers:
+                return cached[1]
+            table = self._compile(triggers)
+            if instance.pk is not None:
+                with self._lock:
+                    self._instances[instance.pk] = (copy.deepcopy(triggers), table)
+            return table
+        version = world.version
+        cached = self._prototypes.get(instance.object_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        table = self._compile(instance.prototype.get("triggers"))
+        with self._lock:
+            self._prototypes[instance.object_id] = (version, table)
+        return table
+
+    def clear_instances(self):
+        with self._lock:
+            self._instances = {}
+
+    def _compile(self, triggers):
+        self.compiled += 1
+        return compile_triggers(triggers)
+
+
+trigger_engine = TriggerEngine()
@@ -2,6 +2,8 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.http import JsonResponse
 from .forms import SendCommandForm
 from .models import CommandQueue, PerceptionQueue, Agent, Memory, LLMQueue
+from .prompt_store import MissingPromptSegment
+from .world import world
 import json
 import os
 from django.conf import settings
@@ -99,7 +101,8 @@ def update_prompt(request, agent_name):
         agent = get_object_or_404(Agent, name=agent_name)
         data = json.loads(request.body)
         agent.prompt = data.get("prompt", agent.prompt)
-        agent.perception = data.get("perception", agent.perception)
+        if "perception" in data:
+            agent.perception = data["perception"]
         agent.save()
         return JsonResponse(
             {"status": "success", "message": "Prompt updated successfully."}
@@ -129,15 +132,18 @@ def agent_detail_view(request, agent_name):
     )
 
 
+def _llm_prompt(entry):
+    # A request whose segments are gone shows why instead of a partial prompt
+    try:
+        return entry.prompt
+    except MissingPromptSegment as e:
+        return f"Error: {e}"
+
+
 def agent_detail_api(request, agent_name):
     agent = get_object_or_404(Agent, name=agent_name)
 
-    # Load map data
-    map_file_path = os.path.join(os.path.dirname(__file__), "data", "map.json")
-    with open(map_file_path, "r") as f:
-        map_data = json.load(f)
-
-    room_title = map_data["rooms"].get(agent.location, {}).get("title", "Unknown Room")
+    room_title = (world.room(agent.location) or {}).get("title", "Unknown Room")
 
     # Get last 5 commands
     commands = CommandQueue.objects.filter(agent=agent).order_by("-date")[:5]
@@ -183,7 +189,7 @@ def agent_detail_api(request, agent_name):
         "llm_queue": [
             {
                 "id": entry.id,
-                "prompt": entry.prompt,
+                "prompt": _llm_prompt(entry),
                 "status": entry.status,
                 "response": entry.response,
                 "date": entry.date.isoformat(),
@@ -0,0 +1,183 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAP_FILE = "map.json"
+OBJECTS_FILE = "objects.json"
+
+
+class WorldData:
+    """
+    The dungeon's map and object prototypes, read from `map.json` and
+    `objects.json` in `MAD_WORLD_DATA_DIR`.
+
+    The files are parsed on first use, not at import, and only once per
+    process: after that their modification times are checked at most every
+    `MAD_WORLD_RELOAD_INTERVAL` seconds, and the world is reloaded when they
+    change, so edits to the map take effect without a restart. Lookups by
+    lowercase exit and item name go through indexes built at load time.
+
+    The exits double as the room graph: `next_hops()` gives, for each room,
+    the first step of a shortest path to every other room.
+    """
+
+    def __init__(self, data_dir=None, clock=time.monotonic):
+        self._data_dir = data_dir
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._mtimes = None
+        self._checked_at = None
+        self._map = {}
+        self._objects = {}
+        self._exits = {}  # room id -> {lowercase direction: room id}
+        self._items = {}  # room id -> {lowercase item id or title: (id, data)}
+        self._next_hops = {}  # room id -> {reachable room id: direction}
+        self.loads = 0
+        self._version = 0
+
+    @property
+    def data_dir(self):
+        return Path(self._data_dir or settings.MAD_WORLD_DATA_DIR)
+
+    @property
+    def map(self):
+        self._refresh()
+        return self._map
+
+    @property
+    def rooms(self):
+        return self.map.get("rooms", {})
+
+    @property
+    def objects(self):
+        self._refresh()
+        return self._objects
+
+    @property
+    def version(self):
+        """Changes whenever the world is (re)loaded."""
+        self._refresh()
+        return self._version
+
+    def room(self, room_id):
+        return self.rooms.get(room_id)
+
+    def exits(self, room_id):
+        """The room's exits, by lowercase direction."""
+        self._refresh()
+        return self._exits.get(room_id, {})
+
+    def find_item(self, room_id, name):
+        """Returns (item id, item data) for the room item called `name`, or None."""
+        self._refresh()
+        return self._items.get(room_id, {}).get(name.lower())
+
+    def next_hops(self, room_id):
+        """
+        The direction to take from `room_id` towards every room reachable from
+        it, as {room id: direction}, following shortest paths. The rows of
+        this all-pairs table are each filled by one breadth-first search when
+        first needed and dropped when the map is reloaded.
+        """
+        self._refresh()
+        hops = self._next_hops.get(room_id)
+        if hops is None:
+            hops = self._search(room_id)
+            self._next_hops[room_id] = hops
+        return hops
+
+    def path(self, source, target):
+        """
+        The directions of a shortest path from `source` to `target`: an empty
+        list when they are the same room, None when there is no way there.
+        """
+        directions = []
+        room_id = source
+        while room_id != target:
+            direction = self.next_hops(room_id).get(target)
+            if direction is None:
+                return None
+            directions.append(direction)
+            room_id = self.exits(room_id).get(direction)
+        return directions
+
+    def _search(self, source):
+        hops = {}
+        queue = deque([source])
+        while queue:
+            room_id = queue.popleft()
+            for direction, target in self._exits.get(room_id, {}).items():
+                if target != source and target not in hops:
+                    hops[target] = hops.get(room_id, direction)
+                    queue.append(target)
+        return hops
+
+    def load(self, map_data, objects):
+        """Replaces the world with the given data, e.g. parsed from the files."""
+        exits = {}
+        items = {}
+        for room_id, room_data in map_data.get("rooms", {}).items():
+            exits[room_id] = {
+                direction.lower(): target
+                for direction, target in room_data.get("exits", {}).items()
+            }
+            room_items = {}
+            # Ids win over titles, like the order examine used to check them
+            for item_id, item_data in room_data.get("items", {}).items():
+                title = item_data.get("title", "").lower()
+                if title:
+                    room_items.setdefault(title, (item_id, item_data))
+            for item_id, item_data in room_data.get("items", {}).items():
+                room_items[item_id.lower()] = (item_id, item_data)
+            items[room_id] = room_items
+        with self._lock:
+            self._map, self._objects = map_data, objects
+            self._exits, self._items = exits, items
+            self._next_hops = {}
+            self._version += 1
+            self._loaded = True
+            self._mtimes = self._stat()
+            self._checked_at = self._clock()
+
+    def reload(self):
+        map_data = json.loads((self.data_dir / MAP_FILE).read_text())
+        objects = json.loads((self.data_dir / OBJECTS_FILE).read_text())
+        self.load(map_data, objects)
+        self.loads += 1
+        logger.info(f"Loaded world data from {self.data_dir}.")
+
+    def _stat(self):
+        try:
+            return tuple(
+                (self.data_dir / name).stat().st_mtime_ns
+                for name in (MAP_FILE, OBJECTS_FILE)
+            )
+        except OSError:
+            return None
+
+    def _refresh(self):
+        if not self._loaded:
+            self.reload()
+            return
+        now = self._clock()
+        if now - self._checked_at < settings.MAD_WORLD_RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        mtimes = self._stat()
+        if mtimes is not None and mtimes != self._mtimes:
+            try:
+                self.reload()
+            except (OSError, ValueError) as e:
+                # Most likely caught mid-write; keep the current world
+                logger.warning(f"Could not reload world data: {e}")
+
+
+world = WorldData()
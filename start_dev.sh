@@ -10,9 +10,14 @@ echo "Starting Django development server on http://127.0.0.1:8000/"
 python manage.py runserver &
 SERVER_PID=$!
 
-# Start the agent application
+# Start the LLM worker; run more of them to raise LLM throughput
+echo "Starting LLM worker..."
+python manage.py run_llm_worker &
+LLM_WORKER_PID=$!
+
+# Start the agent application, leaving LLM calls to the LLM worker
 echo "Starting agent application..."
-python manage.py run_agent_app &
+python manage.py run_agent_app --skip-llm &
 AGENT_APP_PID=$!
 
 # Define a cleanup function to be called on script exit
@@ -20,10 +25,12 @@ cleanup() {
     echo -e "\nCaught signal. Shutting down background processes..."
     kill $WORKER_PID
     kill $SERVER_PID
+    kill $LLM_WORKER_PID
     kill $AGENT_APP_PID
     # Wait for processes to terminate to avoid orphaned processes
     wait $WORKER_PID 2>/dev/null
     wait $SERVER_PID 2>/dev/null
+    wait $LLM_WORKER_PID 2>/dev/null
     wait $AGENT_APP_PID 2>/dev/null
     echo "Shutdown complete."
     exit 0